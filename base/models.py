@@ -112,13 +112,12 @@ class DateTimeModel(MyModel):
     class Meta:
         abstract = True
 
-    def __getattribute__(self, item):
-        if item == 'save_dirty_fields':
-            from dirtyfields import DirtyFieldsMixin
-            if isinstance(self, DirtyFieldsMixin) and self.is_dirty(check_relationship=True):
-                from django.utils import timezone
-                self.updated_at = timezone.now()
-        return super().__getattribute__(item)
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields and 'updated_at' not in update_fields:
+            # auto_now sets it on any save, but partial saves would not write it
+            kwargs['update_fields'] = list(update_fields) + ['updated_at']
+        return super().save(*args, **kwargs)
 
 
 class NameIndexActiveModel(DateTimeModel):
@@ -4,17 +4,23 @@ import io
 import os
 import sys
 import tempfile
+import threading
+import time as time_module
 import traceback
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import timedelta, time
 
 import filelock
 from django.conf import settings
 from django.core.management import call_command
 from django.core.serializers import json
-from django.db import models
+from django.db import models, connections
 from django.db.models import QuerySet
 from django.http import QueryDict
 from django.utils.html import escape, conditional_escape
+from django.utils.module_loading import import_string
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 
@@ -140,6 +146,27 @@ def batch_qs(qs: QuerySet, batch_size=1000):
         yield (qs[start:end], start, end, total)
 
 
+def batch_qs_by_id(qs: QuerySet, batch_size=1000, after_id=0):
+    """
+    Yields lists of objects of the queryset ordered by id.
+    Unlike batch_qs it uses `id > last_id` instead of OFFSET and does not count the queryset, so it is possible to resume
+    from the last processed id.
+
+    Usage:
+        for articles in batch_qs_by_id(Article.objects.filter(active=True), after_id=checkpoint):
+            for article in articles:
+                print article.body
+            checkpoint = articles[-1].id
+    """
+    last_id = after_id
+    while True:
+        batch = list(qs.filter(id__gt=last_id).order_by('id')[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1].id
+
+
 def has_number(string: str) -> bool:
     return any(char.isdigit() for char in string)
 
@@ -154,10 +181,145 @@ def as_list(item) -> list:
     return [item]
 
 
+class LockTimeout(Exception):
+    pass
+
+
+class FileLockBackend(object):
+    """
+    Lock file per key in tempdir. Works between processes of one host only.
+    """
+
+    def __init__(self):
+        self.path = os.path.join(tempfile.gettempdir(), settings.BASE_DIR[1:])
+        os.makedirs(self.path, exist_ok=True)
+
+    def acquire(self, key: str, timeout: float):
+        file_lock = filelock.FileLock(os.path.join(self.path, key + '.lock'))
+        try:
+            file_lock.acquire(timeout=timeout)
+        except filelock.Timeout:
+            raise LockTimeout(key)
+        return file_lock
+
+    def release(self, handle):
+        handle.release()
+
+
+class StripedLockBackend(object):
+    """
+    Fixed set of in-process locks, a key is mapped to one of them by crc32. Works inside one process only.
+    Different keys may share a stripe, so the locks are reentrant to allow nesting in one thread.
+    """
+
+    def __init__(self, stripes: int = 1024):
+        self.locks = [threading.RLock() for _ in range(stripes)]
+
+    def acquire(self, key: str, timeout: float):
+        stripe_lock = self.locks[zlib.crc32(key.encode()) % len(self.locks)]
+        if not stripe_lock.acquire(timeout=timeout):
+            raise LockTimeout(key)
+        return stripe_lock
+
+    def release(self, handle):
+        handle.release()
+
+
+class MySQLLockBackend(object):
+    """
+    MySQL advisory locks (GET_LOCK) on the thread's own connection: works between hosts sharing the database.
+    MySQL < 5.7 holds one named lock per connection, so the locks must not be nested there.
+    """
+
+    def __init__(self, using: str = 'default'):
+        self.using = using
+
+    def get_name(self, key: str) -> str:
+        name = '%s:%s' % (settings.DATABASES[self.using]['NAME'], key)
+        if len(name) > 64:
+            name = md5(name.encode())
+        return name
+
+    def acquire(self, key: str, timeout: float):
+        name = self.get_name(key)
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('SELECT GET_LOCK(%s, %s)', [name, int(timeout)])
+            if cursor.fetchone()[0] != 1:
+                raise LockTimeout(key)
+        return name
+
+    def release(self, handle):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', [handle])
+
+
+class LockStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.acquired = 0
+            self.timeouts = 0
+            self.waited = 0.0
+            self.max_waited = 0.0
+
+    def add(self, waited: float, acquired=True):
+        with self.lock:
+            if acquired:
+                self.acquired += 1
+            else:
+                self.timeouts += 1
+            self.waited += waited
+            self.max_waited = max(self.max_waited, waited)
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            total = self.acquired + self.timeouts
+            return dict(
+                acquired=self.acquired,
+                timeouts=self.timeouts,
+                avg_waited=self.waited / total if total else 0,
+                max_waited=self.max_waited,
+            )
+
+
+class LockManager(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.stats = LockStats()
+
+    @contextmanager
+    def lock(self, key: str, timeout=10):
+        started_at = time_module.monotonic()
+        try:
+            handle = self.backend.acquire(key, timeout)
+        except LockTimeout:
+            self.stats.add(time_module.monotonic() - started_at, acquired=False)
+            raise
+        self.stats.add(time_module.monotonic() - started_at)
+        try:
+            yield
+        finally:
+            self.backend.release(handle)
+
+
+_lock_manager = None
+_lock_manager_lock = threading.Lock()
+
+
+def get_lock_manager() -> LockManager:
+    global _lock_manager
+    if _lock_manager is None:
+        with _lock_manager_lock:
+            if _lock_manager is None:
+                _lock_manager = LockManager(import_string(settings.LOCK_BACKEND)())
+    return _lock_manager
+
+
 def lock(key: str, timeout=10):
-    path = os.path.join(tempfile.gettempdir(), settings.BASE_DIR[1:])
-    os.makedirs(path, exist_ok=True)
-    return filelock.FileLock(os.path.join(path, key + '.lock'), timeout=timeout)
+    return get_lock_manager().lock(key, timeout)
 
 
 def unique(items: list or tuple):
@@ -209,6 +371,49 @@ class Memoized(object):
         return _memoized
 
 
+class TTLCache(object):
+    """
+    Thread safe LRU cache with time to live. get/set/delete are compatible with django cache backends.
+    """
+
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires_at = self.data[key]
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at < time_module.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.data[key] = (value, time_module.monotonic() + ttl if ttl else None)
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
 def execute_command(module: object, *args, **options):
     s = io.StringIO()
     call_command(module.__name__.split('.')[-1], stdout=s, *args, **options)
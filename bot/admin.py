@@ -1,10 +1,11 @@
 from bitfield import BitField
 from bitfield.forms import BitFieldCheckboxSelectMultiple
-from django.contrib import admin
+from django.contrib import admin, messages
 
 from base import utils as base_utils
-from base.admin import MyAdmin
-from bot.models import TgUser, TgMessage, TgChat
+from base.admin import MyAdmin, short_description
+from bot import timers
+from bot.models import TgUser, TgMessage, TgChat, OutgoingMessage, IncomingUpdate, TimeEntry, Timer
 
 
 @admin.register(TgChat)
@@ -46,3 +47,60 @@ class TgMessageAdmin(MyAdmin):
 
     def has_add_permission(self, request, obj=None):
         return False
+
+
+@admin.register(OutgoingMessage)
+class OutgoingMessageAdmin(MyAdmin):
+    list_display = ['id', 'chat_id', 'method', 'status', 'attempts', 'error', 'not_before', 'created_at', 'sent_at']
+    list_filter = ['status', 'method']
+    search_fields = ['chat_id']
+    readonly_fields = base_utils.get_field_names(OutgoingMessage, [])
+    ordering = ['-id']
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(IncomingUpdate)
+class IncomingUpdateAdmin(MyAdmin):
+    list_display = ['id', 'update_id', 'tg_id', 'status', 'error', 'created_at', 'processed_at']
+    list_filter = ['status']
+    search_fields = ['tg_id', 'update_id']
+    readonly_fields = base_utils.get_field_names(IncomingUpdate, [])
+    ordering = ['-id']
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(TimeEntry)
+class TimeEntryAdmin(MyAdmin):
+    list_display = ['id', 'tguser', 'board_id', 'card_id', 'date', 'seconds', 'stopped_at']
+    search_fields = ['tguser__tg_id', 'board_id', 'list_id', 'card_id']
+    readonly_fields = base_utils.get_field_names(TimeEntry, [])
+    ordering = ['-id']
+    date_hierarchy = 'date'
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(Timer)
+class TimerAdmin(MyAdmin):
+    list_display = ['id', 'tguser', 'board_id', 'card_id', 'created_at']
+    search_fields = ['tguser__tg_id', 'board_id', 'list_id', 'card_id']
+    readonly_fields = base_utils.get_field_names(Timer, [])
+    ordering = ['-id']
+    actions = ['stop_timers']
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    @short_description('Stop selected timers')
+    def stop_timers(self, request, queryset):
+        stats = timers.stop_many(queryset)
+        self.message_user(
+            request,
+            'Stopped: %(stopped)d, kept running without a Trello comment: %(kept)d (%(kept_ids)s)' % stats,
+            level=messages.WARNING if stats['kept'] else messages.INFO,
+        )
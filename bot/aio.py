@@ -0,0 +1,175 @@
+"""
+asyncio runtime: one process keeps many IncomingUpdate in flight.
+Sync handlers and ORM run in a bounded thread executor, handlers may also be coroutine functions,
+their coroutines are awaited on the runtime loop. Updates of one user are processed in order.
+Async HTTP clients need aiohttp, which is optional.
+"""
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from telebot import apihelper
+
+from bot.models import IncomingUpdate
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+_runtime = None
+
+
+def resolve(result):
+    """
+    Result of a handler: a coroutine is awaited on the running runtime loop, or on a new loop without runtime.
+    Called from executor threads, never from the loop itself.
+    """
+    if not asyncio.iscoroutine(result):
+        return result
+    if _runtime is not None and _runtime.loop.is_running():
+        return asyncio.run_coroutine_threadsafe(result, _runtime.loop).result()
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(result)
+    finally:
+        loop.close()
+
+
+class AsyncRuntime(object):
+    def __init__(self, executor_workers: int = None, max_in_flight: int = None, batch_size: int = 100, poll_interval: float = 0.2):
+        self.max_in_flight = max_in_flight or settings.ASYNC_MAX_IN_FLIGHT
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers or settings.ASYNC_EXECUTOR_WORKERS)
+        self.loop.set_default_executor(self.executor)
+        self.in_flight = set()  # IncomingUpdate ids
+        self.user_tails = {}  # tg_id -> the last scheduled task of the user
+        self.semaphore = None
+        self.session = None
+        self.stopping = False
+        self.thread = None
+
+    def run_sync(self, func, *args, **kwargs):
+        """
+        Awaitable result of a blocking call (ORM, sync handlers, trolly) from the bounded executor.
+        """
+        return self.loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    def claim(self) -> list:
+        return list(
+            IncomingUpdate.objects
+            .filter(status=IncomingUpdate.STATUS_PENDING)
+            .exclude(id__in=list(self.in_flight))
+            .order_by('id')[:self.batch_size]
+        )
+
+    async def process(self, previous, incoming: IncomingUpdate):
+        from bot.ingest import process_incoming
+        if previous is not None:
+            # its exception is already logged by process_incoming
+            await asyncio.wait([previous])
+        async with self.semaphore:
+            await self.run_sync(process_incoming, incoming)
+
+    def schedule(self, incoming: IncomingUpdate):
+        self.in_flight.add(incoming.id)
+        task = self.loop.create_task(self.process(self.user_tails.get(incoming.tg_id), incoming))
+        self.user_tails[incoming.tg_id] = task
+
+        def done(future):
+            self.in_flight.discard(incoming.id)
+            if self.user_tails.get(incoming.tg_id) is task:
+                del self.user_tails[incoming.tg_id]
+
+        task.add_done_callback(done)
+
+    async def consume(self):
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        while not self.stopping:
+            if len(self.in_flight) >= self.max_in_flight * 2:
+                # backpressure: scheduled updates wait for the semaphore anyway
+                await asyncio.sleep(0.05)
+                continue
+            claimed = await self.run_sync(self.claim)
+            for incoming in claimed:
+                self.schedule(incoming)
+            if not claimed:
+                await asyncio.sleep(self.poll_interval)
+        tasks = list(self.user_tails.values())
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def run(self):
+        global _runtime
+        _runtime = self
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.consume())
+            if self.session is not None:
+                self.loop.run_until_complete(self.session.close())
+        finally:
+            self.executor.shutdown()
+            self.loop.close()
+            _runtime = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='AsyncRuntime', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops claiming, in flight updates are finished.
+        """
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(setattr, self, 'stopping', True)
+        if self.thread:
+            self.thread.join()
+
+
+def get_session():
+    if aiohttp is None:
+        raise ImproperlyConfigured('aiohttp is required for async HTTP clients')
+    if _runtime is None:
+        raise ImproperlyConfigured('AsyncRuntime is not running')
+    if _runtime.session is None:
+        # created on the runtime loop: the clients are called from its coroutines only
+        _runtime.session = aiohttp.ClientSession()
+    return _runtime.session
+
+
+class AsyncApiError(Exception):
+    def __init__(self, method_name: str, status: int, description: str):
+        super().__init__('%s: %d %s' % (method_name, status, description))
+        self.status = status
+        self.description = description
+
+
+async def telegram(method_name: str, **params):
+    """
+    Telegram Bot API call for coroutine handlers, e.g. await aio.telegram('sendMessage', chat_id=..., text=...).
+    """
+    url = apihelper.API_URL.format(settings.TELEGRAM_BOT_TOKEN, method_name)
+    async with get_session().post(url, data=params) as response:
+        data = await response.json()
+    if not data.get('ok'):
+        raise AsyncApiError(method_name, response.status, data.get('description', ''))
+    return data['result']
+
+
+async def trello(user_auth_token: str, uri_path: str, **query_params):
+    """
+    Trello GET for coroutine handlers. Goes around trello_cache, use run_sync(tguser.client...) to share it.
+    """
+    params = dict(query_params, key=settings.TRELLO_API_KEY, token=user_auth_token)
+    async with get_session().get(settings.TRELLO_API_URL + uri_path, params=params) as response:
+        if response.status != 200:
+            raise AsyncApiError(uri_path, response.status, await response.text())
+        return await response.json()
@@ -0,0 +1,156 @@
+"""
+TgMessage audit log written outside of the update processing.
+Messages are buffered in a bounded queue and saved with bulk_create by a background thread.
+Batches are taken from the queue and written under one lock, so `flush` also waits for the batch being written.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError, IntegrityError
+
+from bot import serialization
+from bot.models import TgMessage
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLog(object):
+    def __init__(self, batch_size: int = None, flush_interval: float = None, max_size: int = None):
+        self.batch_size = batch_size or settings.AUDIT_LOG_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.AUDIT_LOG_FLUSH_INTERVAL
+        self.queue = queue.Queue(maxsize=max_size or settings.AUDIT_LOG_MAX_SIZE)
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.ready = threading.Event()  # set when something is put to the queue
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.stats = dict(written=0, overflow=0, failed=0)
+
+    @property
+    def is_sync(self) -> bool:
+        return settings.TESTING or not settings.AUDIT_LOG_ASYNC
+
+    def add(self, tgmessage: TgMessage, item=None):
+        """
+        `item` is a telebot object serialized to `tgmessage.message` right before writing.
+        """
+        if self.is_sync:
+            self.write([(tgmessage, item)])
+            return
+        self.start()
+        try:
+            self.queue.put_nowait((tgmessage, item))
+            self.ready.set()
+        except queue.Full:
+            # bounded memory: the writer is behind, so the update pays for its own INSERT
+            self.count('overflow')
+            self.write([(tgmessage, item)])
+
+    def count(self, key: str, value: int = 1):
+        with self.lock:
+            self.stats[key] += value
+
+    def start(self):
+        if self.thread and self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.thread and self.pid == os.getpid():
+                return
+            # a forked worker doesn't inherit the thread of its parent
+            self.pid = os.getpid()
+            # nor a lock its writer thread held at fork time
+            self.write_lock = threading.Lock()
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, name='AuditLogWriter', daemon=True)
+            self.thread.start()
+
+    def get_batch(self) -> list:
+        batch = []
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                if not self.ready.wait(self.flush_interval):
+                    continue
+                with self.write_lock:
+                    # messages put after clear() set it again
+                    self.ready.clear()
+                    batch = self.get_batch()
+                    if not batch:
+                        continue
+                    if not self.queue.empty():
+                        self.ready.set()
+                    try:
+                        self.write(batch)
+                    except Exception as e:
+                        self.count('failed', len(batch))
+                        logger.exception(e)
+        finally:
+            connection.close()
+
+    def write(self, batch: list):
+        tgmessages = []
+        for tgmessage, item in batch:
+            if item is not None:
+                tgmessage.message = serialization.dumps(item)
+            tgmessages.append(tgmessage)
+        try:
+            # savepoint: in the synchronous mode this runs inside the update transaction
+            with transaction.atomic():
+                TgMessage.objects.bulk_create(tgmessages)
+        except DatabaseError as e:
+            logger.warning('TgMessage bulk_create failed, saving one by one: %s', e)
+            for tgmessage in tgmessages:
+                self.save(tgmessage)
+        else:
+            self.count('written', len(tgmessages))
+
+    def save(self, tgmessage: TgMessage):
+        try:
+            try:
+                with transaction.atomic():
+                    tgmessage.save()
+            except IntegrityError:
+                # tguser or tgchat was deleted after the update was processed
+                tgmessage.tguser = tgmessage.tgchat = None
+                with transaction.atomic():
+                    tgmessage.save()
+        except DatabaseError as e:
+            self.count('failed')
+            logger.exception(e)
+        else:
+            self.count('written')
+
+    def flush(self):
+        """
+        Writes everything buffered in the calling thread, after the batch the writer thread is writing, if any.
+        """
+        with self.write_lock:
+            while True:
+                batch = self.get_batch()
+                if not batch:
+                    break
+                self.write(batch)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread and self.pid == os.getpid():
+            self.thread.join()
+        self.thread = None
+        self.flush()
+
+
+audit_log = AuditLog()
+atexit.register(audit_log.stop)
@@ -0,0 +1,78 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.utils import timezone
+
+from base import utils as base_utils
+from bot import keyboards
+from bot.models import Broadcast, TgUser
+from bot.outbox import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastEngine(object):
+    """
+    Sends broadcast text to all active users.
+    Users are streamed in id ordered batches, every batch is sent by a bounded pool of threads under the global Telegram
+    rate limit and then the progress is saved to Broadcast, so a crashed run can be resumed from the last batch.
+    """
+
+    def __init__(self, broadcast: Broadcast, workers=16, batch_size=500, rate=None, dry_run=False, stdout=None, verbosity=1):
+        self.broadcast = broadcast
+        self.workers = workers
+        self.batch_size = batch_size
+        self.bucket = TokenBucket(rate or settings.TELEGRAM_GLOBAL_RATE_LIMIT)
+        self.dry_run = dry_run
+        self.stdout = stdout
+        self.verbosity = verbosity
+        self.elapsed = 0.0
+        self.processed_before = broadcast.processed
+
+    def write(self, text: str):
+        if self.stdout and self.verbosity:
+            self.stdout.write(text)
+
+    def send(self, tguser: TgUser) -> str:
+        self.bucket.wait()
+        try:
+            result = tguser.send_message(self.broadcast.text, keyboard=keyboards.Start, queued=False)
+        except Exception as e:
+            logger.exception(e)
+            return 'failed'
+        if result:
+            return 'sent'
+        if not tguser.active:
+            return 'deactivated'
+        return 'failed'
+
+    def checkpoint(self):
+        if not self.dry_run:
+            self.broadcast.save()
+
+    @property
+    def throughput(self) -> float:
+        processed = self.broadcast.processed - self.processed_before
+        return processed / self.elapsed if self.elapsed else 0.0
+
+    def run(self) -> Broadcast:
+        broadcast = self.broadcast
+        started = time.monotonic()
+        tgusers_qs = TgUser.objects.filter(active=True)
+        with ThreadPoolExecutor(self.workers) as executor:
+            for tgusers in base_utils.batch_qs_by_id(tgusers_qs, self.batch_size, broadcast.last_tguser_id):
+                for tguser, result in zip(tgusers, executor.map(self.send, tgusers)):
+                    setattr(broadcast, result, getattr(broadcast, result) + 1)
+                    if self.verbosity >= 2:
+                        self.write('%s %s' % (tguser, result))
+                broadcast.processed += len(tgusers)
+                broadcast.last_tguser_id = tgusers[-1].id
+                self.checkpoint()
+                self.elapsed = time.monotonic() - started
+                self.write('%s, %.1f msg/s' % (broadcast, self.throughput))
+        broadcast.finished_at = timezone.now()
+        self.checkpoint()
+        self.elapsed = time.monotonic() - started
+        return broadcast
@@ -31,3 +31,5 @@ START = '▶️'
 STOP = '⏹'
 RESET = '🔄'
 TIMER = '⏱'
+PAGE_PREVIOUS = '⬅️'
+PAGE_NEXT = '➡️'
@@ -2,9 +2,9 @@ from django.utils.translation import ugettext_lazy as _
 import logging
 import re
 from collections import OrderedDict
+from contextlib import contextmanager
 from importlib import import_module
 
-import six
 from django.db import transaction
 from django.utils import timezone
 from django.utils.datetime_safe import datetime
@@ -12,8 +12,9 @@ from telebot import TeleBot
 from telebot import util as telebot_util
 from telebot.types import Message, JsonDeserializable, CallbackQuery, ReplyKeyboardRemove
 
-from bot import utils as bot_utils
-from bot.models import TgUser, TgMessage
+from bot import utils as bot_utils, serialization, aio, identity
+from bot.audit import audit_log
+from bot.models import TgUser, TgMessage, tguser_cache, tgchat_cache
 from django.conf import settings
 from base import utils as base_utils
 
@@ -24,14 +25,7 @@ logger = logging.getLogger(__name__)
 
 @base_utils.monkeypatch_method(JsonDeserializable)
 def __str__(self):
-    d = {}
-    for x, y in six.iteritems(self.__dict__):
-        if hasattr(y, '__dict__'):
-            d[x] = y.__dict__
-        elif y is not None:
-            d[x] = y
-
-    return six.text_type(d)
+    return serialization.dumps(self)
 
 
 @base_utils.monkeypatch_method(TeleBot)
@@ -50,7 +44,8 @@ def exec_task(function, tguser: TgUser):
     fnc = function.__qualname__
     if check_result is True:
         try:
-            res = function(tguser)
+            # coroutine handlers are awaited on the async runtime loop
+            res = aio.resolve(function(tguser))
             if res is False:
                 result = 'fail'
             else:
@@ -71,7 +66,7 @@ def message_task(function, tgmessage: TgMessage, message: Message, tguser: TgUse
     if not tguser.id:
         # was deleted
         return
-    tgmessage.save()
+    audit_log.add(tgmessage, message)
     tguser.save_dirty_fields()
 
 
@@ -85,7 +80,6 @@ def _before_exec_message_task(self, msg_handler, message: Message, tguser: TgUse
         message_id=message.message_id,
         chat_type=message.chat.type,
         text=message.text or message.caption or 'content_type:%s' % message.content_type,
-        message=base_utils.to_json(message),
         date=timezone.make_aware(datetime.fromtimestamp(message.date)),
     )
     self._exec_task(message_task, msg_handler['function'], tgmessage, message, tguser)
@@ -95,7 +89,7 @@ def callback_query_task(function: callable, tgmessage: TgMessage, callback_query
     logger.debug('callback: %s' % function.__qualname__)
     tgmessage.fnc, tgmessage.result = exec_task(function, tguser)
     tgmessage.requests_made = tguser.requests_made
-    tgmessage.save()
+    audit_log.add(tgmessage, callback_query)
     tguser.answer_callback_query()
     tguser.save_dirty_fields()
 
@@ -109,17 +103,111 @@ def _before_exec_callback_query_task(self, msg_handler, callback_query: Callback
         message_id=callback_query.message and callback_query.message.message_id,
         chat_type='callback_query',
         text=callback_query.data,
-        message=base_utils.to_json(callback_query),
         date=timezone.now(),
     )
     self._exec_task(callback_query_task, msg_handler['function'], tgmessage, callback_query, tguser)
 
 
+class PrefixTrie(object):
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix: str, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(value)
+
+    def iter_prefixes(self, text: str):
+        """
+        Values of all prefixes of `text`.
+        """
+        node = self.root
+        yield from node.get(None, ())
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                return
+            yield from node.get(None, ())
+
+
+class HandlerIndex(object):
+    """
+    Positions of handlers bucketed by the filter that must match: command, exact data, data prefix or content type.
+    Only candidates from the matching buckets are tested, in the order of registration.
+    """
+
+    def __init__(self, handlers: list):
+        self.size = len(handlers)
+        self.commands = {}
+        self.data = {}
+        self.data_startswith = PrefixTrie()
+        self.content_types = {}
+        self.other = []
+        for position, handler in enumerate(handlers):
+            filters = handler['filters']
+            if filters.get('commands') is not None:
+                for command in filters['commands']:
+                    self.commands.setdefault(command.lower(), []).append(position)
+            elif filters.get('data') is not None:
+                self.data.setdefault(filters['data'], []).append(position)
+            elif filters.get('data_startswith') is not None:
+                self.data_startswith.add(filters['data_startswith'], position)
+            elif filters.get('content_types') is not None:
+                for content_type in filters['content_types']:
+                    self.content_types.setdefault(content_type, []).append(position)
+            else:
+                self.other.append(position)
+
+    def get_candidates(self, item) -> list:
+        positions = list(self.other)
+        content_type = getattr(item, 'content_type', None)
+        if content_type:
+            positions += self.content_types.get(content_type, ())
+            if content_type == 'text':
+                command = telebot_util.extract_command(item.text)
+                if command:
+                    positions += self.commands.get(str(command).lower(), ())
+        data = getattr(item, 'data', None)
+        if data:
+            positions += self.data.get(data, ())
+            positions += self.data_startswith.iter_prefixes(data)
+        return sorted(set(positions))
+
+
+@base_utils.monkeypatch_method(TeleBot)
+def _get_handler_index(self, handlers: list) -> HandlerIndex:
+    indexes = self.__dict__.setdefault('_handler_indexes', {})
+    index = indexes.get(id(handlers))
+    if index is None or index.size != len(handlers):
+        # handlers are registered at import time, so the index is built once per list
+        index = indexes[id(handlers)] = HandlerIndex(handlers)
+    return index
+
+
+@contextmanager
+def identity_rollback(item):
+    """
+    Saves of a failed update are rolled back, but already went to the identity cache.
+    Wraps the update transaction, so versions changed in it are bumped again once it is committed.
+    """
+    try:
+        yield
+    except Exception:
+        tguser_cache.invalidate(item.from_user.id)
+        if isinstance(item, Message) and item.chat.id != item.from_user.id:
+            tgchat_cache.invalidate(item.chat.id)
+        raise
+    finally:
+        identity.flush_pending()
+
+
 @base_utils.monkeypatch_method(TeleBot)
 def _notify_command_handlers(self, handlers, items):
+    index = self._get_handler_index(handlers)
     for item in items:
         with base_utils.lock('tguser_%d' % item.from_user.id):
-            with transaction.atomic():
+            with identity_rollback(item), transaction.atomic():
                 tguser = TgUser.load(item.from_user, item)
                 assert isinstance(tguser, TgUser)
                 if settings.UNDER_CONSTRUCTION and not tguser.is_admin():
@@ -130,8 +218,11 @@ def _notify_command_handlers(self, handlers, items):
                     tries += 1
                     try:
                         next_raised = False
-                        for handler in handlers:
-                            if self._test_message_handler(handler, item, tguser):
+                        # predicate results of this update, a handler that raised NextHandler may have changed the state
+                        memo = {}
+                        for position in index.get_candidates(item):
+                            handler = handlers[position]
+                            if self._test_message_handler(handler, item, tguser, memo):
                                 try:
                                     if isinstance(item, CallbackQuery):
                                         self._before_exec_callback_query_task(handler, item, tguser)
@@ -140,13 +231,14 @@ def _notify_command_handlers(self, handlers, items):
                                     next_raised = False
                                 except bot_utils.NextHandler:
                                     next_raised = True
+                                    memo.clear()
                                     continue
                                 break
                         else:
                             if settings.DEBUG:
                                 logger.debug('Unhandled update: %s', item)
                         if next_raised:
-                            logger.warning('NextHandler raised but was not proceed! TgUser: %s, message: %s', tguser, base_utils.to_json(item, indent=None))
+                            logger.warning('NextHandler raised but was not proceed! TgUser: %s, message: %s', tguser, serialization.dumps(item))
                     except bot_utils.RestartHandler:
                         if tries >= 10:
                             raise
@@ -165,19 +257,31 @@ def filter_commands(msg, tgu, filter_value):
     return command in map(str.lower, filter_value)
 
 
+def call_memoized(func, tgu, memo: dict or None):
+    if memo is None:
+        return func(tgu)
+    try:
+        return memo[func]
+    except KeyError:
+        result = memo[func] = func(tgu)
+        return result
+
+
 test_cases = OrderedDict((
-    ('content_types', lambda msg, tgu, filter_value: msg.content_type in filter_value),
-    ('commands', filter_commands),
-    ('func', lambda msg, tgu, filter_value: filter_value(tgu)),
-    ('all', lambda msg, tgu, filter_value: all([func(tgu) for func in filter_value])),
-    ('data', lambda msg, tgu, filter_value: msg.data and msg.data == filter_value),
-    ('data_startswith', lambda msg, tgu, filter_value: msg.data and msg.data.startswith(filter_value)),
-    ('regexp', lambda msg, tgu, filter_value: msg.content_type == 'text' and msg.text and re.search(filter_value, msg.text)),
+    ('content_types', lambda msg, tgu, filter_value, memo: msg.content_type in filter_value),
+    ('commands', lambda msg, tgu, filter_value, memo: filter_commands(msg, tgu, filter_value)),
+    ('func', lambda msg, tgu, filter_value, memo: call_memoized(filter_value, tgu, memo)),
+    ('all', lambda msg, tgu, filter_value, memo: all(call_memoized(func, tgu, memo) for func in filter_value)),
+    ('data', lambda msg, tgu, filter_value, memo: msg.data and msg.data == filter_value),
+    ('data_startswith', lambda msg, tgu, filter_value, memo: msg.data and msg.data.startswith(filter_value)),
+    ('regexp', lambda msg, tgu, filter_value, memo: msg.content_type == 'text' and msg.text and filter_value.search(msg.text)),
 ))
 
 
 @base_utils.monkeypatch_method(TeleBot)
 def _build_handler_dict(self, handler, *simple_funcs, **filters):
+    if isinstance(filters.get('regexp'), str):
+        filters['regexp'] = re.compile(filters['regexp'])
     return {
         'function': handler,
         'simple_funcs': simple_funcs,
@@ -209,9 +313,9 @@ def message_handler(self, *simple_funcs, content_types=None, commands=None, func
 
 
 @base_utils.monkeypatch_method(TeleBot)
-def _test_message_handler(self, msg_handler, message, tguser):
+def _test_message_handler(self, msg_handler, message, tguser, memo=None):
     for func in msg_handler['simple_funcs']:
-        if not func(tguser):
+        if not call_memoized(func, tguser, memo):
             return False
     for filter_name, filter_func in test_cases.items():
         if filter_name not in msg_handler['filters']:
@@ -219,7 +323,7 @@ def _test_message_handler(self, msg_handler, message, tguser):
         filter_value = msg_handler['filters'][filter_name]
         if filter_value is None:
             continue
-        if not filter_func(message, tguser, filter_value):
+        if not filter_func(message, tguser, filter_value, memo):
             return False
     return True
 
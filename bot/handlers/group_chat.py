@@ -4,6 +4,7 @@ from django.db.models import Q
 from telebot.types import Message, User
 
 from bot import utils as bot_utils
+from bot.audit import audit_log
 from bot.handlers import tgbot
 from bot.models import TgUser, MessageLink, TgMessage
 
@@ -29,15 +30,15 @@ class GroupHandler(bot_utils.BaseHandler):
         if feedback_message_link:
             kwargs['reply_to_message_id'] = feedback_message_link.original_message_id
         if message.text:
-            result = recipient_tguser.send_message(message.text, **kwargs)
+            result = recipient_tguser.send_message(message.text, queued=False, **kwargs)
         elif message.photo:
-            result = recipient_tguser.send_photo(message.photo[-1].file_id, **kwargs)
+            result = recipient_tguser.send_photo(message.photo[-1].file_id, queued=False, **kwargs)
         elif message.voice:
-            result = recipient_tguser.send_voice(message.voice.file_id, **kwargs)
+            result = recipient_tguser.send_voice(message.voice.file_id, queued=False, **kwargs)
         elif message.document:
-            result = recipient_tguser.send_document(message.document.file_id, **kwargs)
+            result = recipient_tguser.send_document(message.document.file_id, queued=False, **kwargs)
         elif message.sticker:
-            result = recipient_tguser.send_sticker(message.sticker.file_id, **kwargs)
+            result = recipient_tguser.send_sticker(message.sticker.file_id, queued=False, **kwargs)
         else:
             tgchat.send_message('Неподдерживаемый тип сообщения')
             raise bot_utils.BaseErrorHandler('not_implemented')
@@ -77,10 +78,13 @@ class GroupHandler(bot_utils.BaseHandler):
             tgchat.send_message('Пользователь не найден')
             raise bot_utils.ParamsErrorHandler('user_not_found')
         assert isinstance(recipient_tguser, TgUser)
-        result = recipient_tguser.send_message(text)
+        result = recipient_tguser.send_message(text, queued=False)
         if result:
             tgchat.send_message('Сообщение отправлено')
         else:
+            # the last messages may still be buffered by the audit log: this process writes its buffer now,
+            # other processes write theirs within AUDIT_LOG_FLUSH_INTERVAL
+            audit_log.flush()
             last_message = TgMessage.objects.filter(from_tg_id=recipient_tguser.tg_id, chat_type='private').last()
             if last_message:
                 assert isinstance(last_message, TgMessage)
@@ -10,18 +10,20 @@ from bot.models import TgUser, TgChat, MessageLink
 from django.conf import settings
 
 
-def define_handlers_before_unknown_text(path):
-    module = import_module(path)
+def define_handlers_before_unknown_text(paths):
     unknown_texts = []
     text_regexps = []
-    for name in dir(module):
-        kls = 'Handler' in name and getattr(module, name)
-        if not kls or not issubclass(kls, bot_utils.BaseHandler):
-            continue
-        if not kls.is_abstract():
-            unknown_texts.append(getattr(kls, bot_utils.BaseHandler.unknown_texts.__name__))
-            text_regexps.append(getattr(kls, bot_utils.BaseHandler.text_regexps.__name__))
-    for fnc in unknown_texts + text_regexps:
+    for path in paths:
+        module = import_module(path)
+        for name in dir(module):
+            kls = 'Handler' in name and getattr(module, name)
+            if not kls or not issubclass(kls, bot_utils.BaseHandler):
+                continue
+            if not kls.is_abstract():
+                unknown_texts.append(getattr(kls, bot_utils.BaseHandler.unknown_texts.__name__))
+                text_regexps.append(getattr(kls, bot_utils.BaseHandler.text_regexps.__name__))
+    # typed buttons of all modules first: unknown_texts handlers may take any text (e.g. PrivateHandler.search)
+    for fnc in text_regexps + unknown_texts:
         fnc()
 
 
@@ -42,14 +44,15 @@ class OtherHandler(bot_utils.BaseHandler):
             tguser.after_unknown_text(tguser)
 
     @staticmethod
+    # not in text_regexps: this module is not imported yet when define_handlers_before_unknown_text looks into it
+    @tgbot.message_handler(TgUser.is_private, regexp=keyboards.Cancel.text_to_regexp())
     @tgbot.message_handler(TgUser.is_private, regexp=keyboards.Cancel.emoji_to_regexp())
     @tgbot.message_handler(TgUser.is_private, commands=keyboards.Cancel.commands())
     def cancel(tguser: TgUser):
         tguser.reset()
         tguser.render_to_string('bot/private/canceled.html', keyboard=keyboards.Start)
 
-    for path in settings.BOT_HANDLERS_MODULES:
-        define_handlers_before_unknown_text(path)
+    define_handlers_before_unknown_text(settings.BOT_HANDLERS_MODULES)
 
     @staticmethod
     @tgbot.message_handler(TgUser.is_private, content_types=['text', 'photo', 'sticker', 'voice'])
@@ -71,12 +74,8 @@ class OtherHandler(bot_utils.BaseHandler):
         if hasattr(tguser, "current_call") and tguser.current_call:
             additional = ' во время <a href="%s">рабочего дня</a> (%s)%s' % (tguser.current_call.get_url(), tguser.current_call.get_state(), additional)
         tgchat.send_message('%s прислал%s:' % (tguser.admin_name_advanced, additional))
-        sent_message = tgchat.forward_message(message.chat.id, message.message_id)
+        sent_message = tgchat.forward_message(message.chat.id, message.message_id, queued=False)
         if isinstance(reply_to_message, Message):
             tgchat.send_message('в ответ на:')
             tgchat.forward_message(reply_to_message.chat.id, reply_to_message.message_id)
         MessageLink.create(message, sent_message)
-
-    @classmethod
-    def text_regexps(cls):
-        tgbot.message_handler(TgUser.is_private, regexp=keyboards.Cancel.text_to_regexp())(cls.cancel)
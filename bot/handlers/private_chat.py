@@ -1,14 +1,14 @@
 from datetime import timedelta
 
-import trolly
 from django.utils import timezone
-from telebot.types import Message
 
 from base import utils as base_utils
 from base.utils import mytime
-from bot import utils as bot_utils, keyboards
+from bot import utils as bot_utils, keyboards, mirror, timers
 from bot.handlers import tgbot
-from bot.models import TgUser, Token, Timer
+from bot.models import TgUser, Token, TimeRollup, TrelloBoard, TrelloList, TrelloCard
+from bot.pagination import paginator
+from bot.search import search_index
 from bot.utils import TrelloClient
 
 
@@ -45,140 +45,200 @@ class PrivateHandler(bot_utils.BaseHandler):
     @staticmethod
     @tgbot.message_handler(TgUser.is_private, TgUser.is_authorized, regexp=keyboards.Boards.emoji_to_regexp())
     @tgbot.message_handler(TgUser.is_private, TgUser.is_authorized, commands=keyboards.Boards.commands())
-    def boards(tguser: TgUser):
-        assert isinstance(tguser.client, TrelloClient)
-        boards = tguser.client.get_boards()
-        timer_board_ids = tguser.timer_set.values_list('board_id', flat=True)
-        tguser.render_to_string('bot/private/choose_board.html', keyboard=keyboards.Boards(tguser, boards, timer_board_ids), edit=True)
+    def boards(tguser: TgUser, page_number=0):
+        mirror.ensure_synced(tguser)
+        boards = tguser.trello_boards.filter(closed=False).order_by('name')
+        page = paginator.get_page(boards, 'boards:%d' % tguser.id, tguser.trello.boards_synced_at, page_number)
+        PrivateHandler.detach_timers(tguser)
+        timer_board_ids = set(tguser.timer_set.values_list('board_id', flat=True))
+        tguser.render_to_string('bot/private/choose_board.html', keyboard=keyboards.Boards(tguser, page, timer_board_ids), edit=True)
 
     @staticmethod
     @tgbot.callback_query_handler(TgUser.is_authorized, data_startswith='/board ')
-    def board(tguser: TgUser, board_id=None):
+    def board(tguser: TgUser, board_id=None, page_number=0):
         if board_id is None:
             board_id = tguser.callback_query_data_get(1)
-        assert isinstance(tguser.client, TrelloClient)
-        board = tguser.client.get_board(board_id)
-        assert isinstance(board, trolly.Board)
-        lists = board.get_lists()
-        timer_list_ids = tguser.timer_set.values_list('list_id', flat=True)
-        tguser.render_to_string('bot/private/choose_list.html', keyboard=keyboards.Lists(tguser, lists, timer_list_ids), edit=True)
+        board = PrivateHandler.get_board(tguser, board_id)
+        lists = board.lists.filter(closed=False)
+        page = paginator.get_page(lists, 'lists:%s' % board.id, board.synced_at, page_number)
+        PrivateHandler.detach_timers(tguser)
+        timer_list_ids = set(tguser.timer_set.values_list('list_id', flat=True))
+        tguser.render_to_string('bot/private/choose_list.html', keyboard=keyboards.Lists(tguser, board.id, page, timer_list_ids), edit=True)
 
     @staticmethod
     @tgbot.callback_query_handler(TgUser.is_authorized, data_startswith='/board_list ')
-    def board_list(tguser: TgUser, list_id=None):
+    def board_list(tguser: TgUser, list_id=None, page_number=0):
         if list_id is None:
             list_id = tguser.callback_query_data_get(1)
-        assert isinstance(tguser.client, TrelloClient)
-        board_list = tguser.client.get_list(list_id)
-        assert isinstance(board_list, trolly.List)
-        cards = board_list.get_cards()
-        timer_card_ids = tguser.timer_set.values_list('card_id', flat=True)
-        tguser.render_to_string('bot/private/choose_card.html', keyboard=keyboards.Cards(tguser, list_id, cards, timer_card_ids), edit=True)
+        board_list = PrivateHandler.get_board_list(tguser, list_id)
+        cards = board_list.cards.filter(closed=False)
+        page = paginator.get_page(cards, 'cards:%s' % board_list.id, board_list.board.synced_at, page_number)
+        PrivateHandler.detach_timers(tguser)
+        timer_card_ids = set(tguser.timer_set.values_list('card_id', flat=True))
+        keyboard = keyboards.Cards(tguser, list_id, page, timer_card_ids, board_id=board_list.board_id)
+        tguser.render_to_string('bot/private/choose_card.html', keyboard=keyboard, edit=True)
+
+    @staticmethod
+    @tgbot.callback_query_handler(TgUser.is_authorized, data_startswith='/page ')
+    def page(tguser: TgUser):
+        """
+        Page buttons of Boards, Lists and Cards: /page boards <number>, /page lists|cards <parent id> <number>.
+        """
+        kind = tguser.callback_query_data_get(1)
+        if kind == 'boards':
+            return PrivateHandler.boards(tguser, tguser.callback_query_data_get(2, as_int=True) or 0)
+        parent_id = tguser.callback_query_data_get(2)
+        page_number = tguser.callback_query_data_get(3, as_int=True) or 0
+        if kind == 'lists':
+            return PrivateHandler.board(tguser, parent_id, page_number)
+        if kind == 'cards':
+            return PrivateHandler.board_list(tguser, parent_id, page_number)
+        raise bot_utils.StateErrorHandler('unknown_page')
 
     @staticmethod
     @tgbot.callback_query_handler(TgUser.is_authorized, data_startswith='/card ')
     def card(tguser: TgUser):
         card_id = tguser.callback_query_data_get(1)
-        assert isinstance(tguser.client, TrelloClient)
-        card = tguser.client.get_card(card_id)
-        assert isinstance(card, trolly.Card)
-        card_info = card.get_card_information()
-        timer = tguser.timer_set.filter(card_id=card_id).first()
-        message = tguser.render_to_string('bot/private/show_card.html', context=dict(card=card_info), keyboard=keyboards.Card(tguser, card_id, timer), edit=True)
+        card = PrivateHandler.get_card(tguser, card_id)
+        timer = timers.get(tguser, card_id)
+        keyboard = keyboards.Card(tguser, card_id, timer, list_id=card.list_id)
+        tguser.render_to_string('bot/private/show_card.html', context=dict(card=card.data), keyboard=keyboard, edit=True)
         if timer:
-            assert isinstance(message, Message)
-            timer.message_id = message.message_id
-            timer.save()
+            # the card is shown by editing the message with the pressed button
+            timers.attach(tguser, timer, tguser.callback_query.message.message_id)
+        else:
+            PrivateHandler.detach_timers(tguser)
+
+    @staticmethod
+    def detach_timers(tguser: TgUser):
+        """
+        The pressed button's message is edited into another menu: the timer ticker must stop editing it.
+        """
+        if tguser.callback_query:
+            timers.detach(tguser, tguser.callback_query.message.message_id)
+
+    @staticmethod
+    def get_board(tguser: TgUser, board_id: str) -> TrelloBoard:
+        board = tguser.trello_boards.filter(id=board_id).first()
+        if not board:
+            tguser.answer_callback_query('The board is not available', show_alert=True)
+            raise bot_utils.StateErrorHandler('board_not_found')
+        return board
+
+    @staticmethod
+    def get_board_list(tguser: TgUser, list_id: str) -> TrelloList:
+        board_list = TrelloList.objects.filter(id=list_id, board__tgusers=tguser).select_related('board').first()
+        if not board_list:
+            tguser.answer_callback_query('The list is not available', show_alert=True)
+            raise bot_utils.StateErrorHandler('list_not_found')
+        return board_list
+
+    @staticmethod
+    def get_card(tguser: TgUser, card_id: str) -> TrelloCard:
+        card = TrelloCard.objects.filter(id=card_id, board__tgusers=tguser).first()
+        if not card:
+            tguser.answer_callback_query('The card is not available', show_alert=True)
+            raise bot_utils.StateErrorHandler('card_not_found')
+        return card
 
     @staticmethod
     @tgbot.callback_query_handler(TgUser.is_authorized, data_startswith='/timer_start ')
     def timer_start(tguser: TgUser):
         card_id = tguser.callback_query_data_get(1)
-        assert isinstance(tguser.client, TrelloClient)
-        card = tguser.client.get_card(card_id)
-        assert isinstance(card, trolly.Card)
-        timer = tguser.timer_set.filter(card_id=card_id).first()
-        if timer:
+        card = PrivateHandler.get_card(tguser, card_id)
+        state, timer = timers.start(tguser, card, tguser.callback_query.message.message_id)
+        if state == timers.ALREADY_STARTED:
             tguser.answer_callback_query('Timer was already started', show_alert=True)
             raise bot_utils.StateErrorHandler('timer_already_started')
-        if tguser.timer_set.exists():
+        if state == timers.MULTIPLE:
             tguser.answer_callback_query('You cannot start more than one timer simultaneously', show_alert=True)
             raise bot_utils.StateErrorHandler('multiple_timers')
-        card_info = card.get_card_information()
-        timer = tguser.timer_set.create(
-            board_id=card_info['idBoard'],
-            list_id=card_info['idList'],
-            card_id=card_id,
-            message_id=tguser.callback_query.message.message_id,
-        )
-        tguser.edit_message_reply_markup(keyboard=keyboards.Card(tguser, card_id, timer))
+        tguser.edit_message_reply_markup(keyboard=keyboards.Card(tguser, card_id, timer, list_id=timer.list_id))
 
     @staticmethod
     @tgbot.callback_query_handler(TgUser.is_authorized, data_startswith='/timer ')
     def timer(tguser: TgUser):
         card_id = tguser.callback_query_data_get(1)
-        assert isinstance(tguser.client, TrelloClient)
-        card = tguser.client.get_card(card_id)
-        assert isinstance(card, trolly.Card)
-        timer = tguser.timer_set.filter(card_id=card_id).first()
+        timer = timers.get(tguser, card_id)
         if not timer:
             tguser.answer_callback_query('Timer was not started', show_alert=True)
             raise bot_utils.StateErrorHandler('timer_not_started')
-        tguser.edit_message_reply_markup(keyboard=keyboards.Card(tguser, card_id, timer))
+        tguser.edit_message_reply_markup(keyboard=keyboards.Card(tguser, card_id, timer, list_id=timer.list_id))
 
     @staticmethod
     @tgbot.callback_query_handler(TgUser.is_authorized, data_startswith='/timer_stop ')
     def timer_stop(tguser: TgUser):
         card_id = tguser.callback_query_data_get(1)
         assert isinstance(tguser.client, TrelloClient)
-        card = tguser.client.get_card(card_id)
-        assert isinstance(card, trolly.Card)
-        timer = tguser.timer_set.filter(card_id=card_id).first()
+        timer, dur = timers.stop(tguser, card_id, tguser.client)
         if not timer:
             tguser.answer_callback_query('Timer was not started', show_alert=True)
             raise bot_utils.StateErrorHandler('timer_not_started')
-        assert isinstance(timer, Timer)
-        dur = timezone.now() - timer.created_at
-        d = '%.2f' % (dur.seconds / 3600)
-        card.add_comments('plus! %s/%s' % (d, d))
-        timer.delete()
         logged = mytime(dur, True)
         tguser.answer_callback_query('Logged %s' % logged)
-        tguser.edit_message_reply_markup(keyboard=keyboards.Card(tguser, card_id, None))
+        tguser.edit_message_reply_markup(keyboard=keyboards.Card(tguser, card_id, None, list_id=timer.list_id))
 
     @staticmethod
     @tgbot.callback_query_handler(TgUser.is_authorized, data_startswith='/timer_reset ')
     def timer_reset(tguser: TgUser):
         card_id = tguser.callback_query_data_get(1)
-        assert isinstance(tguser.client, TrelloClient)
-        card = tguser.client.get_card(card_id)
-        assert isinstance(card, trolly.Card)
-        timer = tguser.timer_set.filter(card_id=card_id).first()
+        timer = timers.pop(tguser, card_id)
         if not timer:
             tguser.answer_callback_query('Timer was not started', show_alert=True)
             raise bot_utils.StateErrorHandler('timer_not_started')
-        timer.delete()
         tguser.answer_callback_query('Timer was reset!')
-        tguser.edit_message_reply_markup(keyboard=keyboards.Card(tguser, card_id, None))
+        tguser.edit_message_reply_markup(keyboard=keyboards.Card(tguser, card_id, None, list_id=timer.list_id))
+
+    @staticmethod
+    @tgbot.message_handler(TgUser.is_private, TgUser.is_authorized, commands=keyboards.Report.commands())
+    @tgbot.callback_query_handler(TgUser.is_authorized, data_startswith='/report ')
+    def report(tguser: TgUser):
+        period = tguser.callback_query_data_get(1) if tguser.callback_query else None
+        if period not in dict(TimeRollup.PERIODS):
+            period = TimeRollup.PERIOD_WEEK
+        rollups = TimeRollup.get_report(tguser, period)
+        PrivateHandler.detach_timers(tguser)
+        # boards the user has lost access to are still in the mirror or shown by id
+        board_names = dict(TrelloBoard.objects.filter(id__in=[rollup.board_id for rollup in rollups]).values_list('id', 'name'))
+        rows = [dict(name=board_names.get(rollup.board_id, rollup.board_id), spent=mytime(rollup.seconds)) for rollup in rollups]
+        total = mytime(sum(rollup.seconds for rollup in rollups))
+        tguser.render_to_string('bot/private/report.html', context=dict(period=period, rows=rows, total=total), keyboard=keyboards.Report(tguser, period), edit=True)
 
     @staticmethod
     @tgbot.callback_query_handler(TgUser.is_authorized, data_startswith='/back ')
     def back(tguser: TgUser):
         obj_type = tguser.callback_query_data_get(1)
         obj_id = tguser.callback_query_data_get(2)
-        assert isinstance(tguser.client, TrelloClient)
+        # parent id is absent in buttons created before it was added to callback data
+        parent_id = tguser.callback_query_data_get(3)
         if obj_type == 'card':
-            card = tguser.client.get_card(obj_id)
-            assert isinstance(card, trolly.Card)
-            card_info = card.get_card_information()
-            return PrivateHandler.board_list(tguser, card_info['idList'])
+            if not parent_id:
+                parent_id = PrivateHandler.get_card(tguser, obj_id).list_id
+            return PrivateHandler.board_list(tguser, parent_id)
         if obj_type == 'list':
-            board_list = tguser.client.get_list(obj_id)
-            assert isinstance(board_list, trolly.List)
-            board = board_list.get_board()
-            return PrivateHandler.board(tguser, board.id)
+            if not parent_id:
+                parent_id = PrivateHandler.get_board_list(tguser, obj_id).board_id
+            return PrivateHandler.board(tguser, parent_id)
         PrivateHandler.boards(tguser)
 
+    @staticmethod
+    def search(tguser: TgUser):
+        """
+        Free text is a card search query, texts without matches go on to OtherHandler.unknown_text.
+        """
+        query = tguser.message.text
+        mirror.ensure_synced(tguser)
+        matches = search_index.search(tguser, query)
+        if not matches:
+            raise bot_utils.NextHandler()
+        timer_card_ids = set(tguser.timer_set.values_list('card_id', flat=True))
+        keyboard = keyboards.SearchResults(tguser, matches, timer_card_ids)
+        tguser.render_to_string('bot/private/search.html', context=dict(query=query), keyboard=keyboard)
+
+    @classmethod
+    def unknown_texts(cls):
+        tgbot.message_handler(TgUser.is_private, TgUser.is_authorized, content_types=['text'])(cls.search)
+
     @staticmethod
     @tgbot.message_handler(TgUser.is_private, regexp=keyboards.Help.emoji_to_regexp())
     @tgbot.message_handler(TgUser.is_private, commands=keyboards.Help.commands() + ['sos'])
@@ -0,0 +1,204 @@
+"""
+Per process cache of TgUser/TgChat rows by tg_id, so loading a known user before the handler costs no queries.
+Entries hold field values as they are in the database, every load builds a new instance from them.
+Each tg_id has a version in the shared django cache (IDENTITY_CACHE_BACKEND), saves and deletes in any process bump it
+and make other processes reload the row. Without a shared backend (not set, local memory or dummy cache) the cache is
+off: other processes would never see the bumps.
+A change inside a transaction is bumped again after the commit (`flush_pending`), otherwise another process could
+cache the old row under the new version before the commit.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import router, connections
+from django.db.models.signals import post_save, post_delete
+from django.utils.functional import cached_property
+
+from base import utils as base_utils
+
+logger = logging.getLogger(__name__)
+
+_pending = threading.local()
+
+
+def get_pending() -> set:
+    """
+    (IdentityCache, tg_id) changed by the current thread in a transaction that isn't committed yet.
+    """
+    if not hasattr(_pending, 'items'):
+        _pending.items = set()
+    return _pending.items
+
+
+def flush_pending():
+    """
+    Bumps versions of rows changed in the transaction just committed (or rolled back).
+    """
+    items = get_pending()
+    while items:
+        cache, tg_id = items.pop()
+        cache.bump(tg_id)
+
+
+class IdentityCache(object):
+    def __init__(self, model, related=()):
+        """
+        `related`: names of reverse one-to-one relations cached together with the row (None if there is no related row).
+        """
+        self.model = model
+        self.related = related
+        self.fields = model._meta.concrete_fields
+        self.local = base_utils.TTLCache(settings.IDENTITY_CACHE_SIZE, settings.IDENTITY_CACHE_TTL)
+
+    @property
+    def shared(self):
+        return caches[settings.IDENTITY_CACHE_BACKEND]
+
+    @cached_property
+    def enabled(self) -> bool:
+        if not settings.IDENTITY_CACHE_BACKEND:
+            return False
+        if isinstance(self.shared, (LocMemCache, DummyCache)):
+            logger.warning('Identity cache of %s is off: IDENTITY_CACHE_BACKEND is not shared between processes', self.model.__name__)
+            return False
+        return True
+
+    def get_version_key(self, tg_id: int) -> str:
+        return 'identity:%s:%d' % (self.model._meta.db_table, tg_id)
+
+    def get_version(self, tg_id: int):
+        return self.shared.get(self.get_version_key(tg_id), 0)
+
+    def bump(self, tg_id: int) -> float:
+        version = time.time()
+        # outlives local entries, so a lost version can't make an older entry valid again
+        self.shared.set(self.get_version_key(tg_id), version, settings.IDENTITY_CACHE_TTL * 2)
+        return version
+
+    def changed(self, tg_id: int) -> float:
+        version = self.bump(tg_id)
+        if connections[router.db_for_write(self.model)].in_atomic_block:
+            get_pending().add((self, tg_id))
+        return version
+
+    @staticmethod
+    def get_values(instance, fields) -> list:
+        # prepared values: mutable python values (e.g. BitField handlers) must not be shared between instances
+        return [field.get_prep_value(getattr(instance, field.attname)) for field in fields]
+
+    def get_related_values(self, instance) -> dict or None:
+        related_values = {}
+        for name in self.related:
+            descriptor = getattr(self.model, name)
+            if not hasattr(instance, descriptor.cache_name):
+                # not loaded, caching it would cost a query per load
+                return None
+            related_obj = getattr(instance, descriptor.cache_name)
+            if related_obj is None:
+                related_values[name] = None
+            else:
+                related_values[name] = self.get_values(related_obj, related_obj._meta.concrete_fields)
+        return related_values
+
+    def build(self, values: list, related_values: dict):
+        db = router.db_for_read(self.model)
+        instance = self.model.from_db(db, [field.attname for field in self.fields], values)
+        for name, values in related_values.items():
+            descriptor = getattr(self.model, name)
+            related_obj = None
+            if values is not None:
+                related_model = descriptor.related.field.model
+                related_fields = related_model._meta.concrete_fields
+                related_obj = related_model.from_db(db, [field.attname for field in related_fields], values)
+                setattr(related_obj, descriptor.related.field.get_cache_name(), instance)
+            setattr(instance, descriptor.cache_name, related_obj)
+        return instance
+
+    def get(self, tg_id: int):
+        """
+        (instance, version): a new instance built from the cache or None, version is passed to `fill` on a miss.
+        """
+        if not self.enabled:
+            return None, None
+        if get_pending() and not connections[router.db_for_write(self.model)].in_atomic_block:
+            # committed outside of the handlers' identity_rollback
+            flush_pending()
+        version = self.get_version(tg_id)
+        entry = self.local.get(tg_id)
+        if entry is None or entry[0] != version:
+            return None, version
+        return self.build(entry[1], entry[2]), version
+
+    def fill(self, instance, version):
+        """
+        Caches an instance just loaded from the database. `version` must be taken before loading.
+        """
+        if not self.enabled:
+            return
+        related_values = self.get_related_values(instance)
+        if related_values is not None:
+            self.local.set(instance.tg_id, (version, self.get_values(instance, self.fields), related_values))
+
+    def saved(self, instance, update_fields=None):
+        """
+        Write-through after a save: a partial save replaces only `update_fields` of the cached values.
+        """
+        if not self.enabled:
+            return
+        entry = self.local.get(instance.tg_id)
+        version = self.changed(instance.tg_id)
+        if update_fields:
+            if entry is None:
+                return
+            values = list(entry[1])
+            for index, field in enumerate(self.fields):
+                if field.name in update_fields or field.attname in update_fields:
+                    values[index] = self.get_values(instance, [field])[0]
+            self.local.set(instance.tg_id, (version, values, entry[2]))
+        else:
+            related_values = self.get_related_values(instance)
+            if related_values is None:
+                related_values = entry[2] if entry else None
+            if related_values is None:
+                self.local.delete(instance.tg_id)
+            else:
+                self.local.set(instance.tg_id, (version, self.get_values(instance, self.fields), related_values))
+
+    def invalidate(self, tg_id: int):
+        if not self.enabled:
+            return
+        self.changed(tg_id)
+        self.local.delete(tg_id)
+
+    def connect(self):
+        """
+        Keeps the cache in line with saves and deletes of the model and of the related rows.
+        Queryset update() goes around signals, call `invalidate` after it.
+        """
+        uid = 'identity_%s' % self.model._meta.db_table
+        post_save.connect(self.on_save, sender=self.model, weak=False, dispatch_uid=uid)
+        post_delete.connect(self.on_delete, sender=self.model, weak=False, dispatch_uid=uid)
+        for name in self.related:
+            related_field = getattr(self.model, name).related.field
+            post_save.connect(self.on_related_change, sender=related_field.model, weak=False, dispatch_uid=uid)
+            post_delete.connect(self.on_related_change, sender=related_field.model, weak=False, dispatch_uid=uid)
+
+    def on_save(self, sender, instance, update_fields=None, raw=False, **kwargs):
+        if raw:
+            self.invalidate(instance.tg_id)
+        else:
+            self.saved(instance, update_fields)
+
+    def on_delete(self, sender, instance, **kwargs):
+        self.invalidate(instance.tg_id)
+
+    def on_related_change(self, sender, instance, **kwargs):
+        for name in self.related:
+            related_field = getattr(self.model, name).related.field
+            if isinstance(instance, related_field.model):
+                self.invalidate(getattr(instance, related_field.name).tg_id)
@@ -0,0 +1,274 @@
+"""
+Processing of IncomingUpdate queue by worker processes, the queue is filled by the webhook or by UpdateFetcher.
+Updates are sharded by user: worker `index` of `workers` takes users with abs(tg_id) % workers == index,
+so updates of one user are processed in order while different users are processed in parallel.
+Processed updates are kept for TELEGRAM_INGEST_RETENTION only: update_id is unique, and Telegram starts it again
+from a random value after a week without updates.
+"""
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.utils import timezone
+from requests import RequestException
+from telebot import apihelper
+from telebot.apihelper import ApiException
+
+from base import utils as base_utils
+from bot import serialization
+from bot.models import IncomingUpdate
+
+logger = logging.getLogger(__name__)
+
+
+def process_incoming(incoming: IncomingUpdate):
+    from bot.handlers import tgbot
+    try:
+        tgbot.process_new_updates([serialization.parse_update(incoming.body)])
+    except Exception as e:
+        base_utils.error_log_to_group_chat()
+        logger.exception(e)
+        incoming.status = IncomingUpdate.STATUS_FAILED
+        incoming.error = str(e)[:255]
+    else:
+        incoming.status = IncomingUpdate.STATUS_DONE
+    incoming.processed_at = timezone.now()
+    incoming.save(update_fields=['status', 'error', 'processed_at'])
+
+
+def prune_processed():
+    """
+    Deletes updates processed before the retention period, except the last stored one UpdateFetcher.get_offset needs.
+    """
+    last_id = IncomingUpdate.objects.order_by('-id').values_list('id', flat=True).first()
+    if last_id is None:
+        return
+    IncomingUpdate.objects.filter(
+        status__in=[IncomingUpdate.STATUS_DONE, IncomingUpdate.STATUS_FAILED],
+        processed_at__lt=timezone.now() - timedelta(seconds=settings.TELEGRAM_INGEST_RETENTION),
+    ).exclude(id=last_id).delete()
+
+
+class Pruner(object):
+    """
+    prune_processed at most once per `interval` seconds, called from the loops of the parent process.
+    """
+
+    def __init__(self, interval: float = 60 * 60):
+        self.interval = interval
+        self.pruned_at = 0
+
+    def __call__(self):
+        if time.time() - self.pruned_at < self.interval:
+            return
+        self.pruned_at = time.time()
+        try:
+            prune_processed()
+        finally:
+            connection.close()
+
+
+class UpdateWorker(object):
+    def __init__(self, index: int, workers: int, stop_event, batch_size: int = 100, poll_interval: float = 0.2):
+        self.index = index
+        self.workers = workers
+        self.stop_event = stop_event
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+    def claim(self) -> list:
+        return list(
+            IncomingUpdate.objects
+            .filter(status=IncomingUpdate.STATUS_PENDING)
+            .extra(where=['MOD(ABS(tg_id), %s) = %s'], params=[self.workers, self.index])
+            .order_by('id')[:self.batch_size]
+        )
+
+    def process(self, incoming: IncomingUpdate):
+        process_incoming(incoming)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            claimed = self.claim()
+            for incoming in claimed:
+                if self.stop_event.is_set():
+                    break
+                self.process(incoming)
+            if not claimed:
+                self.stop_event.wait(self.poll_interval)
+
+
+def worker_main(index: int, workers: int, stop_event, batch_size: int):
+    # the parent handles Ctrl+C and sets stop_event, the current update is finished
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        UpdateWorker(index, workers, stop_event, batch_size).run()
+    finally:
+        connection.close()
+
+
+def handle_stop_signals(stop_event):
+    def stop(signum, frame):
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+
+class WorkerPool(object):
+    """
+    UpdateWorker processes. Ctrl+C and SIGTERM set `stop_event`, workers finish the current update and exit.
+    """
+
+    def __init__(self, workers: int, batch_size: int = 100):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.stop_event = multiprocessing.Event()
+        self.processes = []
+        self.prune = Pruner()
+
+    def start_worker(self, index: int) -> multiprocessing.Process:
+        # children must not share the parent's database connection
+        connection.close()
+        process = multiprocessing.Process(
+            target=worker_main,
+            args=(index, self.workers, self.stop_event, self.batch_size),
+            name='UpdateWorker-%d' % index,
+        )
+        process.start()
+        return process
+
+    def start(self):
+        self.processes = [self.start_worker(index) for index in range(self.workers)]
+        handle_stop_signals(self.stop_event)
+
+    def check(self):
+        for index, process in enumerate(self.processes):
+            if not process.is_alive() and not self.stop_event.is_set():
+                # the shard would stall without its worker
+                logger.error('%s exited with code %s, restarting', process.name, process.exitcode)
+                self.processes[index] = self.start_worker(index)
+        self.prune()
+
+    def join(self):
+        self.stop_event.set()
+        for process in self.processes:
+            process.join()
+
+    def run(self):
+        self.start()
+        while not self.stop_event.wait(1):
+            self.check()
+        self.join()
+
+
+def run_workers(workers: int, batch_size: int = 100):
+    WorkerPool(workers, batch_size).run()
+
+
+class UpdateFetcher(object):
+    """
+    getUpdates long polling into IncomingUpdate.
+    Updates are confirmed to Telegram by the next getUpdates only after they are stored, and the offset is restored
+    from the last stored one, so a restart neither drops nor repeats updates.
+    Fetching pauses while workers are more than `max_pending` updates behind.
+    """
+
+    def __init__(self, stop_event, timeout: int = 25, limit: int = 100, max_pending: int = 1000):
+        self.stop_event = stop_event
+        self.timeout = timeout
+        self.limit = limit
+        self.max_pending = max_pending
+
+    @staticmethod
+    def get_offset() -> int or None:
+        """
+        After the update stored last, not after the largest update_id: Telegram starts update_id from a random value
+        after a week without updates, and an offset above the new ones would skip all of them.
+        """
+        last_update_id = IncomingUpdate.objects.order_by('-id').values_list('update_id', flat=True).first()
+        return last_update_id + 1 if last_update_id is not None else None
+
+    def wait_backlog(self):
+        while not self.stop_event.is_set():
+            if IncomingUpdate.objects.filter(status=IncomingUpdate.STATUS_PENDING).count() < self.max_pending:
+                return
+            self.stop_event.wait(0.5)
+
+    @staticmethod
+    def store(updates: list):
+        objs = [
+            IncomingUpdate(
+                update_id=data['update_id'],
+                tg_id=IncomingUpdate.get_tg_id(data),
+                body=json.dumps(data, ensure_ascii=False, separators=(',', ':')),
+            )
+            for data in updates
+        ]
+        try:
+            with transaction.atomic():
+                IncomingUpdate.objects.bulk_create(objs)
+        except IntegrityError:
+            # some of them were stored before a crash, older ones with the same ids are pruned by Pruner
+            for obj in objs:
+                if not IncomingUpdate.objects.filter(update_id=obj.update_id).exists():
+                    obj.save()
+
+    def run(self, on_idle=None):
+        from bot.handlers import tgbot
+        offset = self.get_offset()
+        while not self.stop_event.is_set():
+            if on_idle:
+                on_idle()
+            self.wait_backlog()
+            if self.stop_event.is_set():
+                break
+            try:
+                updates = apihelper.get_updates(tgbot.token, offset, self.limit, self.timeout)
+            except (ApiException, RequestException) as e:
+                logger.warning('getUpdates failed: %s', e)
+                self.stop_event.wait(3)
+                continue
+            if updates:
+                self.store(updates)
+                offset = updates[-1]['update_id'] + 1
+
+
+def run_polling(workers: int, batch_size: int = 100, timeout: int = 25, max_pending: int = 1000, use_async=False):
+    if use_async:
+        from bot.aio import AsyncRuntime
+        runtime = AsyncRuntime(batch_size=batch_size)
+        stop_event = threading.Event()
+        handle_stop_signals(stop_event)
+        runtime.start()
+        try:
+            UpdateFetcher(stop_event, timeout=timeout, max_pending=max_pending).run(on_idle=Pruner())
+        finally:
+            runtime.stop()
+        return
+    pool = WorkerPool(workers, batch_size)
+    pool.start()
+    fetcher = UpdateFetcher(pool.stop_event, timeout=timeout, max_pending=max_pending)
+    try:
+        fetcher.run(on_idle=pool.check)
+    finally:
+        pool.join()
+
+
+def run_async(batch_size: int = 100):
+    from bot.aio import AsyncRuntime
+    runtime = AsyncRuntime(batch_size=batch_size)
+    stop_event = threading.Event()
+    handle_stop_signals(stop_event)
+    runtime.start()
+    prune = Pruner()
+    while not stop_event.wait(1):
+        prune()
+    runtime.stop()
@@ -1,12 +1,17 @@
 import re
-from copy import deepcopy
 
+from django.conf import settings
 from django.utils import timezone
 from telebot import types
 
 from base import utils as base_utils
 from bot import models as bot_models, emoji
 
+# markup JSON of dynamic keyboards by Keyboard.get_cache_key()
+keyboard_cache = base_utils.TTLCache(settings.KEYBOARD_CACHE_SIZE, settings.KEYBOARD_CACHE_TTL)
+# '[R]' and then '#' with trailing whitespace are stripped from the end of card names, one after another
+CARD_NAME_SUFFIX_RES = (re.compile(r'\[R\]$'), re.compile(r'#\s*$'))
+
 
 class Keyboard(object):
     button_rows = [
@@ -16,6 +21,7 @@ class Keyboard(object):
         # [dict(text='title')],
     ]
     button = None
+    static = False  # markup doesn't depend on arguments, built once per class
     SEPARATOR = ' '  # NO-BREAK SPACE
 
     def __init__(self, tguser, *args, **kwargs):
@@ -66,8 +72,11 @@ class Keyboard(object):
     def get_cls_button(cls) -> dict:
         if not cls.button:
             return {}
-        button = deepcopy(cls.button)
-        if isinstance(button, (str, tuple, list)):
+        button = cls.button
+        if isinstance(button, dict):
+            # callers update the result, values are immutable
+            button = dict(button)
+        elif isinstance(button, (str, tuple, list)):
             button = {'text': button}
         return button
 
@@ -113,6 +122,34 @@ class Keyboard(object):
             reply_markup.row(*items)
         return reply_markup
 
+    def get_cache_key(self) -> str or None:
+        """
+        Key of the markup JSON in keyboard_cache, None - built on every render.
+        """
+        return None
+
+    def get_reply_markup_json(self) -> str:
+        cls = self.__class__
+        if cls.static:
+            if '_static_json' not in cls.__dict__:
+                cls._static_json = self.get_reply_markup().to_json()
+            return cls._static_json
+        key = self.get_cache_key()
+        if key is None:
+            return self.get_reply_markup().to_json()
+        markup_json = keyboard_cache.get(key)
+        if markup_json is None:
+            markup_json = self.get_reply_markup().to_json()
+            keyboard_cache.set(key, markup_json)
+        return markup_json
+
+    def get_entities_cache_key(self, entities, timer_ids: set, *extra) -> str:
+        """
+        Cache key of a keyboard with a button per entity: ids, names and timer state of entities.
+        """
+        items = tuple((entity.id, entity.name, entity.id in timer_ids) for entity in entities)
+        return '%s:%s' % (self.__class__.__name__, base_utils.md5(repr((items,) + extra).encode()))
+
     def collect(self):
         return []
 
@@ -148,6 +185,18 @@ class InlineKeyboard(Keyboard):
     def get_self_button(self) -> dict:
         return self.get_button(callback_data=base_utils.join(*self.args))
 
+    @staticmethod
+    def get_page_row(page, command: str) -> list:
+        """
+        Buttons of the previous and the next pages, `command` gets the page number appended.
+        """
+        row = []
+        if page.has_previous:
+            row.append(dict(text=(emoji.PAGE_PREVIOUS, str(page.number)), callback_data='%s %d' % (command, page.number - 1)))
+        if page.has_next:
+            row.append(dict(text=(emoji.PAGE_NEXT, str(page.number + 2)), callback_data='%s %d' % (command, page.number + 1)))
+        return row
+
 
 class ReplyKeyboard(Keyboard):
     resize_keyboard = True
@@ -167,42 +216,84 @@ class ReplyKeyboard(Keyboard):
 class Boards(InlineKeyboard):
     button = (emoji.BOARDS, 'Доски')
 
+    def get_cache_key(self):
+        page, timer_board_ids = self.args
+        return self.get_entities_cache_key(page, timer_board_ids, page.number, page.has_next)
+
     def get_button_rows(self):
         rows = []
-        boards, timer_board_ids = self.args
-        for board in boards:
+        page, timer_board_ids = self.args
+        for board in page:
             name = board.name
             if board.id in timer_board_ids:
                 name = (emoji.TIMER, name)
             rows.append([dict(text=name, callback_data='/board %s' % board.id)])
+        page_row = self.get_page_row(page, '/page boards')
+        if page_row:
+            rows.append(page_row)
         return rows
 
 
 class Lists(InlineKeyboard):
+    def get_cache_key(self):
+        board_id, page, timer_list_ids = self.args
+        return self.get_entities_cache_key(page, timer_list_ids, board_id, page.number, page.has_next)
+
     def get_button_rows(self):
         rows = []
-        lists, timer_list_ids = self.args
-        for board_list in lists:
+        board_id, page, timer_list_ids = self.args
+        for board_list in page:
             name = board_list.name
             if board_list.id in timer_list_ids:
                 name = (emoji.TIMER, name)
             rows.append([dict(text=name, callback_data='/board_list %s' % board_list.id)])
+        page_row = self.get_page_row(page, '/page lists %s' % board_id)
+        if page_row:
+            rows.append(page_row)
         rows.append([Back.get_button(callback_data='/back board')])
         return rows
 
 
 class Cards(InlineKeyboard):
+    def get_cache_key(self):
+        list_id, page, timer_card_ids = self.args
+        return self.get_entities_cache_key(page, timer_card_ids, list_id, self.kwargs.get('board_id'), page.number, page.has_next)
+
+    @staticmethod
+    def strip_name(name: str) -> str:
+        for suffix_re in CARD_NAME_SUFFIX_RES:
+            name = suffix_re.sub('', name)
+        return name
+
+    def get_button_rows(self):
+        rows = []
+        list_id, page, timer_card_ids = self.args
+        for card in page:
+            name = self.strip_name(card.name)
+            if card.id in timer_card_ids:
+                name = (emoji.TIMER, name)
+            rows.append([dict(text=name, callback_data='/card %s' % card.id)])
+        page_row = self.get_page_row(page, '/page cards %s' % list_id)
+        if page_row:
+            rows.append(page_row)
+        back = '/back list %s' % list_id
+        if self.kwargs.get('board_id'):
+            # lets /back go up without fetching the list first
+            back += ' %s' % self.kwargs['board_id']
+        rows.append([Back.get_button(callback_data=back)])
+        return rows
+
+
+class SearchResults(InlineKeyboard):
     def get_button_rows(self):
         rows = []
-        list_id, cards, timer_card_ids = self.args
-        for card in cards:
-            name = card.name
-            name = re.sub('\[R\]$', '', name)
-            name = re.sub('#\s*$', '', name)
+        matches, timer_card_ids = self.args
+        for match in matches:
+            card = match.card
+            name = '%s / %s' % (card.list_name, Cards.strip_name(card.name))
             if card.id in timer_card_ids:
                 name = (emoji.TIMER, name)
             rows.append([dict(text=name, callback_data='/card %s' % card.id)])
-        rows.append([Back.get_button(callback_data='/back list %s' % list_id)])
         return rows
 
 
@@ -219,25 +310,45 @@ class Card(InlineKeyboard):
             ])
         else:
             rows.append([dict(text=(emoji.START, 'Start'), callback_data='/timer_start %s' % card_id), ])
-        rows.append([Back.get_button(callback_data='/back card %s' % card_id)])
+        back = '/back card %s' % card_id
+        if self.kwargs.get('list_id'):
+            # lets /back go up without fetching the card first
+            back += ' %s' % self.kwargs['list_id']
+        rows.append([Back.get_button(callback_data=back)])
         return rows
 
 
+class Report(InlineKeyboard):
+    button = (emoji.TIMER, 'Report')
+    periods = (
+        ('day', 'Today'),
+        ('week', 'This week'),
+    )
+
+    def get_button_rows(self):
+        period, = self.args
+        return [[dict(text=title, callback_data='/report %s' % key) for key, title in self.periods if key != period]]
+
+
 class Start(ReplyKeyboard):
+    static = True
     button_rows = (
         (Boards.get_button(),),
     )
 
 
 class Cancel(ReplyKeyboard):
+    static = True
     button = (emoji.CANCEL, 'Отмена')
 
 
 class Help(ReplyKeyboard):
+    static = True
     button = (emoji.HELP, 'Помощь')
 
 
 class Next(ReplyKeyboard):
+    static = True
     button = (emoji.NEXT, 'Далее')
 
 
@@ -0,0 +1,54 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from base import utils as base_utils
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк блокировок пользователей (base_utils.lock) при параллельных апдейтах'
+
+    backends = (
+        ('file', base_utils.FileLockBackend),
+        ('striped', base_utils.StripedLockBackend),
+        ('mysql', base_utils.MySQLLockBackend),
+    )
+
+    def add_arguments(self, parser: CommandParser):
+        super().add_arguments(parser)
+        parser.add_argument('--threads', dest='threads', type=int, default=16)
+        parser.add_argument('--updates', dest='updates', type=int, default=5000)
+        parser.add_argument('--users', dest='users', type=int, default=100, help='Updates are spread over the users')
+        parser.add_argument('--hold', dest='hold', type=float, default=0.0, help='Seconds the lock is held per update')
+        parser.add_argument('--backends', dest='backends', nargs='+', default=[name for name, _ in self.backends])
+
+    def run(self, manager: base_utils.LockManager, options: dict) -> float:
+        random.seed(0)
+        user_ids = [random.randrange(options['users']) for _ in range(options['updates'])]
+
+        def update(user_id):
+            with manager.lock('bench_tguser_%d' % user_id):
+                if options['hold']:
+                    time.sleep(options['hold'])
+
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            list(executor.map(update, user_ids))
+        return time.monotonic() - started_at
+
+    def handle(self, *args, **options):
+        for name, backend_class in self.backends:
+            if name not in options['backends']:
+                continue
+            manager = base_utils.LockManager(backend_class())
+            elapsed = self.run(manager, options)
+            stats = manager.stats.as_dict()
+            self.stdout.write('%-8s %9.0f updates/s  wait avg %7.3f ms  max %7.3f ms  timeouts %d' % (
+                name,
+                options['updates'] / elapsed,
+                stats['avg_waited'] * 1000,
+                stats['max_waited'] * 1000,
+                stats['timeouts'],
+            ))
@@ -0,0 +1,78 @@
+import timeit
+
+from dirtyfields.dirtyfields import reset_state
+from django.core.management.base import BaseCommand, CommandParser
+from django.utils import timezone
+
+from bot.models import TgUser
+
+
+def legacy_getattribute(self, item):
+    """
+    DateTimeModel.__getattribute__ as it was before explicit dirty tracking.
+    """
+    if item == 'save_dirty_fields':
+        from dirtyfields import DirtyFieldsMixin
+        if isinstance(self, DirtyFieldsMixin) and self.is_dirty(check_relationship=True):
+            self.updated_at = timezone.now()
+    return super(TgUser, self).__getattribute__(item)
+
+
+def handler_path(tguser: TgUser):
+    """
+    Attribute reads of a typical update: handler predicates, checks and the handler itself.
+    """
+    tguser.is_empty_dialog()
+    tguser.get_dialog(0)
+    tguser.get_dialog(1, part='timer')
+    tguser.is_admin()
+    tguser.is_authorized()
+    tguser.is_private()
+    tguser.is_group()
+    tguser.is_muted()
+    tguser.name
+    tguser.tg_id
+    tguser.update_last_active()
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк чтения атрибутов TgUser в обработчике: с DateTimeModel.__getattribute__ и без'
+
+    def add_arguments(self, parser: CommandParser):
+        super().add_arguments(parser)
+        parser.add_argument('--number', dest='number', type=int, default=10000)
+        parser.add_argument('--repeat', dest='repeat', type=int, default=5)
+
+    def get_tguser(self) -> TgUser:
+        # looks loaded from the database, but nothing here touches it
+        tguser = TgUser(id=1, tg_id=1, first_name='First', last_name='Last', dialog='timer:1', last_active_at=timezone.now())
+        tguser._state.adding = False
+        reset_state(TgUser, tguser)
+        setattr(tguser, TgUser.trello.cache_name, None)
+        return tguser
+
+    def measure(self, name: str, func, tguser: TgUser) -> float:
+        timer = timeit.Timer(lambda: func(tguser))
+        best = min(timer.repeat(repeat=self.options['repeat'], number=self.options['number'])) / self.options['number']
+        self.stdout.write('%-28s %8.2f us' % (name, best * 1e6))
+        return best
+
+    def run(self, tguser: TgUser) -> dict:
+        return {
+            'handler': self.measure('handler path', handler_path, tguser),
+            'save_dirty_fields': self.measure('save_dirty_fields (clean)', lambda u: u.save_dirty_fields(), tguser),
+        }
+
+    def handle(self, *args, **options):
+        self.options = options
+        tguser = self.get_tguser()
+        self.stdout.write('before: DateTimeModel.__getattribute__')
+        TgUser.__getattribute__ = legacy_getattribute
+        try:
+            before = self.run(tguser)
+        finally:
+            del TgUser.__getattribute__
+        self.stdout.write('after: save hook')
+        after = self.run(tguser)
+        for name in before:
+            self.stdout.write('%s speedup %.2fx' % (name, before[name] / after[name]))
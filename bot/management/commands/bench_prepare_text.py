@@ -0,0 +1,60 @@
+import random
+import re
+import timeit
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from bot import utils as bot_utils, emoji, smile
+
+
+def legacy_prepare_text(text: str) -> str:
+    """
+    prepare_text as it was before the single pass implementation.
+    """
+    text = bot_utils.multiple_replace(bot_utils.HTML_ENTITIES, text)
+    text = re.sub('(\n|\r|\s{2,})+', ' ', text)
+    text = re.sub('<br */?>', '\n', text, flags=re.IGNORECASE)
+    text = re.sub(' *\n *', '\n', text)
+    return text
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк prepare_text на отрендеренных карточках'
+
+    words = ['fix', 'bug', 'deploy', 'release', 'Q&A', '"login"', '<script>', 'api', 'trello', 'bot', 'user\'s', 'review']
+
+    def add_arguments(self, parser: CommandParser):
+        super().add_arguments(parser)
+        parser.add_argument('--texts', dest='texts', type=int, default=200, help='Number of rendered texts')
+        parser.add_argument('--number', dest='number', type=int, default=20, help='Passes over all texts per repeat')
+        parser.add_argument('--repeat', dest='repeat', type=int, default=3)
+
+    def sentence(self, length: int) -> str:
+        return ' '.join(random.choice(self.words) for _ in range(length))
+
+    def get_texts(self, count: int) -> list:
+        template = bot_utils.get_dialog_template('bot/private/show_card.html').template
+        texts = []
+        for i in range(count):
+            card = {
+                'name': self.sentence(random.randint(2, 8)),
+                'desc': '\n\n'.join(self.sentence(random.randint(5, 30)) for _ in range(random.randint(0, 5))),
+                'due': random.choice([None, '2017-03-01T12:00:00.000Z']),
+                'shortUrl': 'https://trello.com/c/%08d' % i,
+            }
+            texts.append(template.render(dict(card=card, emoji=emoji, smile=smile)))
+        return texts
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        texts = self.get_texts(options['texts'])
+        for text in texts:
+            if legacy_prepare_text(text) != bot_utils.prepare_text(text):
+                raise Exception('prepare_text result differs from legacy one for %r' % text)
+        results = {}
+        for name, func in (('legacy', legacy_prepare_text), ('current', bot_utils.prepare_text)):
+            timer = timeit.Timer(lambda: [func(text) for text in texts])
+            best = min(timer.repeat(repeat=options['repeat'], number=options['number']))
+            results[name] = best / (options['number'] * len(texts))
+            self.stdout.write('%-8s %8.2f us/text' % (name, results[name] * 1e6))
+        self.stdout.write('speedup  %8.2fx' % (results['legacy'] / results['current']))
@@ -0,0 +1,58 @@
+import json
+import timeit
+
+from django.core.management.base import BaseCommand, CommandParser, CommandError
+from telebot.types import Update
+
+from base import utils as base_utils
+from bot import serialization
+from bot.models import TgMessage
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк сериализации апдейтов для TgMessage.message'
+
+    def add_arguments(self, parser: CommandParser):
+        super().add_arguments(parser)
+        parser.add_argument('--corpus', dest='corpus', help='File with one recorded webhook update JSON per line')
+        parser.add_argument('--limit', dest='limit', type=int, default=1000, help='Recorded updates from TgMessage without --corpus')
+        parser.add_argument('--number', dest='number', type=int, default=5)
+        parser.add_argument('--repeat', dest='repeat', type=int, default=3)
+
+    def get_corpus(self, options: dict) -> list:
+        if options['corpus']:
+            with open(options['corpus'], encoding='utf-8') as f:
+                return [line.strip() for line in f if line.strip()]
+        messages = TgMessage.objects.filter(message__contains='"update_id"').order_by('-id')
+        return list(messages.values_list('message', flat=True)[:options['limit']])
+
+    def handle(self, *args, **options):
+        corpus = self.get_corpus(options)
+        if not corpus:
+            raise CommandError('No recorded updates: pass --corpus or receive some webhook updates first')
+        plain_objects, raw_objects = [], []
+        for raw in corpus:
+            for objects in (plain_objects, raw_objects):
+                update = Update.de_json(json.loads(raw))
+                obj = update.message or update.callback_query
+                if obj is None:
+                    continue
+                if objects is raw_objects:
+                    serialization.set_raw(obj, raw)
+                objects.append(obj)
+        for obj in plain_objects[:100]:
+            if json.loads(serialization.dumps(obj)) != json.loads(base_utils.to_json(obj)):
+                raise CommandError('serialization.dumps differs from to_json for %r' % obj)
+        results = {}
+        for name, func, objects in (
+            ('to_json', base_utils.to_json, plain_objects),
+            ('encoder', serialization.dumps, plain_objects),
+            ('raw', serialization.dumps, raw_objects),
+        ):
+            timer = timeit.Timer(lambda: [func(obj) for obj in objects])
+            best = min(timer.repeat(repeat=options['repeat'], number=options['number']))
+            results[name] = best / (options['number'] * len(objects))
+            size = sum(len(func(obj)) for obj in objects) / len(objects)
+            self.stdout.write('%-8s %8.2f us/update  %7.0f chars' % (name, results[name] * 1e6, size))
+        for name in ('encoder', 'raw'):
+            self.stdout.write('%s speedup %.2fx' % (name, results['to_json'] / results[name]))
@@ -0,0 +1,194 @@
+import json
+import random
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from bot.models import TgUser, Trello
+from bot.stubs import TelegramStubServer, TrelloStubServer
+
+
+def percentile(values: list, share: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+class Scenario(object):
+    """
+    Synthetic users going through menus down to a card, its timer and a card search, also driven by bot/tests.
+    """
+    KINDS = ('/boards', '/board', '/board_list', '/card', '/timer_start', '/timer', '/timer_stop', 'search')
+
+    def __init__(self, trello: TrelloStubServer, boards: int, lists: int, cards: int):
+        self.client = Client()
+        self.url = reverse('bot_webhook', kwargs=dict(token_hash=settings.TELEGRAM_TOKEN_HASH))
+        self.update_id = 0
+        self.message_id = 0
+        self.cards = self.seed_trello(trello, boards, lists, cards)
+
+    @staticmethod
+    def seed_trello(trello: TrelloStubServer, boards: int, lists: int, cards: int) -> list:
+        items = []
+        for board_num in range(boards):
+            board_id = trello.add_board('Board %d' % board_num)
+            for list_num in range(lists):
+                list_id = trello.add_list(board_id, 'List %d' % list_num)
+                for card_num in range(cards):
+                    name = 'Task %d %s' % (card_num, random.choice(['login', 'deploy', 'report', 'billing', 'search']))
+                    items.append((board_id, list_id, trello.add_card(list_id, name), name))
+        return items
+
+    def get_message(self, tg_id: int) -> dict:
+        self.message_id += 1
+        return dict(
+            message_id=self.message_id,
+            date=int(time.time()),
+            chat=dict(id=tg_id, type='private', first_name='User %d' % tg_id),
+        )
+
+    def get_update(self, tg_id: int, text: str = None, data: str = None) -> dict:
+        self.update_id += 1
+        update = dict(update_id=self.update_id)
+        user = dict(id=tg_id, first_name='User %d' % tg_id)
+        if data is None:
+            update['message'] = dict(self.get_message(tg_id), text=text, **{'from': user})
+        else:
+            update['callback_query'] = {'id': str(self.update_id), 'from': user, 'message': self.get_message(tg_id), 'chat_instance': str(tg_id), 'data': data}
+        return update
+
+    def get_round(self, tg_id: int) -> list:
+        """
+        [(kind, update)] of one scenario: menus down to a card, its timer and a card search.
+        """
+        board_id, list_id, card_id, name = random.choice(self.cards)
+        return [
+            ('/boards', self.get_update(tg_id, text='/boards')),
+            ('/board', self.get_update(tg_id, data='/board %s' % board_id)),
+            ('/board_list', self.get_update(tg_id, data='/board_list %s' % list_id)),
+            ('/card', self.get_update(tg_id, data='/card %s' % card_id)),
+            ('/timer_start', self.get_update(tg_id, data='/timer_start %s' % card_id)),
+            ('/timer', self.get_update(tg_id, data='/timer %s' % card_id)),
+            ('/timer_stop', self.get_update(tg_id, data='/timer_stop %s' % card_id)),
+            ('search', self.get_update(tg_id, text=name.split()[-1])),
+        ]
+
+    def post(self, update: dict) -> int:
+        return self.client.post(self.url, json.dumps(update), content_type='application/json').status_code
+
+    def add_users(self, tg_ids: list):
+        """
+        /start from every user, then a Trello token as if each of them authorized.
+        """
+        for tg_id in tg_ids:
+            self.post(self.get_update(tg_id, text='/start'))
+        for tguser in TgUser.objects.filter(tg_id__in=tg_ids):
+            Trello.objects.create(tguser=tguser, token='bench%d' % tguser.tg_id, token_created_at=timezone.now())
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк webhook: синтетические апдейты через BotRequestView с заглушками Telegram и Trello во временной базе'
+
+    def add_arguments(self, parser: CommandParser):
+        super().add_arguments(parser)
+        parser.add_argument('--users', dest='users', type=int, default=20)
+        parser.add_argument('--rounds', dest='rounds', type=int, default=10, help='Scenarios per user: menus, card, timer, search')
+        parser.add_argument('--warmup', dest='warmup', type=int, default=1, help='Rounds per user that are not measured')
+        parser.add_argument('--boards', dest='boards', type=int, default=3)
+        parser.add_argument('--lists', dest='lists', type=int, default=5, help='Lists per board')
+        parser.add_argument('--cards', dest='cards', type=int, default=30, help='Cards per list')
+        parser.add_argument('--stub-latency', dest='stub_latency', type=float, default=0.0, help='Stub servers latency, seconds')
+        parser.add_argument('--seed', dest='seed', type=int, default=0)
+        parser.add_argument('--output', dest='output', help='Write the results as JSON to compare runs')
+
+    def measure(self, scenario: Scenario, kind: str, update: dict, stubs: dict):
+        calls = {name: stub.total_calls for name, stub in stubs.items()}
+        with CaptureQueriesContext(connection) as queries:
+            started_at = time.perf_counter()
+            status_code = scenario.post(update)
+            latency = time.perf_counter() - started_at
+        result = self.results[kind]
+        result['latency'].append(latency)
+        result['queries'].append(len(queries))
+        for name, stub in stubs.items():
+            result[name].append(stub.total_calls - calls[name])
+        if status_code != 200:
+            result['errors'].append(status_code)
+
+    def run(self, options: dict, telegram: TelegramStubServer, trello: TrelloStubServer) -> float:
+        scenario = Scenario(trello, options['boards'], options['lists'], options['cards'])
+        tg_ids = [1000 + num for num in range(options['users'])]
+        scenario.add_users(tg_ids)
+        for _ in range(options['warmup']):
+            for tg_id in tg_ids:
+                for kind, update in scenario.get_round(tg_id):
+                    scenario.post(update)
+        stubs = dict(telegram=telegram, trello=trello)
+        started_at = time.perf_counter()
+        for _ in range(options['rounds']):
+            for tg_id in tg_ids:
+                for kind, update in scenario.get_round(tg_id):
+                    self.measure(scenario, kind, update, stubs)
+        return time.perf_counter() - started_at
+
+    def get_summary(self, duration: float) -> OrderedDict:
+        summary = OrderedDict()
+        rows = list(self.results.items())
+        total = defaultdict(list)
+        for kind, result in rows:
+            for key, values in result.items():
+                total[key] += values
+        for kind, result in rows + [('total', total)]:
+            latency = result['latency']
+            if not latency:
+                continue
+            summary[kind] = OrderedDict([
+                ('updates', len(latency)),
+                ('p50_ms', percentile(latency, 0.5) * 1e3),
+                ('p95_ms', percentile(latency, 0.95) * 1e3),
+                ('p99_ms', percentile(latency, 0.99) * 1e3),
+                ('queries', sum(result['queries']) / len(latency)),
+                ('telegram', sum(result['telegram']) / len(latency)),
+                ('trello', sum(result['trello']) / len(latency)),
+                ('errors', len(result['errors'])),
+            ])
+        summary['total']['updates_per_second'] = len(total['latency']) / duration
+        return summary
+
+    def report(self, summary: OrderedDict):
+        self.stdout.write('%-14s %7s %8s %8s %8s %8s %9s %7s %7s' % ('update', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'telegram', 'trello', 'errors'))
+        for kind, row in summary.items():
+            self.stdout.write('%-14s %7d %8.2f %8.2f %8.2f %8.1f %9.2f %7.2f %7d' % (
+                kind, row['updates'], row['p50_ms'], row['p95_ms'], row['p99_ms'], row['queries'], row['telegram'], row['trello'], row['errors'],
+            ))
+        self.stdout.write('%.1f updates/s' % summary['total']['updates_per_second'])
+
+    def handle(self, *args, **options):
+        if options['rounds'] < 1 or options['users'] < 1:
+            raise CommandError('--rounds and --users must be positive')
+        random.seed(options['seed'])
+        self.results = OrderedDict()
+        for kind in Scenario.KINDS:
+            self.results[kind] = defaultdict(list)
+        setup_test_environment()
+        # everything the bot saves goes to a throwaway database
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with TelegramStubServer(latency=options['stub_latency']) as telegram, telegram.patch(), \
+                    TrelloStubServer(latency=options['stub_latency']) as trello, trello.patch(), \
+                    override_settings(TELEGRAM_INGEST_MODE='inline', TELEGRAM_RESPONSE_ERROR_ON_EXCEPTION=True, ALLOWED_HOSTS=['testserver']):
+                duration = self.run(options, telegram, trello)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        summary = self.get_summary(duration)
+        self.report(summary)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2)
@@ -1,8 +1,11 @@
 import logging
 
-from django.core.management.base import BaseCommand, CommandParser
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser, CommandError
 
-from bot.models import TgUser
+from bot.broadcast import BroadcastEngine
+from bot.models import Broadcast
+from bot.stubs import TelegramStubServer
 
 logger = logging.getLogger(__name__)
 
@@ -14,15 +17,39 @@ class Command(BaseCommand):
         super().add_arguments(parser)
         assert isinstance(parser, CommandParser)
         parser.add_argument('--text', '-t', dest='text', metavar='str', nargs='+', type=str, help='Custom text'),
+        parser.add_argument('--resume', dest='resume', metavar='id', type=int, help='Resume broadcast with the id'),
+        parser.add_argument('--workers', '-w', dest='workers', type=int, default=16, help='Number of sending threads'),
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=500),
+        parser.add_argument('--rate', dest='rate', type=float, default=settings.TELEGRAM_GLOBAL_RATE_LIMIT, help='Messages per second'),
+        parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='Send to a local stub Telegram server, save nothing'),
+        parser.add_argument('--stub-latency', dest='stub_latency', type=float, default=0.05, help='Stub server latency, seconds'),
 
     def handle(self, *args, **options):
-        text = ['Доступ к боту открыт!']
-        text = ' '.join(options.get('text') or text)  # sorry
-        total = 0
-        tgusers = TgUser.objects.filter(active=True)
-        for tguser in tgusers:
-            result = tguser.send_message(text, keyboard=tguser.keyboards.Start)
-            if options['verbosity'] >= 2:
-                print(tguser, bool(result))
-            total += 1
-        return 'Total: %d' % total
+        if options['resume']:
+            broadcast = Broadcast.objects.safe_get(options['resume'])
+            if not broadcast:
+                raise CommandError('Broadcast %d is not found' % options['resume'])
+            if broadcast.finished_at:
+                raise CommandError('Broadcast %d is already finished' % broadcast.id)
+        else:
+            text = ['Доступ к боту открыт!']
+            text = ' '.join(options.get('text') or text)  # sorry
+            broadcast = Broadcast(text=text)
+        engine = BroadcastEngine(
+            broadcast,
+            workers=options['workers'],
+            batch_size=options['batch_size'],
+            rate=options['rate'],
+            dry_run=options['dry_run'],
+            stdout=self.stdout,
+            verbosity=options['verbosity'],
+        )
+        if options['dry_run']:
+            with TelegramStubServer(latency=options['stub_latency']) as stub, stub.patch():
+                engine.run()
+        else:
+            engine.checkpoint()
+            engine.run()
+        return 'Total: %d, sent: %d, failed: %d, deactivated: %d, %.1f s, %.1f msg/s' % (
+            broadcast.processed, broadcast.sent, broadcast.failed, broadcast.deactivated, engine.elapsed, engine.throughput,
+        )
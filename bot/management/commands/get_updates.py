@@ -1,13 +1,12 @@
 import logging
-import sys
-import time
 from collections import OrderedDict
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
-from django.utils import autoreload
+from django.core.management.base import BaseCommand, CommandParser
 from telebot import logger
 
+from bot.ingest import run_polling
+
 logger.setLevel(logging.INFO)
 
 
@@ -16,12 +15,22 @@ class Command(BaseCommand):
     tgbot = None
     verbosity = 1
 
+    def add_arguments(self, parser: CommandParser):
+        super().add_arguments(parser)
+        parser.add_argument('--workers', '-w', dest='workers', type=int, default=settings.TELEGRAM_INGEST_WORKERS, help='Number of worker processes')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=100)
+        parser.add_argument('--timeout', dest='timeout', type=int, default=25, help='getUpdates long polling timeout, seconds')
+        parser.add_argument('--async', dest='use_async', action='store_true', help='Process updates with asyncio runtime in this process')
+        parser.add_argument('--max-pending', dest='max_pending', type=int, default=1000, help='Fetching pauses when workers are so many updates behind')
+
     def handle(self, *args, **options):
         self.verbosity = options.get('verbosity')
         from bot.handlers import tgbot
         self.tgbot = tgbot
         self.tgbot.remove_webhook()
-        autoreload.main(self.inner_handle)
+        if settings.DEBUG:
+            self.print_handlers_counter()
+        run_polling(options['workers'], options['batch_size'], options['timeout'], options['max_pending'], options['use_async'])
 
     def print_handlers_counter(self):
         handlers = ['message', 'callback_query', 'edited_message', 'channel_post', 'edited_channel_post', 'inline', 'chosen_inline']
@@ -40,13 +49,3 @@ class Command(BaseCommand):
                 commands = set(commands)
                 commands = sorted(commands)
                 logger.info('All commands: %s', commands)
-
-    def inner_handle(self, *args, **options):
-        if settings.DEBUG:
-            self.print_handlers_counter()
-        self.tgbot.polling(True, 0, 30)
-        while 1:
-            try:
-                time.sleep(100)
-            except KeyboardInterrupt:
-                sys.exit(0)
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from bot.ingest import run_workers, run_async
+
+
+class Command(BaseCommand):
+    help = 'Обработка очереди входящих апдейтов (TELEGRAM_INGEST_MODE = queue)'
+
+    def add_arguments(self, parser: CommandParser):
+        super().add_arguments(parser)
+        parser.add_argument('--workers', '-w', dest='workers', type=int, default=settings.TELEGRAM_INGEST_WORKERS, help='Number of worker processes')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=100)
+        parser.add_argument('--async', dest='use_async', action='store_true', help='One process with asyncio runtime instead of worker processes')
+
+    def handle(self, *args, **options):
+        if options['use_async']:
+            run_async(options['batch_size'])
+        else:
+            run_workers(options['workers'], options['batch_size'])
@@ -0,0 +1,24 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from bot.outbox import Outbox
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Отправка очереди исходящих сообщений'
+
+    def add_arguments(self, parser: CommandParser):
+        super().add_arguments(parser)
+        parser.add_argument('--workers', '-w', dest='workers', type=int, default=None, help='Number of worker threads')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        outbox = Outbox(workers=options['workers'], batch_size=options['batch_size'])
+        try:
+            outbox.run()
+        except KeyboardInterrupt:
+            pass
+        return 'Stats: %s' % ', '.join('%s - %d' % (k, v) for k, v in sorted(outbox.stats.items()))
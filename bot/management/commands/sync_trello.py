@@ -0,0 +1,28 @@
+import logging
+import threading
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from bot.ingest import handle_stop_signals
+from bot.mirror import MirrorSync
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Синхронизация локальной копии досок Trello'
+
+    def add_arguments(self, parser: CommandParser):
+        super().add_arguments(parser)
+        parser.add_argument('--once', dest='once', action='store_true', default=False, help='Sync stale and changed boards and exit')
+        parser.add_argument('--interval', dest='interval', type=float, default=None, help='Seconds between syncs of boards without changes')
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        mirror_sync = MirrorSync(stop_event, interval=options['interval'])
+        if options['once']:
+            mirror_sync.run_once()
+        else:
+            handle_stop_signals(stop_event)
+            mirror_sync.run()
+        return 'Stats: %s' % ', '.join('%s - %d' % (k, v) for k, v in sorted(mirror_sync.stats.items()))
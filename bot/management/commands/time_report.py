@@ -0,0 +1,33 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandParser, CommandError
+
+from base.utils import mytime
+from bot.models import TimeRollup
+
+
+class Command(BaseCommand):
+    help = 'Отчёт о затраченном времени по доскам из TimeRollup'
+
+    def add_arguments(self, parser: CommandParser):
+        super().add_arguments(parser)
+        parser.add_argument('--period', dest='period', choices=[period for period, _ in TimeRollup.PERIODS], default=TimeRollup.PERIOD_WEEK)
+        parser.add_argument('--date', dest='date', help='YYYY-MM-DD inside the period, today by default')
+        parser.add_argument('--user', dest='tg_id', type=int, help='tg_id of the user, all users by default')
+
+    def handle(self, *args, **options):
+        date = TimeRollup.get_today()
+        if options['date']:
+            try:
+                date = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Wrong --date: %s' % options['date'])
+        rollups = TimeRollup.objects.filter(period=options['period'], period_start=TimeRollup.get_period_start(options['period'], date))
+        if options['tg_id']:
+            rollups = rollups.filter(tguser__tg_id=options['tg_id'])
+        tguser = None
+        for rollup in rollups.select_related('tguser').order_by('tguser_id', '-seconds'):
+            if rollup.tguser != tguser:
+                tguser = rollup.tguser
+                self.stdout.write('%s (%d)' % (tguser.name, tguser.tg_id))
+            self.stdout.write('    %-30s %10s %5d' % (rollup.board_id, mytime(rollup.seconds), rollup.entries))
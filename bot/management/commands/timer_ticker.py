@@ -0,0 +1,24 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from bot.ticker import TimerTicker
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Обновление клавиатур запущенных таймеров'
+
+    def add_arguments(self, parser: CommandParser):
+        super().add_arguments(parser)
+        parser.add_argument('--workers', '-w', dest='workers', type=int, default=None, help='Number of threads sending edits')
+        parser.add_argument('--sync-interval', dest='sync_interval', type=float, default=None, help='Seconds between loads of started timers')
+
+    def handle(self, *args, **options):
+        ticker = TimerTicker(workers=options['workers'], sync_interval=options['sync_interval'])
+        try:
+            ticker.run()
+        except KeyboardInterrupt:
+            pass
+        return 'Stats: %s' % ', '.join('%s - %d' % (k, v) for k, v in sorted(ticker.stats.items()))
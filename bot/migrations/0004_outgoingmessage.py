@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0003_timer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingMessage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('chat_id', models.BigIntegerField(db_index=True)),
+                ('method', models.CharField(max_length=50)),
+                ('args', models.TextField(default='[]')),
+                ('kwargs', models.TextField(default='{}')),
+                ('status', models.CharField(max_length=10, default='pending', choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')])),
+                ('attempts', models.IntegerField(default=0)),
+                ('not_before', models.DateTimeField(default=django.utils.timezone.now)),
+                ('error', models.CharField(max_length=255, blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(null=True, blank=True)),
+            ],
+            options={
+                'verbose_name': 'OutgoingMessage',
+                'verbose_name_plural': 'OutgoingMessage',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='outgoingmessage',
+            index_together=set([('status', 'not_before')]),
+        ),
+    ]
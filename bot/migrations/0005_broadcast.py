@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0004_outgoingmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('text', models.TextField()),
+                ('last_tguser_id', models.IntegerField(default=0)),
+                ('processed', models.IntegerField(default=0)),
+                ('sent', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('deactivated', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(null=True, blank=True)),
+            ],
+            options={
+                'verbose_name': 'Broadcast',
+                'verbose_name_plural': 'Broadcast',
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0005_broadcast'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IncomingUpdate',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('update_id', models.BigIntegerField(unique=True)),
+                ('tg_id', models.BigIntegerField(default=0)),
+                ('body', models.TextField()),
+                ('status', models.CharField(max_length=10, choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], default='pending')),
+                ('error', models.CharField(max_length=255, blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(null=True, blank=True)),
+            ],
+            options={
+                'verbose_name': 'IncomingUpdate',
+                'verbose_name_plural': 'IncomingUpdate',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='incomingupdate',
+            index_together=set([('status', 'tg_id')]),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0006_incomingupdate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimeEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('board_id', models.CharField(max_length=50)),
+                ('list_id', models.CharField(max_length=50)),
+                ('card_id', models.CharField(max_length=50)),
+                ('date', models.DateField()),
+                ('started_at', models.DateTimeField()),
+                ('stopped_at', models.DateTimeField()),
+                ('seconds', models.PositiveIntegerField()),
+                ('tguser', models.ForeignKey(verbose_name='TgUser', to='bot.TgUser')),
+            ],
+            options={
+                'verbose_name': 'TimeEntry',
+                'verbose_name_plural': 'TimeEntry',
+            },
+        ),
+        migrations.CreateModel(
+            name='TimeRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('period', models.CharField(max_length=4, choices=[('day', 'Day'), ('week', 'Week')])),
+                ('period_start', models.DateField()),
+                ('board_id', models.CharField(max_length=50)),
+                ('seconds', models.PositiveIntegerField(default=0)),
+                ('entries', models.PositiveIntegerField(default=0)),
+                ('tguser', models.ForeignKey(verbose_name='TgUser', to='bot.TgUser')),
+            ],
+            options={
+                'verbose_name': 'TimeRollup',
+                'verbose_name_plural': 'TimeRollup',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='timerollup',
+            unique_together=set([('tguser', 'period', 'period_start', 'board_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='timeentry',
+            index_together=set([('tguser', 'board_id', 'list_id', 'card_id', 'date'), ('tguser', 'date')]),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0007_timeentry_timerollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trello',
+            name='boards_synced_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.CreateModel(
+            name='TrelloBoard',
+            fields=[
+                ('id', models.CharField(max_length=50, serialize=False, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+                ('closed', models.BooleanField(default=False)),
+                ('webhook_id', models.CharField(max_length=50, blank=True, default='')),
+                ('since', models.CharField(max_length=30, blank=True, default='')),
+                ('changed_at', models.DateTimeField(null=True, blank=True)),
+                ('synced_at', models.DateTimeField(null=True, blank=True)),
+                ('tgusers', models.ManyToManyField(related_name='trello_boards', to='bot.TgUser', blank=True)),
+            ],
+            options={
+                'verbose_name': 'TrelloBoard',
+                'verbose_name_plural': 'TrelloBoard',
+            },
+        ),
+        migrations.CreateModel(
+            name='TrelloList',
+            fields=[
+                ('id', models.CharField(max_length=50, serialize=False, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+                ('closed', models.BooleanField(default=False)),
+                ('pos', models.FloatField(default=0)),
+                ('board', models.ForeignKey(related_name='lists', to='bot.TrelloBoard')),
+            ],
+            options={
+                'verbose_name': 'TrelloList',
+                'verbose_name_plural': 'TrelloList',
+                'ordering': ['pos'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TrelloCard',
+            fields=[
+                ('id', models.CharField(max_length=50, serialize=False, primary_key=True)),
+                ('name', models.CharField(max_length=255)),
+                ('desc', models.TextField(blank=True, default='')),
+                ('due', models.CharField(max_length=30, blank=True, default='')),
+                ('short_url', models.CharField(max_length=255, blank=True, default='')),
+                ('closed', models.BooleanField(default=False)),
+                ('pos', models.FloatField(default=0)),
+                ('board', models.ForeignKey(related_name='cards', to='bot.TrelloBoard')),
+                ('list', models.ForeignKey(related_name='cards', to='bot.TrelloList')),
+            ],
+            options={
+                'verbose_name': 'TrelloCard',
+                'verbose_name_plural': 'TrelloCard',
+                'ordering': ['pos'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0008_trello_mirror'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='timer',
+            unique_together=set([('tguser', 'card_id')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0009_timer_unique_tguser_card'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='timer',
+            name='message_id',
+            field=models.BigIntegerField(null=True, blank=True, db_index=True),
+        ),
+    ]
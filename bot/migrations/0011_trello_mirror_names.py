@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0010_timer_message_id_not_unique'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trelloboard',
+            name='name',
+            field=models.TextField(),
+        ),
+        migrations.AlterField(
+            model_name='trellolist',
+            name='name',
+            field=models.TextField(),
+        ),
+        migrations.AlterField(
+            model_name='trellocard',
+            name='name',
+            field=models.TextField(),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0011_trello_mirror_names'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trelloboard',
+            name='full_synced_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,291 @@
+"""
+Local mirror of Trello boards, lists and cards of authorized users, menus are read from it.
+A board is mirrored entirely once, then by delta: only cards and lists touched by board actions since the last
+mirrored one (`TrelloBoard.since`) are fetched again. Deltas run when a webhook callback marks the board changed,
+and every TRELLO_MIRROR_SYNC_INTERVAL in case a callback was lost or webhooks are off. A board is mirrored entirely
+again every TRELLO_MIRROR_FULL_SYNC_INTERVAL in case a delta missed something.
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import threading
+from datetime import timedelta
+
+import trolly
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from requests import RequestException
+
+from base import utils as base_utils
+from bot.models import TgUser, Trello, TrelloBoard, TrelloList, TrelloCard
+from bot.utils import TrelloClient
+
+logger = logging.getLogger(__name__)
+
+LIST_FIELDS = 'name,closed,pos,idBoard'
+CARD_FIELDS = 'name,desc,due,shortUrl,closed,pos,idList,idBoard'
+ACTIONS_LIMIT = 1000
+
+
+def get_list_values(data: dict) -> dict:
+    return dict(board_id=data['idBoard'], name=data['name'], closed=bool(data.get('closed')), pos=float(data.get('pos') or 0))
+
+
+def get_card_values(data: dict) -> dict:
+    return dict(
+        board_id=data['idBoard'],
+        list_id=data['idList'],
+        name=data['name'],
+        desc=data.get('desc') or '',
+        due=data.get('due') or '',
+        short_url=data.get('shortUrl') or '',
+        closed=bool(data.get('closed')),
+        pos=float(data.get('pos') or 0),
+    )
+
+
+def upsert(model, values: dict):
+    """
+    Saves {id: field values} rows: new ones with one bulk insert, existing ones only if changed.
+    """
+    existing = {obj.id: obj for obj in model.objects.filter(id__in=list(values))}
+    new = []
+    for obj_id, obj_values in values.items():
+        obj = existing.get(obj_id)
+        if obj is None:
+            new.append(model(id=obj_id, **obj_values))
+            continue
+        changed = [name for name, value in obj_values.items() if getattr(obj, name) != value]
+        if changed:
+            for name in changed:
+                setattr(obj, name, obj_values[name])
+            obj.save(update_fields=changed)
+    if new:
+        model.objects.bulk_create(new)
+
+
+def get_client(tguser: TgUser) -> TrelloClient:
+    return TrelloClient(tguser, tguser.trello.token, notify_unauthorized=False)
+
+
+def get_callback_url() -> str:
+    return base_utils.site_url(reverse('trello_webhook'))
+
+
+def is_valid_signature(body: bytes, signature: str) -> bool:
+    """
+    Trello signs callbacks with base64(HMAC-SHA1(app secret, body + callback URL)).
+    """
+    digest = hmac.new(settings.TRELLO_SECRET_KEY.encode(), body + get_callback_url().encode(), hashlib.sha1).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode(), signature or '')
+
+
+def register_webhook(board: TrelloBoard, client: TrelloClient):
+    if not settings.TRELLO_WEBHOOKS or not settings.TRELLO_SECRET_KEY or board.webhook_id:
+        # callbacks are rejected without the secret to check their signatures
+        return
+    try:
+        webhook = client.fetch_json('/webhooks', http_method='POST', query_params={
+            'callbackURL': get_callback_url(),
+            'idModel': board.id,
+            'description': 'TrelloPlusBot mirror',
+        })
+    except (trolly.ResourceUnavailable, trolly.Unauthorised) as e:
+        logger.warning('Webhook of board %s was not registered: %s', board.id, e)
+        return
+    board.webhook_id = webhook['id']
+    board.save(update_fields=['webhook_id'])
+
+
+def sync_board(board: TrelloBoard, client: TrelloClient):
+    """
+    Mirrors the whole board: its lists and cards including closed ones.
+    """
+    started_at = timezone.now()
+    data = client.fetch_fresh_json('/boards/%s' % board.id, {
+        'fields': 'name,closed',
+        'lists': 'all',
+        'list_fields': LIST_FIELDS,
+        'cards': 'all',
+        'card_fields': CARD_FIELDS,
+        'actions': 'all',
+        'actions_limit': 1,
+        'action_fields': 'date',
+    })
+    lists = {item['id']: get_list_values(item) for item in data.get('lists', [])}
+    cards = {item['id']: get_card_values(item) for item in data.get('cards', [])}
+    with transaction.atomic():
+        TrelloCard.objects.filter(board=board).exclude(id__in=list(cards)).delete()
+        TrelloList.objects.filter(board=board).exclude(id__in=list(lists)).delete()
+        upsert(TrelloList, lists)
+        upsert(TrelloCard, cards)
+        board.name = data['name']
+        board.closed = bool(data.get('closed'))
+        if data.get('actions'):
+            board.since = data['actions'][0]['date']
+        board.synced_at = board.full_synced_at = started_at
+        board.save(update_fields=['name', 'closed', 'since', 'synced_at', 'full_synced_at'])
+    register_webhook(board, client)
+
+
+def sync_board_delta(board: TrelloBoard, client: TrelloClient):
+    """
+    Fetches again cards and lists touched by board actions since the last mirrored one.
+    """
+    if not board.since:
+        return sync_board(board, client)
+    started_at = timezone.now()
+    actions = client.fetch_fresh_json('/boards/%s/actions' % board.id, {
+        'since': board.since,
+        'limit': ACTIONS_LIMIT,
+        'fields': 'type,date,data',
+    })
+    if len(actions) >= ACTIONS_LIMIT:
+        return sync_board(board, client)
+    card_ids, list_ids, deleted_card_ids = set(), set(), set()
+    board_changed = False
+    for action in actions:
+        data = action.get('data') or {}
+        if action['type'] == 'deleteCard':
+            deleted_card_ids.add(data['card']['id'])
+        elif 'card' in data:
+            card_ids.add(data['card']['id'])
+        for key in ('list', 'listBefore', 'listAfter'):
+            if key in data:
+                list_ids.add(data[key]['id'])
+        board_changed = board_changed or action['type'] == 'updateBoard'
+    card_ids -= deleted_card_ids
+    paths = ['/lists/%s' % list_id for list_id in list_ids] + ['/cards/%s' % card_id for card_id in card_ids]
+    if board_changed:
+        paths.append('/boards/%s' % board.id)
+    lists, cards = {}, {}
+    gone_list_ids, gone_card_ids = set(), set(deleted_card_ids)
+    for path, (status, result) in zip(paths, client.fetch_batch(paths) if paths else []):
+        object_type, object_id = path.strip('/').split('/')
+        if status == 200 and object_type == 'boards':
+            board.name = result['name']
+            board.closed = bool(result.get('closed'))
+        elif status == 200 and result.get('idBoard') == board.id:
+            (lists if object_type == 'lists' else cards)[object_id] = result
+        elif status in (200, 404):
+            # moved to another board or deleted
+            (gone_list_ids if object_type == 'lists' else gone_card_ids).add(object_id)
+        else:
+            logger.warning('Board %s: %s returned %d, syncing the whole board', board.id, path, status)
+            return sync_board(board, client)
+    board_list_ids = set(TrelloList.objects.filter(board=board).values_list('id', flat=True))
+    new_list_ids = set(lists) - board_list_ids
+    if new_list_ids:
+        # created or moved from another board with its cards, actions of the move don't mention them
+        paths = ['/lists/%s/cards' % list_id for list_id in new_list_ids]
+        for path, (status, result) in zip(paths, client.fetch_batch(paths)):
+            if status != 200:
+                logger.warning('Board %s: %s returned %d, syncing the whole board', board.id, path, status)
+                return sync_board(board, client)
+            cards.update((item['id'], item) for item in result if item.get('idBoard') == board.id)
+    known_list_ids = board_list_ids | set(lists)
+    if any(card['idList'] not in known_list_ids for card in cards.values()):
+        return sync_board(board, client)
+    with transaction.atomic():
+        # rows moved to another board may already be mirrored there
+        TrelloCard.objects.filter(Q(id__in=gone_card_ids) | Q(list_id__in=gone_list_ids), board=board).delete()
+        TrelloList.objects.filter(board=board, id__in=gone_list_ids).delete()
+        upsert(TrelloList, {list_id: get_list_values(item) for list_id, item in lists.items()})
+        upsert(TrelloCard, {card_id: get_card_values(item) for card_id, item in cards.items()})
+        if actions:
+            # newest first
+            board.since = actions[0]['date']
+        board.synced_at = started_at
+        board.save(update_fields=['name', 'closed', 'since', 'synced_at'])
+
+
+def sync_user(tguser: TgUser, client: TrelloClient = None):
+    """
+    Mirrors the list of boards of the user, new boards are mirrored entirely.
+    """
+    client = client or get_client(tguser)
+    started_at = timezone.now()
+    boards = {
+        item['id']: dict(name=item['name'], closed=bool(item.get('closed')))
+        for item in client.fetch_fresh_json('/members/me/boards', {'filter': 'open', 'fields': 'name,closed'})
+    }
+    upsert(TrelloBoard, boards)
+    member_ids = set(tguser.trello_boards.values_list('id', flat=True))
+    if member_ids - set(boards):
+        tguser.trello_boards.remove(*(member_ids - set(boards)))
+    if set(boards) - member_ids:
+        tguser.trello_boards.add(*(set(boards) - member_ids))
+    for board in TrelloBoard.objects.filter(id__in=list(boards), synced_at__isnull=True):
+        sync_board(board, client)
+    tguser.trello.boards_synced_at = started_at
+    tguser.trello.save(update_fields=['boards_synced_at'])
+
+
+def ensure_synced(tguser: TgUser):
+    """
+    The first menu of a user waits for the mirror of the user's boards.
+    """
+    if tguser.trello.boards_synced_at is None:
+        sync_user(tguser, tguser.client)
+
+
+def get_board_client(board: TrelloBoard) -> TrelloClient or None:
+    tguser = board.tgusers.filter(active=True, trello__isnull=False).select_related('trello').first()
+    return get_client(tguser) if tguser else None
+
+
+class MirrorSync(object):
+    """
+    ./manage.py sync_trello loop: boards changed by webhook callbacks first, then the periodic sync.
+    """
+
+    stale_check_interval = 30  # seconds, the query is heavier than the one of changed boards
+
+    def __init__(self, stop_event: threading.Event = None, interval: float = None, poll_interval: float = 1):
+        self.stop_event = stop_event or threading.Event()
+        self.interval = interval or settings.TRELLO_MIRROR_SYNC_INTERVAL
+        self.poll_interval = poll_interval
+        self.stats = dict(boards=0, users=0, failed=0)
+
+    def sync(self, func, obj, client: TrelloClient or None, key: str):
+        if client is None:
+            return
+        try:
+            func(obj, client)
+        except (trolly.ResourceUnavailable, trolly.Unauthorised, RequestException) as e:
+            logger.warning('%s %s: %s', key, obj, e)
+            self.stats['failed'] += 1
+        else:
+            self.stats[key] += 1
+
+    def sync_changed(self):
+        for board in TrelloBoard.objects.filter(changed_at__gt=F('synced_at')):
+            self.sync(sync_board_delta, board, get_board_client(board), 'boards')
+
+    def sync_stale(self):
+        stale_at = timezone.now() - timedelta(seconds=self.interval)
+        trellos = Trello.objects.filter(Q(boards_synced_at__isnull=True) | Q(boards_synced_at__lt=stale_at), tguser__active=True)
+        for trello in trellos.select_related('tguser'):
+            self.sync(sync_user, trello.tguser, get_client(trello.tguser), 'users')
+        full_stale_at = timezone.now() - timedelta(seconds=settings.TRELLO_MIRROR_FULL_SYNC_INTERVAL)
+        boards = TrelloBoard.objects.filter(closed=False, synced_at__lt=stale_at)
+        for board in boards:
+            func = sync_board if board.full_synced_at is None or board.full_synced_at < full_stale_at else sync_board_delta
+            self.sync(func, board, get_board_client(board), 'boards')
+
+    def run_once(self):
+        self.sync_changed()
+        self.sync_stale()
+
+    def run(self):
+        checked_at = None
+        while not self.stop_event.is_set():
+            self.sync_changed()
+            if checked_at is None or (timezone.now() - checked_at).total_seconds() >= self.stale_check_interval:
+                checked_at = timezone.now()
+                self.sync_stale()
+            self.stop_event.wait(self.poll_interval)
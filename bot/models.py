@@ -1,29 +1,42 @@
+import json
 import logging
-import re
 from datetime import timedelta
 from json import JSONDecodeError
 
 from bitfield import BitField
 from dirtyfields import DirtyFieldsMixin
 from django.conf import settings
-from django.db import models
-from django.template import engines
-from django.template.loaders.app_directories import Loader
+from django.db import models, transaction, IntegrityError
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 from telebot.apihelper import ApiException
-from telebot.types import User, Chat, Message, CallbackQuery
+from telebot.types import User, Chat, Message, CallbackQuery, Update
 
 from base import utils as base_utils
 from base.models import DateTimeModel, MyModel
 from bot import utils as bot_utils, emoji, smile
+from bot.identity import IdentityCache
 from bot.keyboards import InlineKeyboard
 from bot.utils import TrelloClient
 
 logger = logging.getLogger(__name__)
 
+# TeleBot methods that can be sent through OutgoingMessage queue (all their arguments are serializable to json)
+OUTBOX_METHODS = (
+    'send_message',
+    'edit_message_text',
+    'edit_message_reply_markup',
+    'answer_callback_query',
+    'forward_message',
+    'send_sticker',
+    'send_chat_action',
+    'send_location',
+    'send_venue',
+    'send_contact',
+)
+
 
 class TgBotApiModel(DirtyFieldsMixin, DateTimeModel, MyModel):
     tg_id = models.BigIntegerField(unique=True)
@@ -44,15 +57,24 @@ class TgBotApiModel(DirtyFieldsMixin, DateTimeModel, MyModel):
     def load(cls, user, item):
         return cls.objects
 
-    def smart_save(self, update_fields=None, *args, **kwargs):
-        if update_fields:
-            dirty_fields = self.get_dirty_fields().keys()
-            if not list(set(update_fields) & set(dirty_fields)):
-                return False
-                # надо быть осторожнее, потому что если сохранить только некоторые поля, то флаг is_dirty с сущности снимается
-        if not self.is_dirty():
+    def smart_save(self, update_fields=None, **kwargs) -> bool:
+        """
+        Saves only changed fields (of `update_fields` if given), a new row is saved entirely.
+        Returns False if there was nothing to save.
+        """
+        if self._state.adding:
+            self.save(**kwargs)
+            return True
+        dirty_fields = self.get_dirty_fields(check_relationship=True).keys()
+        if update_fields is not None:
+            dirty_fields = set(dirty_fields) & set(update_fields)
+        if not dirty_fields:
             return False
-        return self.save(update_fields=update_fields, *args, **kwargs)
+        self.save(update_fields=list(dirty_fields), **kwargs)
+        return True
+
+    def save_dirty_fields(self):
+        return self.smart_save()
 
     def mute(self):
         self._mute = True
@@ -83,15 +105,6 @@ class TgBotApiModel(DirtyFieldsMixin, DateTimeModel, MyModel):
             logger.warning('Too long text: %s' % original_text)
         return text
 
-    @staticmethod
-    def _load(template_name: str):
-        django_engine = engines['django'].engine
-        for template_loader in django_engine.template_loaders:
-            if isinstance(template_loader, Loader):
-                content, _ = template_loader.load_template_source(template_name)
-                return content
-        return None
-
     def render_to_string(self, template_name: str, context=None, sticker=None, document=None, photo=None, keyboard=None, reply_markup=None, edit=False, **kwargs):
         """
         На самом деле этот метод отправляет диалог. Но это имя ему задано для того чтобы IDE проверял пути к шаблонам.
@@ -105,42 +118,7 @@ class TgBotApiModel(DirtyFieldsMixin, DateTimeModel, MyModel):
             context[self_key] = self
         context['emoji'] = emoji
         context['smile'] = smile
-        text = self._load(template_name)
-        version = base_utils.md5(text.encode('utf-8'))
-        title = None
-        m = re.search(r'title:(?P<title>.+)\n', text)
-        if m:
-            title = m.group('title')
-            text = text[:m.start()] + text[m.end():]
-        name = template_name
-        if name.find('bot/', 0, 4) == 0:
-            name = name[4:]
-        if name.find('.html', -5) != -1:
-            name = name[:-5]
-        title_parts = name.split('/')
-        title_associate = {
-            'private': 'Приватный чат',
-            'group': 'Групповой чат',
-            'errors': 'Ошибки',
-            'tutorial': 'Обучение',
-            'admin': 'Админам',
-        }
-        for i in range(len(title_parts)):
-            part = title_parts[i]
-            if part in title_associate:
-                title_parts[i] = title_associate[part]
-            elif i == len(title_parts) - 1 and title:
-                title_parts[i] = title.strip()
-        title = ' / '.join(title_parts)
-        m = re.search(r'comment:(?P<comment>.+)\n', text)
-        comment = ''
-        if context and isinstance(context, dict):
-            comment = 'context=%s' % list(context.keys())
-        if m:
-            comment += '\n' + m.group('comment')
-            text = text[:m.start()] + text[m.end():]
-        text = text.strip()
-        text = bot_utils.render_from_string(text, context)
+        text = bot_utils.get_dialog_template(template_name).render(context)
         if sticker:
             self.send_sticker(sticker, **kwargs)
         kwargs['keyboard'] = keyboard
@@ -156,7 +134,15 @@ class TgBotApiModel(DirtyFieldsMixin, DateTimeModel, MyModel):
     def reset(self):
         self.call_parent(super())
 
-    def _exec_api_request(self, method: callable, *args, simple=False, reply=False, **kwargs):
+    def enqueue(self, method: callable, *args, simple=False, delay=0, **kwargs):
+        """
+        Puts the request to OutgoingMessage queue instead of sending it right now.
+        """
+        if not simple:
+            args = (self.tg_id,) + args
+        return OutgoingMessage.enqueue(self.tg_id, method.__name__, *args, delay=delay, **kwargs)
+
+    def _exec_api_request(self, method: callable, *args, simple=False, reply=False, queued=None, **kwargs):
         if not self.active:
             return False
         if self.is_muted():
@@ -167,10 +153,15 @@ class TgBotApiModel(DirtyFieldsMixin, DateTimeModel, MyModel):
             if not reply_markup and keyboard and isinstance(self, TgUser):
                 keyboard = bot_utils.keyboard_factory(self, keyboard, reply_markup=False)
                 if not simple or isinstance(keyboard, InlineKeyboard):
-                    reply_markup = keyboard.get_reply_markup()
+                    reply_markup = keyboard.get_reply_markup_json()
             kwargs['reply_markup'] = reply_markup
         if not simple and reply and self.message and self.message.message_id and 'reply_to_message_id' not in kwargs:
             kwargs['reply_to_message_id'] = self.message.message_id
+        outbox_method = settings.TELEGRAM_OUTBOX and method.__name__ in OUTBOX_METHODS
+        if queued is None:
+            queued = outbox_method
+        if queued:
+            return self.enqueue(method, *args, simple=simple, **kwargs)
         self.requests_made += 1
         try:
             if simple:
@@ -193,6 +184,9 @@ class TgBotApiModel(DirtyFieldsMixin, DateTimeModel, MyModel):
                 self.deactivate()
             elif e.result.status_code == 429:
                 logger.warning('tg_id: %d, %s' % (self.tg_id, description))
+                if outbox_method:
+                    retry_after = json_data.get('parameters', {}).get('retry_after', 1)
+                    self.enqueue(method, *args, simple=simple, delay=retry_after, **kwargs)
             else:
                 text = 'tg_id: %d, e: %s, args: %s, kwargs: %s' % (self.tg_id, e, args, base_utils.get_dict(kwargs))
                 logger.warning(text)
@@ -280,6 +274,9 @@ class TgBotApiModel(DirtyFieldsMixin, DateTimeModel, MyModel):
         if not answered:
             self.__answered = True
             from bot.handlers import tgbot
+            # not behind the chat rate limit of the outbox: the button spinner waits for the answer,
+            # and the query expires if the answer is late
+            kwargs.setdefault('queued', False)
             return self._exec_api_request(tgbot.answer_callback_query, self.callback_query.id, text=text, show_alert=show_alert, simple=True, **kwargs)
         return False
 
@@ -323,11 +320,14 @@ class TgChat(TgBotApiModel):
 
     @classmethod
     def load(cls, chat: Chat, item=None):
-        tgchat = cls.objects.get_or_create(tg_id=chat.id, defaults=dict(
-            type=chat.type,
-            title=chat.title,
-            active=True,
-        ))[0]
+        tgchat, version = tgchat_cache.get(chat.id)
+        if tgchat is None:
+            tgchat = cls.objects.get_or_create(tg_id=chat.id, defaults=dict(
+                type=chat.type,
+                title=chat.title,
+                active=True,
+            ))[0]
+            tgchat_cache.fill(tgchat, version)
         tgchat.active = True
         return tgchat
 
@@ -359,9 +359,15 @@ class TgUser(TgBotApiModel):
 
     @classmethod
     def load(cls, user: User, item):
-        qs = (super().load(user, item) or cls.objects)
-        qs = qs.select_related('trello')
-        tguser = qs.get_or_create(tg_id=user.id)[0]
+        # profile fields are assigned anyway, dirty fields tracking leaves unchanged ones unsaved
+        tguser, version = tguser_cache.get(user.id)
+        if tguser is None:
+            qs = (super().load(user, item) or cls.objects)
+            qs = qs.select_related('trello')
+            tguser, created = qs.get_or_create(tg_id=user.id)
+            if created:
+                setattr(tguser, TgUser.trello.cache_name, None)
+            tguser_cache.fill(tguser, version)
         tguser.username = user.username or ''
         tguser.first_name = user.first_name
         tguser.last_name = user.last_name or ''
@@ -487,6 +493,8 @@ class TgUser(TgBotApiModel):
             trello = Trello(tguser=self)
         trello.token = token
         trello.token_created_at = timezone.now()
+        # boards of another token are mirrored again
+        trello.boards_synced_at = None
         trello.save()
         self.client.user_auth_token = token
         return bool(self.client.get_boards())
@@ -520,7 +528,11 @@ class TgMessage(MyModel):
     def get_message(self) -> Message or None:
         if self.chat_type == 'callback_query':
             return None
-        return Message.de_json(self.message)
+        data = json.loads(self.message)
+        if 'update_id' in data:
+            # raw webhook update
+            return Update.de_json(data).message
+        return Message.de_json(data)
 
 
 class MessageLink(models.Model):
@@ -548,6 +560,13 @@ class Trello(models.Model):
     tguser = models.OneToOneField(verbose_name=TgUser.verbose_name(), to=TgUser)
     token = models.CharField(max_length=100)
     token_created_at = models.DateTimeField()
+    boards_synced_at = models.DateTimeField(null=True, blank=True)  # the list of boards of the user was mirrored
+
+
+tguser_cache = IdentityCache(TgUser, related=('trello',))
+tguser_cache.connect()
+tgchat_cache = IdentityCache(TgChat)
+tgchat_cache.connect()
 
 
 class Token(MyModel):
@@ -561,4 +580,309 @@ class Timer(MyModel):
     list_id = models.CharField(max_length=50)
     card_id = models.CharField(max_length=50, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    message_id = models.BigIntegerField(unique=True)
+    # message showing the card with the timer, None - the message shows something else now
+    message_id = models.BigIntegerField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        # a timer per card of a user, also the index of timer lookups
+        unique_together = [('tguser', 'card_id')]
+
+
+class TimeEntry(MyModel):
+    """
+    Time logged by a stopped timer. `date` is the local date the timer was started.
+    """
+    tguser = models.ForeignKey(verbose_name=TgUser.verbose_name(), to=TgUser)
+    board_id = models.CharField(max_length=50)
+    list_id = models.CharField(max_length=50)
+    card_id = models.CharField(max_length=50)
+    date = models.DateField()
+    started_at = models.DateTimeField()
+    stopped_at = models.DateTimeField()
+    seconds = models.PositiveIntegerField()
+
+    class Meta:
+        verbose_name_plural = verbose_name = 'TimeEntry'
+        index_together = [('tguser', 'board_id', 'list_id', 'card_id', 'date'), ('tguser', 'date')]
+
+    @classmethod
+    def get_entry(cls, timer: Timer, stopped_at) -> 'TimeEntry':
+        return cls(
+            tguser=timer.tguser,
+            board_id=timer.board_id,
+            list_id=timer.list_id,
+            card_id=timer.card_id,
+            date=timezone.localtime(timer.created_at).date(),
+            started_at=timer.created_at,
+            stopped_at=stopped_at,
+            seconds=int((stopped_at - timer.created_at).total_seconds()),
+        )
+
+    @classmethod
+    def log(cls, timer: Timer, stopped_at=None) -> 'TimeEntry':
+        entry = cls.get_entry(timer, stopped_at or timezone.now())
+        entry.save()
+        TimeRollup.add(entry)
+        return entry
+
+
+class TimeRollup(models.Model):
+    """
+    Sum of TimeEntry per user, board and day or week, updated on every stop. Weeks start on Monday.
+    """
+    PERIOD_DAY = 'day'
+    PERIOD_WEEK = 'week'
+    PERIODS = (
+        (PERIOD_DAY, 'Day'),
+        (PERIOD_WEEK, 'Week'),
+    )
+
+    tguser = models.ForeignKey(verbose_name=TgUser.verbose_name(), to=TgUser)
+    period = models.CharField(max_length=4, choices=PERIODS)
+    period_start = models.DateField()
+    board_id = models.CharField(max_length=50)
+    seconds = models.PositiveIntegerField(default=0)
+    entries = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = verbose_name = 'TimeRollup'
+        unique_together = [('tguser', 'period', 'period_start', 'board_id')]
+
+    @classmethod
+    def get_period_start(cls, period: str, date):
+        if period == cls.PERIOD_WEEK:
+            return date - timedelta(days=date.weekday())
+        return date
+
+    @classmethod
+    def add(cls, entry: TimeEntry):
+        cls.increment(entry.tguser_id, entry.board_id, entry.date, entry.seconds, 1)
+
+    @classmethod
+    def add_many(cls, entries: list):
+        """
+        One increment per user, board and day of the entries, not per entry.
+        """
+        groups = {}
+        for entry in entries:
+            key = (entry.tguser_id, entry.board_id, entry.date)
+            seconds, count = groups.get(key, (0, 0))
+            groups[key] = (seconds + entry.seconds, count + 1)
+        for (tguser_id, board_id, date), (seconds, count) in groups.items():
+            cls.increment(tguser_id, board_id, date, seconds, count)
+
+    @classmethod
+    def increment(cls, tguser_id: int, board_id: str, date, seconds: int, entries: int):
+        for period, _ in cls.PERIODS:
+            lookup = dict(tguser_id=tguser_id, period=period, period_start=cls.get_period_start(period, date), board_id=board_id)
+            increment = dict(seconds=models.F('seconds') + seconds, entries=models.F('entries') + entries)
+            if cls.objects.filter(**lookup).update(**increment):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(seconds=seconds, entries=entries, **lookup)
+            except IntegrityError:
+                # created by a concurrent stop
+                cls.objects.filter(**lookup).update(**increment)
+
+    @staticmethod
+    def get_today():
+        return timezone.localtime(timezone.now()).date()
+
+    @classmethod
+    def get_report(cls, tguser: TgUser, period: str, date=None) -> list:
+        """
+        Rollups of the period containing `date` (today by default), the longest first.
+        """
+        date = date or cls.get_today()
+        return list(cls.objects.filter(tguser=tguser, period=period, period_start=cls.get_period_start(period, date)).order_by('-seconds'))
+
+
+class TrelloBoard(models.Model):
+    """
+    Mirror of a Trello board (bot.mirror). Primary keys of mirrored objects are Trello ids.
+    """
+    id = models.CharField(max_length=50, primary_key=True)
+    name = models.TextField()  # up to 16384 characters in Trello
+    closed = models.BooleanField(default=False)
+    tgusers = models.ManyToManyField(TgUser, related_name='trello_boards', blank=True)
+    webhook_id = models.CharField(max_length=50, blank=True, default='')
+    since = models.CharField(max_length=30, blank=True, default='')  # date of the last mirrored action
+    changed_at = models.DateTimeField(null=True, blank=True)  # by a webhook callback
+    synced_at = models.DateTimeField(null=True, blank=True)
+    full_synced_at = models.DateTimeField(null=True, blank=True)  # mirrored entirely, not by delta
+
+    class Meta:
+        verbose_name_plural = verbose_name = 'TrelloBoard'
+
+    def __str__(self):
+        return self.name
+
+
+class TrelloList(models.Model):
+    id = models.CharField(max_length=50, primary_key=True)
+    board = models.ForeignKey(TrelloBoard, related_name='lists')
+    name = models.TextField()  # up to 16384 characters in Trello
+    closed = models.BooleanField(default=False)
+    pos = models.FloatField(default=0)
+
+    class Meta:
+        verbose_name_plural = verbose_name = 'TrelloList'
+        ordering = ['pos']
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def idBoard(self) -> str:
+        return self.board_id
+
+
+class TrelloCard(models.Model):
+    id = models.CharField(max_length=50, primary_key=True)
+    board = models.ForeignKey(TrelloBoard, related_name='cards')
+    list = models.ForeignKey(TrelloList, related_name='cards')
+    name = models.TextField()  # up to 16384 characters in Trello
+    desc = models.TextField(blank=True, default='')
+    due = models.CharField(max_length=30, blank=True, default='')
+    short_url = models.CharField(max_length=255, blank=True, default='')
+    closed = models.BooleanField(default=False)
+    pos = models.FloatField(default=0)
+
+    class Meta:
+        verbose_name_plural = verbose_name = 'TrelloCard'
+        ordering = ['pos']
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def idBoard(self) -> str:
+        return self.board_id
+
+    @property
+    def idList(self) -> str:
+        return self.list_id
+
+    @property
+    def data(self) -> dict:
+        """
+        The card in Trello JSON format, as trolly.Card.data.
+        """
+        return dict(id=self.id, name=self.name, desc=self.desc, due=self.due or None, shortUrl=self.short_url, idList=self.list_id, idBoard=self.board_id)
+
+
+class OutgoingMessage(MyModel):
+    """
+    Telegram API request queued to be sent by `send_outbox` workers instead of being sent inside the webhook request.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUSES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    chat_id = models.BigIntegerField(db_index=True)
+    method = models.CharField(max_length=50)
+    args = models.TextField(default='[]')
+    kwargs = models.TextField(default='{}')
+    status = models.CharField(max_length=10, choices=STATUSES, default=STATUS_PENDING)
+    attempts = models.IntegerField(default=0)
+    not_before = models.DateTimeField(default=timezone.now)
+    error = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = verbose_name = 'OutgoingMessage'
+        index_together = [('status', 'not_before')]
+
+    def __str__(self):
+        return '%s to %d (%s)' % (self.method, self.chat_id, self.status)
+
+    @classmethod
+    def enqueue(cls, chat_id: int, method_name: str, *args, delay: int = 0, **kwargs):
+        if method_name not in OUTBOX_METHODS:
+            raise Exception('%s cannot be sent through outbox' % method_name)
+        for key, value in kwargs.items():
+            if hasattr(value, 'to_json'):
+                kwargs[key] = value.to_json()
+        return cls.objects.create(
+            chat_id=chat_id,
+            method=method_name,
+            args=json.dumps(args, ensure_ascii=False),
+            kwargs=json.dumps(kwargs, ensure_ascii=False),
+            not_before=timezone.now() + timedelta(seconds=delay),
+        )
+
+    def get_args(self) -> list:
+        return json.loads(self.args)
+
+    def get_kwargs(self) -> dict:
+        return json.loads(self.kwargs)
+
+
+class Broadcast(MyModel):
+    """
+    Progress of `broadcast` command. Users are processed in id order, so `last_tguser_id` is enough to resume a run.
+    """
+    text = models.TextField()
+    last_tguser_id = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    sent = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    deactivated = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = verbose_name = 'Broadcast'
+
+    def __str__(self):
+        return '%d: %d sent, %d failed, %d deactivated' % (self.id or 0, self.sent, self.failed, self.deactivated)
+
+
+class IncomingUpdate(MyModel):
+    """
+    Webhook update stored for `process_updates` workers when TELEGRAM_INGEST_MODE is 'queue'.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUSES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+    UPDATE_TYPES = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'inline_query', 'chosen_inline_result', 'callback_query')
+
+    update_id = models.BigIntegerField(unique=True)
+    tg_id = models.BigIntegerField(default=0)
+    body = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUSES, default=STATUS_PENDING)
+    error = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = verbose_name = 'IncomingUpdate'
+        index_together = [('status', 'tg_id')]
+
+    def __str__(self):
+        return '%d from %d (%s)' % (self.update_id, self.tg_id, self.status)
+
+    @classmethod
+    def get_tg_id(cls, data: dict) -> int:
+        """
+        Id of the user (or the chat for channel posts) the update belongs to. Updates are processed in order per this id.
+        """
+        for update_type in cls.UPDATE_TYPES:
+            obj = data.get(update_type)
+            if obj:
+                return (obj.get('from') or obj.get('chat') or {}).get('id', 0)
+        return 0
@@ -0,0 +1,298 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from json import JSONDecodeError
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from requests import RequestException
+from telebot.apihelper import ApiException
+
+from bot.models import OutgoingMessage, TgUser, TgChat, tguser_cache, tgchat_cache
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket: `rate` tokens per second, at most `capacity` tokens at once.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def consume(self, tokens: float = 1) -> float:
+        """
+        Takes tokens if there are enough of them. Returns 0 on success or seconds to wait otherwise.
+        """
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def wait(self, tokens: float = 1, stop_event: threading.Event = None) -> bool:
+        while True:
+            delay = self.consume(tokens)
+            if not delay:
+                return True
+            if stop_event:
+                if stop_event.wait(delay):
+                    return False
+            else:
+                time.sleep(delay)
+
+    def pause(self, seconds: float):
+        """
+        Empties the bucket so that the next token appears not earlier than in `seconds` (used on HTTP 429).
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class ChatBuckets(object):
+    """
+    Per chat token buckets. Least recently used buckets are dropped when there are more than `size` of them.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_rate(chat_id: int) -> float:
+        if chat_id < 0:
+            return settings.TELEGRAM_GROUP_RATE_LIMIT
+        return settings.TELEGRAM_CHAT_RATE_LIMIT
+
+    def get(self, chat_id: int) -> TokenBucket:
+        with self.lock:
+            bucket = self.buckets.pop(chat_id, None)
+            if bucket is None:
+                bucket = TokenBucket(self.get_rate(chat_id), 1)
+            self.buckets[chat_id] = bucket
+            while len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+            return bucket
+
+
+def get_api_error(e: ApiException) -> (str, dict):
+    try:
+        json_data = e.result.json()
+    except (JSONDecodeError, ValueError):
+        return str(e.result.content), {}
+    return str(json_data.get('description', '')), json_data.get('parameters') or {}
+
+
+def deactivate_chat(chat_id: int):
+    model, cache = (TgChat, tgchat_cache) if chat_id < 0 else (TgUser, tguser_cache)
+    model.objects.filter(tg_id=chat_id).update(active=False)
+    cache.invalidate(chat_id)
+
+
+class Outbox(object):
+    """
+    Sends OutgoingMessage queue with a pool of worker threads.
+    Messages of one chat are always handled by the same worker in the order of their ids.
+    Requests are throttled by global and per chat token buckets, HTTP 429 postpones the message by `retry_after`.
+    """
+    stale_after = timedelta(minutes=5)
+
+    def __init__(self, workers: int = None, batch_size: int = 500, poll_interval: float = 0.5, tgbot=None):
+        if tgbot is None:
+            from bot.handlers import tgbot
+        self.tgbot = tgbot
+        self.workers = workers or settings.TELEGRAM_OUTBOX_WORKERS
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.global_bucket = TokenBucket(settings.TELEGRAM_GLOBAL_RATE_LIMIT)
+        self.chat_buckets = ChatBuckets()
+        self.queues = [queue.Queue() for _ in range(self.workers)]
+        self.in_flight = {}  # chat_id -> number of claimed messages
+        self.postponed = {}  # chat_id -> time.monotonic() until the chat is postponed by HTTP 429
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.stats = dict(sent=0, retried=0, failed=0, deactivated=0)
+
+    def reset_stale(self):
+        OutgoingMessage.objects.filter(
+            status=OutgoingMessage.STATUS_SENDING,
+            not_before__lt=timezone.now() - self.stale_after,
+        ).update(status=OutgoingMessage.STATUS_PENDING)
+
+    def claim(self) -> list:
+        """
+        Marks the next pending messages as sending, one by one: only messages this process won are returned.
+        A chat is skipped entirely while it has a postponed or an in flight message.
+        """
+        now = timezone.now()
+        with self.lock:
+            blocked = set(self.in_flight)
+        table = OutgoingMessage._meta.db_table
+        pending = (
+            OutgoingMessage.objects
+            .filter(status=OutgoingMessage.STATUS_PENDING)
+            .exclude(chat_id__in=list(blocked))
+            # a message waits while it or an earlier one of its chat is postponed
+            .extra(where=[
+                'NOT EXISTS (SELECT 1 FROM {table} AS earlier WHERE earlier.chat_id = {table}.chat_id '
+                'AND earlier.status = %s AND earlier.not_before > %s AND earlier.id <= {table}.id)'.format(table=table)
+            ], params=[OutgoingMessage.STATUS_PENDING, now])
+            .order_by('id')[:self.batch_size]
+        )
+        claimed = []
+        for message in pending:
+            if message.chat_id in blocked:
+                continue
+            won = OutgoingMessage.objects.filter(id=message.id, status=OutgoingMessage.STATUS_PENDING).update(
+                status=OutgoingMessage.STATUS_SENDING,
+                not_before=now,
+            )
+            if not won:
+                # claimed by another process, later messages of the chat must wait for it
+                blocked.add(message.chat_id)
+                continue
+            message.status = OutgoingMessage.STATUS_SENDING
+            message.not_before = now
+            claimed.append(message)
+        with self.lock:
+            for message in claimed:
+                self.in_flight[message.chat_id] = self.in_flight.get(message.chat_id, 0) + 1
+        return claimed
+
+    def count(self, key: str):
+        with self.lock:
+            self.stats[key] += 1
+
+    def get_postponed(self, chat_id: int) -> float:
+        with self.lock:
+            delay = self.postponed.get(chat_id, 0) - time.monotonic()
+            if delay <= 0:
+                self.postponed.pop(chat_id, None)
+                return 0
+            return delay
+
+    def finish(self, message: OutgoingMessage, status: str, error='', delay=0):
+        message.status = status
+        message.error = error[:255]
+        update_fields = ['status', 'error', 'attempts']
+        if status == OutgoingMessage.STATUS_SENT:
+            message.sent_at = timezone.now()
+            update_fields.append('sent_at')
+        elif status == OutgoingMessage.STATUS_PENDING:
+            message.not_before = timezone.now() + timedelta(seconds=delay)
+            update_fields.append('not_before')
+        message.save(update_fields=update_fields)
+
+    def send(self, message: OutgoingMessage):
+        delay = self.get_postponed(message.chat_id)
+        if delay:
+            # keep messages of the chat in order: an earlier one is waiting for retry
+            self.finish(message, OutgoingMessage.STATUS_PENDING, delay=delay)
+            return
+        chat_bucket = self.chat_buckets.get(message.chat_id)
+        if not chat_bucket.wait(stop_event=self.stop_event) or not self.global_bucket.wait(stop_event=self.stop_event):
+            self.finish(message, OutgoingMessage.STATUS_PENDING)
+            return
+        message.attempts += 1
+        try:
+            getattr(self.tgbot, message.method)(*message.get_args(), **message.get_kwargs())
+        except ApiException as e:
+            description, parameters = get_api_error(e)
+            status_code = e.result.status_code
+            if description in ('Bad Request: QUERY_ID_INVALID', 'Bad Request: message is not modified'):
+                self.finish(message, OutgoingMessage.STATUS_SENT, description)
+            elif status_code == 429:
+                retry_after = parameters.get('retry_after', 1)
+                chat_bucket.pause(retry_after)
+                self.postpone(message, description, retry_after)
+            elif status_code == 403 or (status_code == 400 and description == 'Bad Request: chat not found'):
+                deactivate_chat(message.chat_id)
+                self.count('deactivated')
+                self.finish(message, OutgoingMessage.STATUS_FAILED, description)
+            else:
+                self.retry_or_fail(message, description)
+        except RequestException as e:
+            self.retry_or_fail(message, str(e))
+        else:
+            self.count('sent')
+            self.finish(message, OutgoingMessage.STATUS_SENT)
+
+    def retry_or_fail(self, message: OutgoingMessage, error: str):
+        logger.warning('OutgoingMessage %d: %s', message.id, error)
+        if message.attempts >= settings.TELEGRAM_OUTBOX_MAX_ATTEMPTS:
+            self.count('failed')
+            self.finish(message, OutgoingMessage.STATUS_FAILED, error)
+        else:
+            self.postpone(message, error, 2 ** message.attempts)
+
+    def postpone(self, message: OutgoingMessage, error: str, delay: float):
+        with self.lock:
+            self.postponed[message.chat_id] = time.monotonic() + delay
+        self.count('retried')
+        self.finish(message, OutgoingMessage.STATUS_PENDING, error, delay=delay)
+
+    def worker(self, index: int):
+        q = self.queues[index]
+        try:
+            while not (self.stop_event.is_set() and q.empty()):
+                try:
+                    message = q.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    continue
+                try:
+                    if self.stop_event.is_set():
+                        self.finish(message, OutgoingMessage.STATUS_PENDING)
+                    else:
+                        self.send(message)
+                except Exception as e:
+                    logger.exception(e)
+                finally:
+                    with self.lock:
+                        self.in_flight[message.chat_id] -= 1
+                        if not self.in_flight[message.chat_id]:
+                            del self.in_flight[message.chat_id]
+        finally:
+            connection.close()
+
+    def start(self):
+        self.reset_stale()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.worker, args=(index,), name='OutboxWorker-%d' % index, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        self.start()
+        try:
+            while not self.stop_event.is_set():
+                claimed = self.claim()
+                for message in claimed:
+                    self.queues[message.chat_id % self.workers].put(message)
+                if len(claimed) < self.batch_size:
+                    self.stop_event.wait(self.poll_interval)
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
@@ -0,0 +1,126 @@
+"""
+Pages of Boards, Lists and Cards menus: a keyboard shows at most KEYBOARD_PAGE_SIZE items and page buttons,
+so its size doesn't depend on the size of a board.
+A page is one slice of the mirror (bot.mirror) cached by the mirror version of its items, the next page is read
+ahead in a background thread while the user looks at the current one.
+"""
+import logging
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, DatabaseError
+
+from base import utils as base_utils
+
+logger = logging.getLogger(__name__)
+
+PageItem = namedtuple('PageItem', ('id', 'name'))
+
+
+class Page(object):
+    __slots__ = ('items', 'number', 'has_next')
+
+    def __init__(self, items: list, number: int, has_next: bool):
+        self.items = items
+        self.number = number
+        self.has_next = has_next
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_previous(self) -> bool:
+        return self.number > 0
+
+
+class Paginator(object):
+    def __init__(self, page_size: int = None, workers: int = None):
+        self.page_size = page_size or settings.KEYBOARD_PAGE_SIZE
+        self.workers = workers or settings.KEYBOARD_PREFETCH_WORKERS
+        self.cache = base_utils.TTLCache(settings.KEYBOARD_PAGE_CACHE_SIZE, settings.KEYBOARD_CACHE_TTL)
+        self.lock = threading.Lock()
+        self.pending = set()  # cache keys being read ahead
+        self.executor = None
+        self.pid = None
+        self.stats = dict(hits=0, misses=0, prefetched=0, failed=0)
+
+    @property
+    def is_sync(self) -> bool:
+        return settings.TESTING or not settings.KEYBOARD_PREFETCH
+
+    def count(self, key: str):
+        with self.lock:
+            self.stats[key] += 1
+
+    @staticmethod
+    def get_cache_key(key: str, version, number: int) -> str:
+        return '%s:%s:%d' % (key, version, number)
+
+    def load(self, queryset, cache_key: str, number: int) -> Page:
+        """
+        Reads the page and the first item of the next one to know if it exists, no COUNT query.
+        """
+        offset = number * self.page_size
+        rows = list(queryset.values_list('id', 'name')[offset:offset + self.page_size + 1])
+        page = Page([PageItem(*row) for row in rows[:self.page_size]], number, len(rows) > self.page_size)
+        self.cache.set(cache_key, page)
+        return page
+
+    def get_page(self, queryset, key: str, version, number: int = 0) -> Page:
+        """
+        `key` identifies the queryset, `version` changes with its items (the time the mirror was synced).
+        """
+        number = max(number, 0)
+        cache_key = self.get_cache_key(key, version, number)
+        page = self.cache.get(cache_key)
+        if page is None:
+            self.count('misses')
+            page = self.load(queryset, cache_key, number)
+        else:
+            self.count('hits')
+        if not page.items and number:
+            # items were removed since the page button was shown
+            return self.get_page(queryset, key, version)
+        if page.has_next:
+            self.prefetch(queryset, key, version, number + 1)
+        return page
+
+    def prefetch(self, queryset, key: str, version, number: int):
+        if self.is_sync:
+            return
+        cache_key = self.get_cache_key(key, version, number)
+        with self.lock:
+            if cache_key in self.pending or self.cache.get(cache_key) is not None:
+                return
+            self.pending.add(cache_key)
+        self.get_executor().submit(self.read_ahead, queryset, cache_key, number)
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                # a forked worker doesn't inherit the threads of its parent
+                self.pid = os.getpid()
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    def read_ahead(self, queryset, cache_key: str, number: int):
+        try:
+            self.load(queryset.all(), cache_key, number)
+        except DatabaseError as e:
+            logger.warning('Page %s was not read ahead: %s', cache_key, e)
+            self.count('failed')
+        else:
+            self.count('prefetched')
+        finally:
+            with self.lock:
+                self.pending.discard(cache_key)
+            connection.close()
+
+
+paginator = Paginator()
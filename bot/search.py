@@ -0,0 +1,127 @@
+"""
+Fuzzy search of cards by name and description across the boards of a user, free text in a private chat is a query.
+Cards are read from the mirror (bot.mirror) into a trigram index per board: boards are shared by users, so one segment
+serves all members. A segment is rebuilt only when its board was synced again, least recently used segments are evicted.
+"""
+import heapq
+import re
+import threading
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+
+from base import utils as base_utils
+from bot.models import TgUser, TrelloCard
+
+WORD_RE = re.compile(r'\w+')
+
+CardItem = namedtuple('CardItem', ('id', 'name', 'list_name', 'board_id', 'list_id'))
+Match = namedtuple('Match', ('score', 'card'))
+
+
+def normalize(text: str) -> list:
+    return WORD_RE.findall(text.lower())
+
+
+def get_trigrams(text: str) -> set:
+    """
+    Trigrams of words padded like in pg_trgm: two spaces before and one after, so short words and prefixes match too.
+    """
+    trigrams = set()
+    for word in normalize(text):
+        word = '  %s ' % word
+        trigrams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return trigrams
+
+
+class Segment(object):
+    """
+    Trigram index of open cards of one board.
+    """
+    __slots__ = ('version', 'cards', 'names', 'descs')
+
+    def __init__(self, version):
+        self.version = version
+        self.cards = {}  # card id -> CardItem
+        self.names = defaultdict(set)  # trigram -> card ids
+        self.descs = defaultdict(set)
+
+    def add(self, card: CardItem, desc: str):
+        self.cards[card.id] = card
+        for trigram in get_trigrams(card.name):
+            self.names[trigram].add(card.id)
+        for trigram in get_trigrams(desc[:settings.SEARCH_DESC_LENGTH]):
+            self.descs[trigram].add(card.id)
+
+    def score(self, trigrams: set) -> dict:
+        """
+        {card id: share of the query trigrams found}, matches in descriptions weigh less than in names.
+        """
+        names, descs = defaultdict(int), defaultdict(int)
+        for trigram in trigrams:
+            for card_id in self.names.get(trigram, ()):
+                names[card_id] += 1
+            for card_id in self.descs.get(trigram, ()):
+                descs[card_id] += 1
+        scores = {}
+        for card_id in set(names) | set(descs):
+            scores[card_id] = max(names[card_id], descs[card_id] * settings.SEARCH_DESC_WEIGHT) / len(trigrams)
+        return scores
+
+
+class SearchIndex(object):
+    def __init__(self, size: int = None):
+        # board id -> Segment, no time to live: a segment is checked against the mirror on every query
+        self.segments = base_utils.TTLCache(size or settings.SEARCH_INDEX_SIZE, ttl=0)
+        self.lock = threading.Lock()
+        self.stats = dict(queries=0, built=0, reused=0)
+
+    def count(self, key: str, value: int = 1):
+        with self.lock:
+            self.stats[key] += value
+
+    def build(self, versions: dict) -> dict:
+        """
+        Segments of the boards {board id: synced_at} by one query.
+        """
+        segments = {board_id: Segment(version) for board_id, version in versions.items()}
+        cards = TrelloCard.objects.filter(board_id__in=list(versions), closed=False, list__closed=False)
+        for row in cards.values_list('id', 'name', 'list__name', 'board_id', 'list_id', 'desc'):
+            segments[row[3]].add(CardItem(*row[:5]), row[5])
+        for board_id, segment in segments.items():
+            self.segments.set(board_id, segment)
+        self.count('built', len(segments))
+        return segments
+
+    def get_segments(self, tguser: TgUser) -> list:
+        versions = dict(tguser.trello_boards.filter(closed=False).values_list('id', 'synced_at'))
+        segments, stale = [], {}
+        for board_id, version in versions.items():
+            segment = self.segments.get(board_id)
+            if segment is None or segment.version != version:
+                stale[board_id] = version
+            else:
+                segments.append(segment)
+        self.count('reused', len(segments))
+        if stale:
+            segments.extend(self.build(stale).values())
+        return segments
+
+    def search(self, tguser: TgUser, query: str, limit: int = None) -> list:
+        """
+        Best matches first: [Match(score, CardItem)].
+        """
+        self.count('queries')
+        trigrams = get_trigrams(query)
+        if not trigrams:
+            return []
+        matches = []
+        for segment in self.get_segments(tguser):
+            for card_id, score in segment.score(trigrams).items():
+                if score >= settings.SEARCH_MIN_SCORE:
+                    matches.append(Match(score, segment.cards[card_id]))
+        # shorter names are closer to the query when scores are equal
+        return heapq.nlargest(limit or settings.SEARCH_RESULTS, matches, key=lambda match: (match.score, -len(match.card.name)))
+
+
+search_index = SearchIndex()
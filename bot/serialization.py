@@ -0,0 +1,82 @@
+"""
+Serialization of Telegram objects for storage and logs.
+Objects created from a webhook request remember the request body, so it is stored as is instead of being encoded again.
+"""
+import json
+import weakref
+
+from django.core.serializers.json import DjangoJSONEncoder
+from telebot.types import Update
+
+_raw_payloads = weakref.WeakKeyDictionary()
+
+
+def set_raw(obj, raw: str):
+    """
+    Remembers `raw` JSON text of the update `obj` was created from.
+    """
+    _raw_payloads[obj] = raw
+
+
+def get_raw(obj) -> str or None:
+    try:
+        return _raw_payloads.get(obj)
+    except TypeError:
+        # not weak referenceable
+        return None
+
+
+def parse_update(raw: str, data: dict = None) -> Update:
+    """
+    Update from the webhook body. `raw` is kept for TgMessage.message, `data` is json.loads(raw) if already parsed.
+    """
+    if data is None:
+        data = json.loads(raw)
+    update = Update.de_json(data)
+    set_raw(update, raw)
+    for obj in (update.message, update.callback_query):
+        if obj is not None:
+            set_raw(obj, raw)
+    return update
+
+
+def to_plain(o):
+    """
+    Iterative base_utils.get_dict: objects and dicts become dicts without None values, at any depth.
+    """
+    if not (hasattr(o, '__dict__') or isinstance(o, (dict, list, tuple))):
+        return o
+    root = []
+    stack = [(o, root, 0)]
+    root.append(None)
+    while stack:
+        value, parent, key = stack.pop()
+        if isinstance(value, (list, tuple)):
+            result = [None] * len(value)
+            items = enumerate(value)
+            skip_none = False
+        else:
+            result = {}
+            items = (value if isinstance(value, dict) else value.__dict__).items()
+            skip_none = True
+        parent[key] = result
+        for k, v in items:
+            if v is None and skip_none:
+                continue
+            if hasattr(v, '__dict__') or isinstance(v, (dict, list, tuple)):
+                if isinstance(result, dict):
+                    result[k] = None
+                stack.append((v, result, k))
+            else:
+                result[k] = v
+    return root[0]
+
+
+def dumps(o) -> str:
+    """
+    Compact JSON: the raw update for objects from a webhook request, otherwise the encoded to_plain(o).
+    """
+    raw = get_raw(o)
+    if raw is not None:
+        return raw
+    return json.dumps(to_plain(o), cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':'))
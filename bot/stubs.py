@@ -0,0 +1,288 @@
+"""
+Local HTTP servers that stand in for external APIs in dry runs and benchmarks.
+"""
+import json
+import socketserver
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubServer(object):
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    @property
+    def total_calls(self) -> int:
+        with self.lock:
+            return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def handle(self, method: str, path: str, params: dict, body: bytes) -> (int, object):
+        raise NotImplementedError
+
+    def dispatch(self, method: str, path: str, params: dict, body: bytes) -> (int, object):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.handle(method, path, params, body)
+
+    def count(self, name: str):
+        with self.lock:
+            self.calls[name] += 1
+
+    def get_handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def process(self, method):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                if body and self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+                status, data = server.dispatch(method, url.path, params, body)
+                content = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.process('GET')
+
+            def do_POST(self):
+                self.process('POST')
+
+            def do_PUT(self):
+                self.process('PUT')
+
+            def do_DELETE(self):
+                self.process('DELETE')
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.get_handler_class())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name=self.__class__.__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class TelegramStubServer(StubServer):
+    """
+    Answers every Bot API method with a successful result. Chats from `blocked_chat_ids` get HTTP 403.
+    """
+
+    def __init__(self, latency: float = 0.0, blocked_chat_ids=()):
+        super().__init__(latency)
+        self.blocked_chat_ids = set(blocked_chat_ids)
+        self.message_id = 0
+
+    def handle(self, method: str, path: str, params: dict, body: bytes) -> (int, object):
+        api_method = path.rsplit('/', 1)[-1]
+        self.count(api_method)
+        chat_id = int(params.get('chat_id') or 0)
+        if chat_id in self.blocked_chat_ids:
+            return 403, dict(ok=False, error_code=403, description='Forbidden: bot was blocked by the user')
+        if api_method == 'answerCallbackQuery' or not chat_id:
+            return 200, dict(ok=True, result=True)
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        result = dict(
+            message_id=int(params.get('message_id') or message_id),
+            date=int(time.time()),
+            chat=dict(id=chat_id, type='private' if chat_id > 0 else 'group'),
+            text=params.get('text', ''),
+        )
+        return 200, dict(ok=True, result=result)
+
+    @contextmanager
+    def patch(self):
+        """
+        Points pyTelegramBotAPI to the stub server.
+        """
+        from telebot import apihelper
+        defaults = apihelper._make_request.__defaults__
+        apihelper._make_request.__defaults__ = defaults[:-1] + (self.url + '/bot{0}/{1}',)
+        try:
+            yield self
+        finally:
+            apihelper._make_request.__defaults__ = defaults
+
+
+class TrelloStubServer(StubServer):
+    """
+    In-memory Trello with the requests used by TrelloClient and bot.mirror.
+    Changes made with add_* and update_card are recorded as board actions, as Trello does.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.boards = OrderedDict()
+        self.lists = OrderedDict()
+        self.cards = OrderedDict()
+        self.actions = []  # oldest first
+        self.webhooks = []
+        self.last_id = 0
+        self.last_date = 0
+
+    def new_id(self) -> str:
+        with self.lock:
+            self.last_id += 1
+            return '%024x' % self.last_id
+
+    def new_date(self) -> str:
+        with self.lock:
+            # unique and increasing, as `since` cursors need
+            self.last_date = max(int(time.time() * 1000), self.last_date + 1)
+            date = self.last_date
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(date / 1000)) + '.%03dZ' % (date % 1000)
+
+    def add_action(self, action_type: str, board_id: str, **data):
+        data['board'] = dict(id=board_id, name=self.boards[board_id]['name'])
+        self.actions.append(dict(id=self.new_id(), type=action_type, date=self.new_date(), data=data))
+
+    def add_board(self, name: str) -> str:
+        board_id = self.new_id()
+        self.boards[board_id] = dict(id=board_id, name=name, closed=False)
+        self.add_action('createBoard', board_id)
+        return board_id
+
+    def add_list(self, board_id: str, name: str) -> str:
+        list_id = self.new_id()
+        self.lists[list_id] = dict(id=list_id, name=name, closed=False, pos=len(self.lists) + 1, idBoard=board_id)
+        self.add_action('createList', board_id, list=dict(id=list_id, name=name))
+        return list_id
+
+    def add_card(self, list_id: str, name: str, **fields) -> str:
+        card_id = self.new_id()
+        board_id = self.lists[list_id]['idBoard']
+        self.cards[card_id] = dict(dict(
+            id=card_id, name=name, desc='', due=None, shortUrl='https://trello.com/c/%s' % card_id[-8:],
+            closed=False, pos=len(self.cards) + 1, idList=list_id, idBoard=board_id,
+        ), **fields)
+        self.add_action('createCard', board_id, card=dict(id=card_id, name=name), list=dict(id=list_id))
+        return card_id
+
+    def update_card(self, card_id: str, **fields):
+        card = self.cards[card_id]
+        data = dict(card=dict(id=card_id, name=card['name']), old={key: card.get(key) for key in fields})
+        if 'idList' in fields:
+            data.update(listBefore=dict(id=card['idList']), listAfter=dict(id=fields['idList']))
+        card.update(fields)
+        self.add_action('updateCard', card['idBoard'], **data)
+
+    def delete_card(self, card_id: str):
+        card = self.cards.pop(card_id)
+        self.add_action('deleteCard', card['idBoard'], card=dict(id=card_id), list=dict(id=card['idList']))
+
+    @staticmethod
+    def pick(obj: dict, fields: str or None) -> dict:
+        if not fields or fields == 'all':
+            return dict(obj)
+        return dict({key: obj[key] for key in fields.split(',') if key in obj}, id=obj['id'])
+
+    def get_actions(self, board_id: str, params: dict, limit_key: str = 'limit') -> list:
+        actions = [action for action in reversed(self.actions) if action['data']['board']['id'] == board_id]
+        if params.get('since'):
+            actions = [action for action in actions if action['date'] > params['since']]
+        return actions[:int(params.get(limit_key) or 50)]
+
+    def get(self, path: str, params: dict) -> (int, object):
+        parts = path.strip('/').split('/')
+        if parts == ['members', 'me', 'boards']:
+            return 200, [self.pick(board, params.get('fields')) for board in self.boards.values()]
+        if len(parts) < 2:
+            return 404, 'The requested resource was not found.'
+        collection = dict(boards=self.boards, lists=self.lists, cards=self.cards).get(parts[0], {})
+        obj = collection.get(parts[1])
+        if obj is None:
+            return 404, 'The requested resource was not found.'
+        if len(parts) == 2:
+            result = self.pick(obj, params.get('fields'))
+            if parts[0] == 'boards':
+                if params.get('lists'):
+                    result['lists'] = [self.pick(item, params.get('list_fields')) for item in self.lists.values() if item['idBoard'] == obj['id']]
+                if params.get('cards'):
+                    result['cards'] = [self.pick(item, params.get('card_fields')) for item in self.cards.values() if item['idBoard'] == obj['id']]
+                if params.get('actions'):
+                    result['actions'] = self.get_actions(obj['id'], params, 'actions_limit')
+            return 200, result
+        if parts[0] == 'boards' and parts[2] == 'actions':
+            return 200, self.get_actions(obj['id'], params)
+        if parts[2] == 'lists':
+            return 200, [item for item in self.lists.values() if item['idBoard'] == obj['id']]
+        if parts[2] == 'cards':
+            key = 'idBoard' if parts[0] == 'boards' else 'idList'
+            return 200, [item for item in self.cards.values() if item[key] == obj['id']]
+        return 404, 'The requested resource was not found.'
+
+    def handle(self, method: str, path: str, params: dict, body: bytes) -> (int, object):
+        path = path[len('/1'):] if path.startswith('/1/') else path
+        self.count('%s %s' % (method, '/'.join(path.split('/')[:2])))
+        if method == 'GET' and path == '/batch':
+            results = []
+            for url in params.get('urls', '').split(','):
+                status, result = self.get(url, {})
+                results.append({str(status): result} if status == 200 else dict(statusCode=status, message=result))
+            return 200, results
+        if method == 'GET':
+            return self.get(path, params)
+        if method == 'POST' and path == '/webhooks':
+            webhook = dict(id=self.new_id(), callbackURL=params.get('callbackURL'), idModel=params.get('idModel'), active=True)
+            self.webhooks.append(webhook)
+            return 200, webhook
+        if method == 'POST' and path.endswith('/actions/comments'):
+            card = self.cards.get(path.split('/')[2])
+            if card is None:
+                return 404, 'The requested resource was not found.'
+            self.add_action('commentCard', card['idBoard'], card=dict(id=card['id']), text=params.get('text', ''))
+            return 200, self.actions[-1]
+        return 404, 'The requested resource was not found.'
+
+    @contextmanager
+    def patch(self):
+        """
+        Points TrelloClient and bot.aio to the stub server.
+        """
+        from django.test.utils import override_settings
+        with override_settings(TRELLO_API_URL=self.url + '/1'):
+            yield self
@@ -0,0 +1,50 @@
+"""
+pytest-benchmark cases of the webhook: the scenarios and stub servers of ./manage.py bench_webhook, one case per update.
+Save a baseline with `pytest bot/tests --benchmark-autosave`, check a change with `--benchmark-compare`.
+"""
+import random
+
+import pytest
+
+from bot.management.commands.bench_webhook import Scenario
+from bot.stubs import TelegramStubServer, TrelloStubServer
+
+TG_ID = 1000
+
+
+@pytest.fixture
+def scenario(db, settings):
+    random.seed(0)
+    settings.TESTING = True
+    settings.TELEGRAM_INGEST_MODE = 'inline'
+    settings.TELEGRAM_RESPONSE_ERROR_ON_EXCEPTION = True
+    settings.ALLOWED_HOSTS = ['testserver']
+    with TelegramStubServer() as telegram, telegram.patch(), TrelloStubServer() as trello, trello.patch():
+        scenario = Scenario(trello, boards=3, lists=5, cards=30)
+        scenario.add_users([TG_ID])
+        yield scenario
+
+
+@pytest.mark.parametrize('kind', Scenario.KINDS)
+def test_update(benchmark, scenario, kind):
+    rest = []
+
+    def setup():
+        # the round is posted around the measured update, so every round starts with no timer
+        for update in rest:
+            scenario.post(update)
+        updates = scenario.get_round(TG_ID)
+        index = [item[0] for item in updates].index(kind)
+        for _, update in updates[:index]:
+            scenario.post(update)
+        rest[:] = [update for _, update in updates[index + 1:]]
+        return (updates[index][1],), {}
+
+    assert benchmark.pedantic(scenario.post, setup=setup, rounds=20) == 200
+
+
+def test_round(benchmark, scenario):
+    def post_round():
+        return [scenario.post(update) for _, update in scenario.get_round(TG_ID)]
+
+    assert set(benchmark.pedantic(post_round, rounds=10)) == {200}
@@ -0,0 +1,217 @@
+"""
+Live timer keyboards: started timers are shown ticking by editing the card message they were started from.
+One loop keeps a min-heap of the next refresh of every timer. Refreshes become rarer as a timer gets older
+and fall on round values of the elapsed time, so timers due at the same moment are edited in one batch.
+Timers are loaded by one query per sync interval and checked by one query per batch, never one by one.
+"""
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+from requests import RequestException
+from telebot.apihelper import ApiException
+
+from bot import keyboards
+from bot.models import Timer
+from bot.outbox import TokenBucket, ChatBuckets, get_api_error, deactivate_chat
+
+logger = logging.getLogger(__name__)
+
+
+class TickEntry(object):
+    __slots__ = ('timer', 'started', 'deadline', 'reply_markup', 'broken_message_id')
+
+    def __init__(self, timer: Timer):
+        self.timer = timer
+        self.started = timer.created_at.timestamp()
+        self.deadline = None
+        self.reply_markup = None  # JSON of the last sent keyboard
+        self.broken_message_id = None  # the message can't be edited until the timer gets another one
+
+
+class TimerTicker(object):
+    def __init__(self, workers: int = None, sync_interval: float = None, tgbot=None):
+        if tgbot is None:
+            from bot.handlers import tgbot
+        self.tgbot = tgbot
+        self.sync_interval = sync_interval or settings.TIMER_TICKER_SYNC_INTERVAL
+        self.executor = ThreadPoolExecutor(max_workers=workers or settings.TIMER_TICKER_WORKERS)
+        self.bucket = TokenBucket(settings.TIMER_TICKER_RATE_LIMIT)
+        self.chat_buckets = ChatBuckets()
+        self.entries = {}  # timer id -> TickEntry
+        self.heap = []  # (deadline, timer id), entries with another deadline are stale
+        self.in_flight = set()  # timer ids
+        self.deactivated = []  # chat ids, deactivated by the loop thread
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.synced_at = 0
+        self.stats = dict(edited=0, unchanged=0, throttled=0, failed=0, dropped=0)
+
+    @staticmethod
+    def get_interval(age: float) -> float:
+        for max_age, interval in settings.TIMER_TICKER_STEPS:
+            if max_age is None or age < max_age:
+                return interval
+        return settings.TIMER_TICKER_STEPS[-1][1]
+
+    def get_deadline(self, entry: TickEntry, now: float) -> float:
+        age = max(now - entry.started, 0)
+        interval = self.get_interval(age)
+        return entry.started + (age // interval + 1) * interval
+
+    def count(self, key: str):
+        with self.lock:
+            self.stats[key] += 1
+
+    def schedule(self, entry: TickEntry, deadline: float):
+        entry.deadline = deadline
+        heapq.heappush(self.heap, (deadline, entry.timer.id))
+
+    @staticmethod
+    def get_timers():
+        # timers whose message shows something else are not ticked until their card is shown again
+        return Timer.objects.filter(message_id__isnull=False).select_related('tguser')
+
+    def sync(self):
+        """
+        Starts ticking new timers and forgets stopped ones.
+        """
+        now = time.time()
+        timers = {timer.id: timer for timer in self.get_timers()}
+        for timer_id in set(self.entries) - set(timers):
+            del self.entries[timer_id]
+        for timer in timers.values():
+            entry = self.entries.get(timer.id)
+            if entry is None:
+                entry = self.entries[timer.id] = TickEntry(timer)
+                self.schedule(entry, self.get_deadline(entry, now))
+            else:
+                self.update(entry, timer, now)
+        self.synced_at = now
+
+    def update(self, entry: TickEntry, timer: Timer, now: float):
+        if timer.message_id != entry.timer.message_id:
+            # the card was shown again: refresh the new message right away
+            entry.reply_markup = None
+            entry.broken_message_id = None
+            self.schedule(entry, now)
+        entry.timer = timer
+
+    def pop_due(self, now: float) -> list:
+        due = {}
+        while self.heap and self.heap[0][0] <= now:
+            deadline, timer_id = heapq.heappop(self.heap)
+            entry = self.entries.get(timer_id)
+            # the same (deadline, timer id) is pushed again when a throttled entry is rescheduled
+            if entry is not None and entry.deadline == deadline:
+                due[timer_id] = entry
+        return list(due.values())
+
+    def refresh(self, due: list, now: float):
+        timers = {timer.id: timer for timer in self.get_timers().filter(id__in=[entry.timer.id for entry in due])}
+        throttled_until = 0
+        for entry in due:
+            timer = timers.get(entry.timer.id)
+            if timer is None:
+                self.entries.pop(entry.timer.id, None)
+                continue
+            self.update(entry, timer, now)
+            if entry.deadline > now:
+                # rescheduled by update
+                continue
+            self.schedule(entry, self.get_deadline(entry, now))
+            if entry.broken_message_id == timer.message_id or not timer.tguser.active:
+                continue
+            with self.lock:
+                if timer.id in self.in_flight:
+                    # coalesced: the previous edit is still being sent
+                    continue
+            if throttled_until:
+                self.schedule(entry, throttled_until)
+                continue
+            reply_markup = keyboards.Card(timer.tguser, timer.card_id, timer, list_id=timer.list_id).get_reply_markup_json()
+            if reply_markup == entry.reply_markup:
+                self.count('unchanged')
+                continue
+            delay = self.bucket.consume() or self.chat_buckets.get(timer.tguser.tg_id).consume()
+            if delay:
+                # later ones of the batch are throttled too, keep their order
+                self.count('throttled')
+                throttled_until = now + delay
+                self.schedule(entry, throttled_until)
+                continue
+            entry.reply_markup = reply_markup
+            with self.lock:
+                self.in_flight.add(timer.id)
+            self.executor.submit(self.edit, entry, timer, reply_markup)
+
+    def edit(self, entry: TickEntry, timer: Timer, reply_markup):
+        try:
+            self.tgbot.edit_message_reply_markup(timer.tguser.tg_id, timer.message_id, reply_markup=reply_markup)
+        except ApiException as e:
+            description, parameters = get_api_error(e)
+            status_code = e.result.status_code
+            if description == 'Bad Request: message is not modified':
+                self.count('unchanged')
+            elif status_code == 429:
+                self.bucket.pause(parameters.get('retry_after', 1))
+                entry.reply_markup = None
+                self.count('throttled')
+            elif status_code == 403 or (status_code == 400 and description == 'Bad Request: chat not found'):
+                with self.lock:
+                    self.deactivated.append(timer.tguser.tg_id)
+                entry.broken_message_id = timer.message_id
+                self.count('dropped')
+            elif status_code == 400:
+                # deleted or too old to edit
+                entry.broken_message_id = timer.message_id
+                self.count('dropped')
+            else:
+                logger.warning('Timer %d: %s', timer.id, description)
+                entry.reply_markup = None
+                self.count('failed')
+        except RequestException as e:
+            logger.warning('Timer %d: %s', timer.id, e)
+            entry.reply_markup = None
+            self.count('failed')
+        else:
+            self.count('edited')
+        finally:
+            with self.lock:
+                self.in_flight.discard(timer.id)
+
+    def deactivate_chats(self):
+        with self.lock:
+            chat_ids, self.deactivated = self.deactivated, []
+        for chat_id in chat_ids:
+            deactivate_chat(chat_id)
+
+    def get_timeout(self, now: float) -> float:
+        timeout = self.synced_at + self.sync_interval - now
+        if self.heap:
+            timeout = min(timeout, self.heap[0][0] - now)
+        return max(timeout, 0.05)
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                now = time.time()
+                if now - self.synced_at >= self.sync_interval:
+                    self.deactivate_chats()
+                    self.sync()
+                due = self.pop_due(now)
+                if due:
+                    self.refresh(due, now)
+                self.stop_event.wait(self.get_timeout(time.time()))
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stop_event.set()
+        self.executor.shutdown()
+        self.deactivate_chats()
+        connection.close()
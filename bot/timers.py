@@ -0,0 +1,139 @@
+"""
+Timer state transitions. Every transition is a constant number of queries: a started timer is found by the
+(tguser, card_id) unique index, stops lock the row with select_for_update so a timer is never logged twice.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import trolly
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from requests import RequestException
+
+from bot.models import TgUser, Timer, TimeEntry, TimeRollup, TrelloCard
+from bot.utils import TrelloClient
+
+logger = logging.getLogger(__name__)
+
+STARTED = 'started'
+ALREADY_STARTED = 'already_started'
+MULTIPLE = 'multiple'
+
+
+def get_comment(duration: timedelta) -> str:
+    hours = '%.2f' % (duration.total_seconds() / 3600)
+    return 'plus! %s/%s' % (hours, hours)
+
+
+def get(tguser: TgUser, card_id: str) -> Timer or None:
+    return tguser.timer_set.filter(card_id=card_id).first()
+
+
+def detach(tguser: TgUser, message_id: int, keep: Timer = None):
+    """
+    The message was edited to show something else: timers shown in it are not shown anywhere anymore.
+    """
+    timers = tguser.timer_set.filter(message_id=message_id)
+    if keep is not None:
+        timers = timers.exclude(id=keep.id)
+    timers.update(message_id=None)
+
+
+def attach(tguser: TgUser, timer: Timer, message_id: int):
+    """
+    The card of the timer is shown in the message now, instead of whatever the message showed before.
+    """
+    detach(tguser, message_id, keep=timer)
+    if timer.message_id != message_id:
+        timer.message_id = message_id
+        timer.save(update_fields=['message_id'])
+
+
+def start(tguser: TgUser, card: TrelloCard, message_id: int) -> (str, Timer or None):
+    """
+    (STARTED, timer), (ALREADY_STARTED, timer) or (MULTIPLE, None) if another timer is running
+    and TIMER_ALLOW_MULTIPLE is off.
+    """
+    started = {timer.card_id: timer for timer in tguser.timer_set.all()}
+    if card.id in started:
+        return ALREADY_STARTED, started[card.id]
+    if started and not settings.TIMER_ALLOW_MULTIPLE:
+        return MULTIPLE, None
+    # a timer of another card was shown in the same message before
+    detach(tguser, message_id)
+    try:
+        with transaction.atomic():
+            timer = tguser.timer_set.create(board_id=card.board_id, list_id=card.list_id, card_id=card.id, message_id=message_id)
+    except IntegrityError:
+        # started by a concurrent update
+        return ALREADY_STARTED, get(tguser, card.id)
+    return STARTED, timer
+
+
+def pop(tguser: TgUser, card_id: str) -> Timer or None:
+    """
+    Deletes the timer of the card and returns it, None if it was not started or was stopped concurrently.
+    """
+    timer = lock(tguser, card_id)
+    if timer:
+        timer.delete()
+    return timer
+
+
+def lock(tguser: TgUser, card_id: str) -> Timer or None:
+    return Timer.objects.select_for_update().filter(tguser=tguser, card_id=card_id).first()
+
+
+def stop(tguser: TgUser, card_id: str, client: TrelloClient) -> (Timer or None, timedelta or None):
+    """
+    Posts the Trello comment, then deletes the timer and logs its time to the ledger.
+    If the comment fails the timer keeps running, so the time is never logged without being posted.
+    """
+    stopped_at = timezone.now()
+    timer = lock(tguser, card_id)
+    if not timer:
+        return None, None
+    duration = stopped_at - timer.created_at
+    add_comment(client, card_id, duration)
+    timer.delete()
+    TimeEntry.log(timer, stopped_at)
+    return timer, duration
+
+
+def add_comment(client: TrelloClient, card_id: str, duration: timedelta):
+    client.get_card(card_id).add_comments(get_comment(duration))
+
+
+def add_comment_safe(timer: Timer, duration: timedelta) -> bool:
+    """
+    add_comment from a worker thread: nothing is sent to the user if the token was revoked.
+    """
+    client = TrelloClient(timer.tguser, timer.tguser.trello.token, notify_unauthorized=False)
+    try:
+        add_comment(client, timer.card_id, duration)
+    except (trolly.ResourceUnavailable, trolly.Unauthorised, RequestException) as e:
+        logger.warning('Comment of timer %d on card %s was not posted: %s', timer.id, timer.card_id, e)
+        return False
+    return True
+
+
+def stop_many(queryset) -> dict:
+    """
+    Stops the timers of the queryset (e.g. selected in the admin) like `stop`: Trello comments are posted concurrently
+    on behalf of their users, then one query logs the commented ones. Timers whose comment failed keep running.
+    """
+    stopped_at = timezone.now()
+    with transaction.atomic():
+        timers = list(queryset.select_for_update().select_related('tguser', 'tguser__trello'))
+        authorized = [timer for timer in timers if timer.tguser.is_authorized()]
+        with ThreadPoolExecutor(max_workers=settings.TIMER_BULK_STOP_WORKERS) as executor:
+            results = list(executor.map(lambda timer: add_comment_safe(timer, stopped_at - timer.created_at), authorized))
+        commented = [timer for timer, result in zip(authorized, results) if result]
+        if commented:
+            entries = TimeEntry.objects.bulk_create([TimeEntry.get_entry(timer, stopped_at) for timer in commented])
+            TimeRollup.add_many(entries)
+            Timer.objects.filter(id__in=[timer.id for timer in commented]).delete()
+    kept = [timer for timer in timers if timer not in commented]
+    return dict(stopped=len(commented), kept=len(kept), kept_ids=', '.join(str(timer.id) for timer in kept) or '-')
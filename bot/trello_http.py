@@ -0,0 +1,122 @@
+"""
+Process-wide pooled HTTP session for Trello API requests.
+trolly creates a new httplib2.Http per client, so every handler opened a new TLS connection to api.trello.com.
+"""
+import bisect
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+
+
+class TrelloHttpMetrics(object):
+    def __init__(self, pool_size: int):
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.errors = 0
+            self.statuses = {}
+            self.latency = [0] * (len(LATENCY_BUCKETS) + 1)  # the last bucket is +Inf
+            self.latency_sum = 0.0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.saturated = 0  # requests started while all pool connections were busy
+
+    def started(self):
+        with self.lock:
+            if self.in_flight >= self.pool_size:
+                self.saturated += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finished(self, status: int or None, seconds: float):
+        with self.lock:
+            self.in_flight -= 1
+            self.requests += 1
+            if status is None:
+                self.errors += 1
+            else:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.latency[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.latency_sum += seconds
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return dict(
+                requests=self.requests,
+                errors=self.errors,
+                statuses=dict(self.statuses),
+                latency=dict(zip([str(le) for le in LATENCY_BUCKETS] + ['+Inf'], self.latency)),
+                latency_avg=self.latency_sum / self.requests if self.requests else 0,
+                pool_size=self.pool_size,
+                in_flight=self.in_flight,
+                max_in_flight=self.max_in_flight,
+                saturated=self.saturated,
+            )
+
+
+class TrelloHttpResponse(object):
+    """
+    The part of httplib2.Response used by trolly.
+    """
+
+    def __init__(self, status: int):
+        self.status = status
+
+
+class TrelloHttp(object):
+    """
+    Replacement of httplib2.Http for trolly.Client: keep-alive connections pool, timeouts and retries of 429/5xx.
+    """
+
+    def __init__(self, pool_size: int, timeout: tuple, retries: int, backoff_factor: float):
+        self.timeout = timeout
+        self.metrics = TrelloHttpMetrics(pool_size)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,  # the last response goes to trolly check_errors
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        self.metrics.started()
+        started_at = time.monotonic()
+        status = None
+        try:
+            response = self.session.request(method, uri, data=body, headers=headers, timeout=self.timeout)
+            status = response.status_code
+        finally:
+            self.metrics.finished(status, time.monotonic() - started_at)
+        return TrelloHttpResponse(status), response.content
+
+
+_http = None
+_http_lock = threading.Lock()
+
+
+def get_http() -> TrelloHttp:
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                _http = TrelloHttp(
+                    pool_size=settings.TRELLO_HTTP_POOL_SIZE,
+                    timeout=(settings.TRELLO_HTTP_CONNECT_TIMEOUT, settings.TRELLO_HTTP_READ_TIMEOUT),
+                    retries=settings.TRELLO_HTTP_RETRIES,
+                    backoff_factor=settings.TRELLO_HTTP_BACKOFF_FACTOR,
+                )
+    return _http
@@ -1,15 +1,23 @@
+import json
+import os
 import re
+import time
+from collections import OrderedDict
+from urllib import parse
 
 import trolly
 from django.conf import settings
+from django.core.cache import caches
 from django.core.urlresolvers import reverse
 from django.template import engines
 from django.template import loader
 from django.template.backends.django import Template
+from django.template.loaders.app_directories import Loader
 from django.template.defaultfilters import urlencode
 from telebot.types import Message
 
 from base import utils as base_utils
+from bot import trello_http
 
 
 def process_start_param(message: Message or None):
@@ -328,8 +336,19 @@ HTML_ENTITIES = {
 }
 
 
+HTML_ENTITIES_RE = re.compile('|'.join(map(re.escape, HTML_ENTITIES.keys())))
+
+# `<br/>` tag. Inside the tag only whitespace that becomes spaces after `collapse_whitespace` is allowed.
+BR_PATTERN = r'<[bB][rR][\n\r]*(?:[^\S\n\r]\s+| )?/?>'
+BR_RE = re.compile(BR_PATTERN)
+
+PREPARE_TEXT_RE = re.compile(
+    r'(?P<entity>%s)|(?P<gap>\s*%s(?:\s|%s)*|\s{2,}|[\n\r])' % (HTML_ENTITIES_RE.pattern, BR_PATTERN, BR_PATTERN)
+)
+
+
 def replace_html_entities(text: str) -> str:
-    return multiple_replace(HTML_ENTITIES, text)
+    return HTML_ENTITIES_RE.sub(lambda m: HTML_ENTITIES[m.group()], text)
 
 
 def multiple_replace(dic: dict, text: str) -> str:
@@ -351,12 +370,44 @@ def keyboard_factory(tguser, keyboard, reply_markup=True):
     return keyboard
 
 
+def collapse_whitespace(text: str) -> str:
+    """
+    The same as re.sub('(\\n|\\r|\\s{2,})+', ' ', text) for a string that consists of whitespace only.
+    """
+    if text[:1] in ('\n', '\r'):
+        rest = text.lstrip('\n\r')
+        return ' ' + rest if len(rest) == 1 else ' '
+    return text if len(text) < 2 else ' '
+
+
+def _prepare_gap(gap: str) -> str:
+    parts = BR_RE.split(gap)
+    if len(parts) == 1:
+        return collapse_whitespace(gap)
+    last = len(parts) - 1
+    for i, part in enumerate(parts):
+        part = collapse_whitespace(part)
+        if i:
+            part = part.lstrip(' ')
+        if i < last:
+            part = part.rstrip(' ')
+        parts[i] = part
+    return '\n'.join(parts)
+
+
+def _prepare_text_replace(m) -> str:
+    entity = m.group('entity')
+    if entity:
+        return HTML_ENTITIES[entity]
+    return _prepare_gap(m.group('gap'))
+
+
 def prepare_text(text: str) -> str:
-    text = replace_html_entities(text)
-    text = re.sub('(\n|\r|\s{2,})+', ' ', text)
-    text = re.sub('<br */?>', '\n', text, flags=re.IGNORECASE)
-    text = re.sub(' *\n *', '\n', text)
-    return text
+    """
+    Replaces html entities, collapses whitespace and turns `<br/>` into new lines in a single pass.
+    Whitespace only gaps that must be changed are passed to python code, single spaces between words are skipped.
+    """
+    return PREPARE_TEXT_RE.sub(_prepare_text_replace, text)
 
 
 def render_to_string(template_name, context=None):
@@ -370,6 +421,112 @@ def render_from_string(template_code, context=None):
     return prepare_text(template.render(context))
 
 
+TEMPLATE_TITLES = {
+    'private': 'Приватный чат',
+    'group': 'Групповой чат',
+    'errors': 'Ошибки',
+    'tutorial': 'Обучение',
+    'admin': 'Админам',
+}
+
+
+def load_template_source(template_name: str) -> tuple:
+    """
+    Returns (content, origin) of the template found by app directories loader.
+    """
+    django_engine = engines['django'].engine
+    for template_loader in django_engine.template_loaders:
+        if isinstance(template_loader, Loader):
+            return template_loader.load_template_source(template_name)
+    return None, None
+
+
+def get_mtime(path: str or None) -> float or None:
+    if not path:
+        return None
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class DialogTemplate(object):
+    """
+    Dialog template with stripped `title:`/`comment:` headers, compiled once per content version.
+    """
+
+    def __init__(self, template_name: str, source: str, origin: str = None):
+        self.name = template_name
+        self.origin = origin
+        self.mtime = get_mtime(origin)
+        self.version = base_utils.md5(source.encode('utf-8'))
+        text = source
+        title = None
+        m = re.search(r'title:(?P<title>.+)\n', text)
+        if m:
+            title = m.group('title')
+            text = text[:m.start()] + text[m.end():]
+        self.title = self.build_title(template_name, title)
+        self.comment = ''
+        m = re.search(r'comment:(?P<comment>.+)\n', text)
+        if m:
+            self.comment = m.group('comment')
+            text = text[:m.start()] + text[m.end():]
+        template = engines['django'].from_string(text.strip())
+        assert isinstance(template, Template)
+        self.template = template
+
+    @staticmethod
+    def build_title(template_name: str, title: str = None) -> str:
+        name = template_name
+        if name.find('bot/', 0, 4) == 0:
+            name = name[4:]
+        if name.find('.html', -5) != -1:
+            name = name[:-5]
+        title_parts = name.split('/')
+        for i in range(len(title_parts)):
+            part = title_parts[i]
+            if part in TEMPLATE_TITLES:
+                title_parts[i] = TEMPLATE_TITLES[part]
+            elif i == len(title_parts) - 1 and title:
+                title_parts[i] = title.strip()
+        return ' / '.join(title_parts)
+
+    def is_modified(self) -> bool:
+        return self.mtime != get_mtime(self.origin)
+
+    def render(self, context=None) -> str:
+        return prepare_text(self.template.render(context))
+
+
+_dialog_template_versions = {}  # template_name -> version
+_dialog_templates = {}  # (template_name, version) -> DialogTemplate
+
+
+def get_dialog_template(template_name: str) -> DialogTemplate:
+    """
+    Process-wide cache of compiled dialog templates.
+    In DEBUG the template file mtime is checked on every call and the template is recompiled if its content changed.
+    """
+    version = _dialog_template_versions.get(template_name)
+    dialog_template = _dialog_templates.get((template_name, version))
+    if dialog_template and not (settings.DEBUG and dialog_template.is_modified()):
+        return dialog_template
+    source, origin = load_template_source(template_name)
+    if source is None:
+        raise Exception('template %s is not found' % template_name)
+    version = base_utils.md5(source.encode('utf-8'))
+    if dialog_template and dialog_template.version == version:
+        dialog_template.mtime = get_mtime(origin)
+        return dialog_template
+    if dialog_template:
+        _dialog_templates.pop((template_name, dialog_template.version), None)
+    dialog_template = DialogTemplate(template_name, source, origin)
+    _dialog_templates[(template_name, version)] = dialog_template
+    _dialog_template_versions[template_name] = version
+    return dialog_template
+
+
 def bot_url(start: str = ''):
     if start:
         start = base_utils.real_urlsafe_b64encode(start.encode())
@@ -377,10 +534,88 @@ def bot_url(start: str = ''):
     return 'https://telegram.me/%s' % settings.TELEGRAM_BOT_NAME + start
 
 
+class TrelloCache(object):
+    """
+    Cache of Trello GET responses. Entries are keyed by user token, so users never see each other's data.
+    Every entry depends on the version of the object its path starts with (/cards/<id>, /lists/<id>, ...),
+    a write request bumps that version and all entries of the object become unreachable.
+    Version keys live as long as entries, so an expired version can't bring back an entry created before the bump.
+    """
+
+    def __init__(self):
+        self._backend = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(settings.TRELLO_CACHE_TTL)
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            if settings.TRELLO_CACHE_BACKEND:
+                self._backend = caches[settings.TRELLO_CACHE_BACKEND]
+            else:
+                self._backend = base_utils.TTLCache(settings.TRELLO_CACHE_SIZE, settings.TRELLO_CACHE_TTL)
+        return self._backend
+
+    @staticmethod
+    def get_object_id(uri_path: str) -> str:
+        return '/'.join(uri_path.strip('/').split('/')[:2])
+
+    def get_version(self, token_hash: str, object_id: str):
+        return self.backend.get('trello:v:%s:%s' % (token_hash, object_id), 0)
+
+    def bump(self, token_hash: str, object_id: str):
+        self.backend.set('trello:v:%s:%s' % (token_hash, object_id), time.time(), settings.TRELLO_CACHE_TTL)
+
+    def get_key(self, token_hash: str, uri_path: str, query_params: dict or None) -> str:
+        version = self.get_version(token_hash, self.get_object_id(uri_path))
+        request = base_utils.md5(('%s?%s' % (uri_path, json.dumps(query_params or {}, sort_keys=True))).encode())
+        return 'trello:%s:%s:%s' % (token_hash, version, request)
+
+    def get(self, token_hash: str, uri_path: str, query_params: dict or None = None):
+        return self.backend.get(self.get_key(token_hash, uri_path, query_params))
+
+    def set(self, token_hash: str, uri_path: str, query_params: dict or None, value):
+        self.backend.set(self.get_key(token_hash, uri_path, query_params), value, settings.TRELLO_CACHE_TTL)
+
+    def invalidate(self, token_hash: str, uri_path: str):
+        object_id = self.get_object_id(uri_path)
+        object_ids = [object_id]
+        if object_id.startswith('cards/'):
+            # lists and boards contain card data too
+            card_json = self.get(token_hash, '/' + object_id)
+            if card_json:
+                object_ids += ['lists/%s' % card_json.get('idList'), 'boards/%s' % card_json.get('idBoard')]
+        for object_id in object_ids:
+            self.bump(token_hash, object_id)
+
+
+trello_cache = TrelloCache()
+
+
 class TrelloClient(trolly.Client):
-    def __init__(self, tguser, user_auth_token):
+    BATCH_SIZE = 10  # max urls in one Trello /batch request
+    BATCH_TYPES = (
+        (re.compile(r'^/members/[^/]+/boards$'), 'create_board'),
+        (re.compile(r'^/(?:cards|lists)/[^/]+/board$'), 'create_board'),
+        (re.compile(r'^/boards/[^/]+/lists$'), 'create_list'),
+        (re.compile(r'^/cards/[^/]+/list$'), 'create_list'),
+        (re.compile(r'^/(?:boards|lists)/[^/]+/cards$'), 'create_card'),
+        (re.compile(r'^/boards/[^/]+$'), 'create_board'),
+        (re.compile(r'^/lists/[^/]+$'), 'create_list'),
+        (re.compile(r'^/cards/[^/]+$'), 'create_card'),
+    )
+
+    def __init__(self, tguser, user_auth_token, notify_unauthorized=True):
         super().__init__(settings.TRELLO_API_KEY, user_auth_token)
+        self.client = trello_http.get_http()
         self.tguser = tguser
+        # False outside of handlers: errors are raised as is, the user is not asked to authorize again
+        self.notify_unauthorized = notify_unauthorized
+
+    def build_uri(self, path, query_params):
+        return settings.TRELLO_API_URL + self.clean_path(path) + '?' + parse.urlencode(query_params)
 
     def get_authorisation_url(self):
         query_params = {
@@ -397,9 +632,114 @@ class TrelloClient(trolly.Client):
         )
         return authorisation_url
 
+    def fetch_json(self, uri_path, http_method='GET', query_params=None, body=None, headers=None):
+        """
+        GET responses are served from trello_cache, other requests invalidate cached data of the object.
+        Cached values are shared between callers and must not be modified.
+        """
+        token_hash = self.token_hash
+        if not token_hash:
+            return super().fetch_json(uri_path, http_method, query_params, body, headers)
+        uri_path = self.clean_path(uri_path)
+        if http_method != 'GET':
+            try:
+                return super().fetch_json(uri_path, http_method, query_params, body, headers)
+            finally:
+                trello_cache.invalidate(token_hash, uri_path)
+        cache_params = dict(query_params or {})
+        result = trello_cache.get(token_hash, uri_path, cache_params)
+        if result is None:
+            result = super().fetch_json(uri_path, http_method, query_params, body, headers)
+            trello_cache.set(token_hash, uri_path, cache_params, result)
+        return result
+
+    def fetch_fresh_json(self, uri_path, query_params=None):
+        """
+        GET past trello_cache.
+        """
+        return super().fetch_json(uri_path, query_params=query_params)
+
+    @property
+    def token_hash(self) -> str or None:
+        if self.user_auth_token and trello_cache.enabled:
+            return base_utils.md5(self.user_auth_token.encode())
+
+    @staticmethod
+    def parse_batch_item(item) -> (int, object):
+        """
+        Trello returns {"<status>": <json>} for every url of a batch, or an error object with statusCode.
+        """
+        if isinstance(item, dict):
+            if len(item) == 1:
+                key, value = next(iter(item.items()))
+                if key.isdigit():
+                    return int(key), value
+            if 'statusCode' in item:
+                return int(item['statusCode']), item
+        return 500, item
+
+    def batch_json(self, *uri_paths) -> list:
+        """
+        JSON of several GET paths (without query params) in the order of paths.
+        Cached paths are not requested, others are fetched with one /batch request per BATCH_SIZE paths.
+        """
+        uri_paths = [self.clean_path(uri_path) for uri_path in uri_paths]
+        token_hash = self.token_hash
+        results = {}
+        for uri_path in uri_paths:
+            if token_hash and uri_path not in results:
+                result = trello_cache.get(token_hash, uri_path, {})
+                if result is not None:
+                    results[uri_path] = result
+        missing = [uri_path for uri_path in OrderedDict.fromkeys(uri_paths) if uri_path not in results]
+        for i in range(0, len(missing), self.BATCH_SIZE):
+            chunk = missing[i:i + self.BATCH_SIZE]
+            if len(chunk) == 1:
+                results[chunk[0]] = self.fetch_json(chunk[0])
+                continue
+            for uri_path, (status, result) in zip(chunk, self.fetch_batch(chunk)):
+                if status != 200:
+                    self.check_errors(uri_path, trello_http.TrelloHttpResponse(status))
+                results[uri_path] = result
+                if token_hash:
+                    trello_cache.set(token_hash, uri_path, {}, result)
+        return [results[uri_path] for uri_path in uri_paths]
+
+    def fetch_batch(self, uri_paths: list) -> list:
+        """
+        (status, json) of every GET path, past trello_cache. One /batch request per BATCH_SIZE paths.
+        """
+        results = []
+        for i in range(0, len(uri_paths), self.BATCH_SIZE):
+            # not through self.fetch_json: the batch itself must not be cached
+            items = super().fetch_json('/batch', query_params={'urls': ','.join(uri_paths[i:i + self.BATCH_SIZE])})
+            results += [self.parse_batch_item(item) for item in items]
+        return results
+
+    def batch(self, *uri_paths) -> list:
+        """
+        batch_json with results converted to trolly objects by BATCH_TYPES, e.g. /lists/<id>/cards -> [Card, ...].
+        """
+        results = []
+        for uri_path, result in zip(uri_paths, self.batch_json(*uri_paths)):
+            create = None
+            for regexp, method_name in self.BATCH_TYPES:
+                if regexp.match(self.clean_path(uri_path)):
+                    create = getattr(self, method_name)
+                    break
+            if create is None:
+                results.append(result)
+            elif isinstance(result, list):
+                results.append([create(item) for item in result])
+            else:
+                results.append(create(result))
+        return results
+
     def check_errors(self, uri, response):
         try:
             return super().check_errors(uri, response)
         except trolly.ResourceUnavailable:
+            if not self.notify_unauthorized:
+                raise
             self.tguser.unauthorized()
             raise StateErrorHandler('unauthorized')
@@ -1,35 +1,48 @@
+import json
 import logging
 
-from rest_framework.generics import CreateAPIView
-from rest_framework.response import Response
-from rest_framework.status import HTTP_200_OK, HTTP_400_BAD_REQUEST, HTTP_500_INTERNAL_SERVER_ERROR
-from telebot.types import Message, CallbackQuery, Update
-
-from bot.permissions import BotPermission
 from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.http import JsonResponse, HttpResponse
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import View
+
 from base import utils as base_utils
+from bot import serialization
+from bot.models import IncomingUpdate, TrelloBoard
 
 logger = logging.getLogger(__name__)
 
 
-class BotRequestView(CreateAPIView):
-    permission_classes = [BotPermission]
+class BotRequestView(View):
+    """
+    Telegram webhook. A plain view: DRF parsing, content negotiation and rendering cost more than the update itself.
+    The body is decoded once with json.loads and then fully by Update.de_json, nothing is parsed lazily.
+    """
+    http_method_names = ['post']
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
 
-    def post(self, request, *args, **kwargs):
-        if len(request.data) == 0:
-            return Response({'error': 'no data'}, status=HTTP_400_BAD_REQUEST)
+    def post(self, request, token_hash):
+        if token_hash != settings.TELEGRAM_TOKEN_HASH:
+            return JsonResponse({'detail': 'Bot token is not valid.'}, status=403)
+        try:
+            raw = request.body.decode('utf-8')
+            data = json.loads(raw)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or not data:
+            return JsonResponse({'error': 'no data'}, status=400)
+        if settings.TELEGRAM_INGEST_MODE == 'queue':
+            return self.enqueue(raw, data)
         from bot.handlers import tgbot
-        message_id = tg_id = ''
         try:
-            update = Update.de_json(request.data)
-            if update.message:
-                assert isinstance(update.message, Message)
-                message_id = update.message.message_id
-                tg_id = update.message.from_user.id
-            elif update.callback_query:
-                assert isinstance(update.callback_query, CallbackQuery)
-                message_id = update.callback_query.id
-                tg_id = update.callback_query.from_user.id
+            # a valid JSON that is not an update fails here, it is logged like a failed handler
+            update = serialization.parse_update(raw, data)
             tgbot.process_new_updates([update])
         except Exception as e:
             if settings.TESTING:
@@ -37,5 +50,51 @@ class BotRequestView(CreateAPIView):
             base_utils.error_log_to_group_chat()
             logger.exception(e)
             if settings.TELEGRAM_RESPONSE_ERROR_ON_EXCEPTION:
-                return Response({'error': 'exception'}, status=HTTP_500_INTERNAL_SERVER_ERROR)
-        return Response({'status': 'OK'}, status=HTTP_200_OK)
+                return JsonResponse({'error': 'exception'}, status=500)
+        return JsonResponse({'status': 'OK'})
+
+    @staticmethod
+    def enqueue(raw: str, data: dict):
+        try:
+            with transaction.atomic():
+                IncomingUpdate.objects.create(
+                    update_id=data.get('update_id', 0),
+                    tg_id=IncomingUpdate.get_tg_id(data),
+                    body=raw,
+                )
+        except IntegrityError:
+            # Telegram repeats an update if the previous answer was not received, processed ones are kept
+            # for TELEGRAM_INGEST_RETENTION (bot.ingest.prune_processed)
+            pass
+        return JsonResponse({'status': 'OK'})
+
+
+class TrelloWebhookView(View):
+    """
+    Trello webhook callbacks: the board is marked changed and synced by ./manage.py sync_trello.
+    Trello checks the callback URL with a HEAD request when the webhook is created.
+    """
+    http_method_names = ['head', 'post']
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def head(self, request):
+        return HttpResponse()
+
+    def post(self, request):
+        from bot import mirror
+        if not settings.TRELLO_WEBHOOKS or not settings.TRELLO_SECRET_KEY:
+            # unsigned callbacks would let anyone force board syncs
+            return JsonResponse({'detail': 'Webhooks are not enabled.'}, status=403)
+        if not mirror.is_valid_signature(request.body, request.META.get('HTTP_X_TRELLO_WEBHOOK')):
+            return JsonResponse({'detail': 'Signature is not valid.'}, status=403)
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or not isinstance(data.get('model'), dict):
+            return JsonResponse({'error': 'no data'}, status=400)
+        TrelloBoard.objects.filter(id=data['model'].get('id')).update(changed_at=timezone.now())
+        return JsonResponse({'status': 'OK'})
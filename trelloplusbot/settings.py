@@ -289,8 +289,79 @@ GRAPPELLI_CLEAN_INPUT_TYPES = False
 
 UNDER_CONSTRUCTION = False
 
+# TgMessage audit log (bot.audit): written with bulk_create by a background thread, uwsgi needs enable-threads
+AUDIT_LOG_ASYNC = True  # False - saved synchronously inside the update transaction (always so in tests)
+AUDIT_LOG_BATCH_SIZE = 200
+AUDIT_LOG_FLUSH_INTERVAL = 1.0  # seconds
+AUDIT_LOG_MAX_SIZE = 10000  # buffered messages, when full the update saves its message itself
+
+# base.utils.lock backend: FileLockBackend - one host, MySQLLockBackend - many hosts,
+# StripedLockBackend - only when all updates of a user are handled by one process (e.g. the ingest worker mode)
+LOCK_BACKEND = 'base.utils.FileLockBackend'
+
 TRELLO_API_KEY = ''
 TRELLO_SECRET_KEY = ''
+TRELLO_API_URL = 'https://api.trello.com/1'
+# Local mirror of boards, lists and cards (bot.mirror, ./manage.py sync_trello)
+TRELLO_WEBHOOKS = False  # register Trello webhooks for mirrored boards, needs TRELLO_SECRET_KEY and the site reachable from Trello
+TRELLO_MIRROR_SYNC_INTERVAL = 5 * 60  # seconds, boards without webhook callbacks are synced at least this often
+TRELLO_MIRROR_FULL_SYNC_INTERVAL = 24 * 60 * 60  # seconds, boards are mirrored entirely again at least this often
+TRELLO_CACHE_TTL = 60  # seconds, 0 - responses are not cached
+TRELLO_CACHE_SIZE = 10000  # entries of in-process cache
+TRELLO_CACHE_BACKEND = None  # alias from CACHES to share the cache between processes, None - in-process LRU cache
+KEYBOARD_CACHE_SIZE = 10000  # markup JSON of Boards, Lists and Cards keyboards
+KEYBOARD_CACHE_TTL = 10 * 60
+KEYBOARD_PAGE_SIZE = 20  # buttons of items on a page of Boards, Lists and Cards keyboards
+KEYBOARD_PAGE_CACHE_SIZE = 10000  # pages read from the mirror
+KEYBOARD_PREFETCH = True  # the next page is read in a background thread (never in tests)
+KEYBOARD_PREFETCH_WORKERS = 2
+SEARCH_INDEX_SIZE = 5000  # boards indexed in process memory, least recently searched ones are evicted
+SEARCH_RESULTS = 10
+SEARCH_MIN_SCORE = 0.5  # share of the query trigrams a card must contain
+SEARCH_DESC_WEIGHT = 0.8  # of a match in the card description relative to the name
+SEARCH_DESC_LENGTH = 1000  # characters of a description that are indexed
+IDENTITY_CACHE_TTL = 60  # seconds TgUser/TgChat rows are kept in process memory
+IDENTITY_CACHE_SIZE = 10000  # rows per model
+# alias from CACHES for versions of cached rows, the cache is off unless it is shared between processes (memcached, redis)
+IDENTITY_CACHE_BACKEND = None
+TRELLO_HTTP_POOL_SIZE = 10  # keep-alive connections to api.trello.com per process
+TRELLO_HTTP_CONNECT_TIMEOUT = 5
+TRELLO_HTTP_READ_TIMEOUT = 15
+TRELLO_HTTP_RETRIES = 3  # retries of 429 and 5xx responses and connection errors (POST is retried on connection errors only)
+TRELLO_HTTP_BACKOFF_FACTOR = 0.3
+
+# 'inline' - webhook updates are processed inside the request,
+# 'queue' - stored to IncomingUpdate and processed by ./manage.py process_updates
+TELEGRAM_INGEST_MODE = 'inline'
+TELEGRAM_INGEST_WORKERS = 4  # worker processes, updates of one user are always processed by the same worker
+TELEGRAM_INGEST_RETENTION = 2 * 24 * 60 * 60  # seconds processed updates are kept to drop repeated ones, less than a week
+
+# asyncio runtime (bot.aio, ./manage.py process_updates --async)
+ASYNC_EXECUTOR_WORKERS = 32  # threads for sync handlers and ORM, each keeps its own database connection
+ASYNC_MAX_IN_FLIGHT = 500  # updates processed concurrently
+
+# Outgoing Telegram requests queue (bot.outbox, ./manage.py send_outbox)
+TELEGRAM_OUTBOX = False  # True - requests are queued by default instead of being sent inside the webhook request
+TELEGRAM_OUTBOX_WORKERS = 8
+TELEGRAM_OUTBOX_MAX_ATTEMPTS = 5
+TELEGRAM_GLOBAL_RATE_LIMIT = 30  # requests per second
+TELEGRAM_CHAT_RATE_LIMIT = 1  # requests per second to one private chat
+TELEGRAM_GROUP_RATE_LIMIT = 20 / 60  # requests per second to one group chat
+
+# Timers (bot.timers)
+TIMER_ALLOW_MULTIPLE = False  # True - a user may run timers of several cards at once
+TIMER_BULK_STOP_WORKERS = 8  # threads posting Trello comments of timers stopped in the admin
+
+# Live timer keyboards (bot.ticker, ./manage.py timer_ticker)
+TIMER_TICKER_STEPS = (  # (timer age below, refresh interval) in seconds, None - any age
+    (60, 5),
+    (10 * 60, 15),
+    (60 * 60, 60),
+    (None, 5 * 60),
+)
+TIMER_TICKER_SYNC_INTERVAL = 5  # seconds between loads of started and stopped timers
+TIMER_TICKER_WORKERS = 4
+TIMER_TICKER_RATE_LIMIT = 10  # edits per second, the ticker's share of TELEGRAM_GLOBAL_RATE_LIMIT
 
 from trelloplusbot.local_settings import *
 
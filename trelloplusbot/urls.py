@@ -3,7 +3,8 @@ from django.conf.urls import include, url
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.template.response import TemplateResponse
 
 from bot import views as bot_views
@@ -32,12 +33,20 @@ def get_token(request, **kwargs):
     return TemplateResponse(request, 'bot/token.html', context)
 
 
+@staff_member_required
+def trello_metrics(request):
+    from bot.trello_http import get_http
+    return JsonResponse(get_http().metrics.as_dict())
+
+
 urlpatterns = [
     url(r'^$', home),
     url(r'^grappelli/', include('grappelli.urls')),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^bot/(?P<token_hash>[0-9a-z]+)/$', bot_views.BotRequestView.as_view(), name='bot_webhook'),
+    url(r'^trello/webhook/$', bot_views.TrelloWebhookView.as_view(), name='trello_webhook'),
     url(r'^token/$', get_token, name='token'),
+    url(r'^trello_metrics/$', trello_metrics, name='trello_metrics'),
 ]
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)